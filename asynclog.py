@@ -0,0 +1,330 @@
+"""
+Log and terminal output written on a background thread, so that a slow
+disk or terminal does not stall the thread that drains the event source.
+"""
+import io
+import sys
+import time
+import queue
+import logging
+import threading
+import unittest
+import logging.handlers
+
+console = None  # file-like object for terminal output once `start` was called
+
+
+class BackgroundWriter(object):
+    """
+    passes the items queued by `put_nowait` or `put` to `write_batch` on a
+    background thread, up to `batch` items per call. at most `depth` items
+    are buffered; items queued with `put_nowait` while the buffer is full
+    are dropped rather than blocking the caller, `put` waits for room.
+    the number of items dropped since the last batch is passed to
+    `write_batch` so it can note the gap in the output.
+    """
+    _done = object()  # sentinel asking the writer thread to exit
+
+    def __init__(self, write_batch, depth: int = 8192, batch: int = 256,
+                 name: str = "background-writer"):
+        self.write_batch = write_batch
+        self.depth = depth
+        self.batch = batch
+        self._queue = queue.Queue(maxsize=depth)
+        self._lock = threading.Lock()
+        self._missed = 0  # dropped since the last batch
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+        # counters
+        self.queued = 0
+        self.dropped = 0
+        self.batches = 0
+
+    def put_nowait(self, item) -> None:
+        try:
+            self._queue.put_nowait(item)
+            self.queued += 1
+        except queue.Full:
+            with self._lock:
+                self._missed += 1
+                self.dropped += 1
+
+    def put(self, item) -> None:
+        self._queue.put(item)
+        self.queued += 1
+
+    def _take_missed(self) -> int:
+        if not self._missed:
+            return 0
+        with self._lock:
+            missed, self._missed = self._missed, 0
+        return missed
+
+    def _run(self) -> None:
+        get_nowait = self._queue.get_nowait
+        while True:
+            items = [self._queue.get()]
+            try:
+                while len(items) < self.batch:
+                    items.append(get_nowait())
+            except queue.Empty:
+                pass
+            count = len(items)
+            done = items[-1] is BackgroundWriter._done
+            if done:
+                items.pop()
+            missed = self._take_missed()
+            try:
+                if items or missed:
+                    self.write_batch(items, missed)
+                    self.batches += 1
+            except Exception:
+                pass  # like logging, never let output errors end tracing
+            finally:
+                for _ in range(count):
+                    self._queue.task_done()
+            if done:
+                return
+
+    def flush(self) -> None:
+        """
+        waits until everything queued so far was written.
+        """
+        self._queue.join()
+
+    def close(self, timeout: float = 5.0) -> None:
+        if self._thread.is_alive():
+            self._queue.put(BackgroundWriter._done)
+            self._thread.join(timeout)
+
+    def summary(self) -> str:
+        return "{} queued, {} dropped, {} batches".format(self.queued, self.dropped, self.batches)
+
+
+class QueueLogHandler(logging.handlers.QueueHandler):
+    """
+    queues log records for a BackgroundWriter, which formats them. this
+    leaves only creating the record to the logging thread, so the record
+    arguments must not be mutated later; cctrace only logs strings and
+    numbers. errors, e.g. policy violations, are never dropped.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if record.levelno >= logging.ERROR:
+            self.queue.put(record)
+        else:
+            self.queue.put_nowait(record)
+
+
+class Console(object):
+    """
+    file-like object queueing terminal output for a BackgroundWriter, one
+    item per line or run of lines, so that the text and the newline that
+    `print` writes separately are queued together. the output is policy
+    violations, so it waits for room rather than being dropped.
+    """
+
+    def __init__(self, writer: BackgroundWriter):
+        self.writer = writer
+        self._partial = ""  # text not ending in a newline yet
+        self._lock = threading.Lock()
+
+    def write(self, text: str) -> None:
+        with self._lock:
+            text = self._partial + text
+            if not text.endswith("\n"):
+                self._partial = text
+                return
+            self._partial = ""
+        self.writer.put(text)
+
+    def flush(self) -> None:
+        with self._lock:
+            (text, self._partial) = (self._partial, "")
+        if text:
+            self.writer.put(text)
+        self.writer.flush()
+
+
+def _log_writer(handler: logging.Handler, others=()):
+    def write_batch(records: list, missed: int) -> None:
+        if missed:
+            records.append(logging.makeLogRecord({
+                'msg': "... %d log messages dropped", 'args': (missed,),
+                'levelname': 'WARNING', 'levelno': logging.WARNING}))
+        handler.acquire()
+        try:
+            handler.stream.write("".join(handler.format(r) + handler.terminator
+                                         for r in records))
+            handler.flush()
+        finally:
+            handler.release()
+        for other in others:
+            for r in records:
+                other.handle(r)
+    return write_batch
+
+
+def _console_writer(stream):
+    def write_batch(texts: list, missed: int) -> None:
+        if missed:
+            texts.append("... {} messages not shown, see log for details.\n".format(missed))
+        stream.write("".join(texts))
+        stream.flush()
+    return write_batch
+
+
+_writers = []
+
+
+def start(handler: logging.StreamHandler, depth: int = 8192,
+          stream=None, others=()) -> None:
+    """
+    sends the records of the root logger to `handler` and any `others`,
+    and the output written to `console` to `stream` (stdout by default),
+    each through a BackgroundWriter buffering up to `depth` messages.
+    """
+    global console
+    log = BackgroundWriter(_log_writer(handler, others), depth, name="log-writer")
+    out = BackgroundWriter(_console_writer(stream or sys.stdout), depth,
+                           name="console-writer")
+    _writers[:] = [log, out, handler, others]
+    logging.getLogger().addHandler(QueueLogHandler(log))
+    console = Console(out)
+
+
+def flush() -> None:
+    """
+    waits for pending output, e.g. before writing to stdout directly.
+    """
+    if not _writers:
+        return
+    log, out, handler, others = _writers
+    for writer in (log, out, handler) + tuple(others):
+        writer.flush()
+
+
+def dropped() -> tuple:
+    """
+    the number of log records and console messages dropped so far.
+    """
+    if not _writers:
+        return 0, 0
+    return _writers[0].dropped, _writers[1].dropped
+
+
+def stop() -> tuple:
+    """
+    writes pending output and stops the writers. records logged later
+    go to the handler directly. returns the number of log records and
+    console messages that were dropped.
+    """
+    global console
+    if not _writers:
+        return 0, 0
+    log, out, handler, others = _writers
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        if isinstance(h, QueueLogHandler) and h.queue is log:
+            root.removeHandler(h)
+    out.close()
+    log.close()
+    root.addHandler(handler)
+    for other in others:
+        root.addHandler(other)
+    del _writers[:]
+    console = None
+    return log.dropped, out.dropped
+
+
+class TestAsyncLog(unittest.TestCase):
+
+    def test_drops_when_full(self):
+        gate = threading.Event()
+        batches = []
+
+        def write_batch(items, missed):
+            gate.wait()
+            batches.append((list(items), missed))
+            if missed:
+                items.append("... dropped")  # writers may add a note
+
+        writer = BackgroundWriter(write_batch, depth=4, batch=2)
+        start = time.perf_counter()
+        for i in range(20):
+            writer.put_nowait(i)
+        self.assertLess(time.perf_counter() - start, 1.0)  # never blocks
+        gate.set()
+        writer.flush()
+        writer.close()
+        written = [i for (items, _) in batches for i in items]
+        self.assertEqual(written, sorted(written))
+        self.assertEqual(len(written) + writer.dropped, 20)
+        self.assertEqual(sum(m for (_, m) in batches), writer.dropped)
+        self.assertTrue(all(len(items) <= 2 for (items, _) in batches))
+
+    def test_logging_and_console(self):
+        logfile, out = io.StringIO(), io.StringIO()
+        handler = logging.StreamHandler(logfile)
+        handler.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
+        root = logging.getLogger()
+        level = root.level
+        root.setLevel(logging.INFO)
+        start(handler, stream=out)
+        try:
+            logging.info("%d:%s", 10, "/usr/bin/cc")
+            print("Error: not using expected c_compiler.", file=console)
+            flush()
+            self.assertEqual(logfile.getvalue(), "INFO:10:/usr/bin/cc\n")
+            self.assertEqual(out.getvalue(), "Error: not using expected c_compiler.\n")
+        finally:
+            self.assertEqual(stop(), (0, 0))
+        self.assertIsNone(console)
+        logging.info("not queued")
+        root.removeHandler(handler)
+        root.setLevel(level)
+        self.assertEqual(logfile.getvalue(), "INFO:10:/usr/bin/cc\nINFO:not queued\n")
+
+
+    def test_errors_and_console_not_dropped(self):
+        gate = threading.Event()
+
+        class SlowStream(io.StringIO):
+            def write(self, text):
+                gate.wait()
+                return super(SlowStream, self).write(text)
+
+        logfile, out = SlowStream(), SlowStream()
+        handler = logging.StreamHandler(logfile)
+        handler.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
+        root = logging.getLogger()
+        level = root.level
+        root.setLevel(logging.INFO)
+        start(handler, depth=2, stream=out)
+        opened = threading.Timer(0.2, gate.set)  # the disk and terminal catch up
+        opened.start()
+        try:
+            for i in range(8):
+                logging.info("info %d", i)
+                logging.error("violation %d", i)
+                print("Error: violation {}.".format(i), file=console)
+            flush()
+        finally:
+            (log_dropped, console_dropped) = stop()
+            opened.join()
+            root.removeHandler(handler)
+            root.setLevel(level)
+        self.assertEqual(console_dropped, 0)
+        self.assertGreater(log_dropped, 0)  # info messages
+        self.assertEqual(out.getvalue(), "".join(
+            "Error: violation {}.\n".format(i) for i in range(8)))
+        errors = [l for l in logfile.getvalue().splitlines() if l.startswith("ERROR")]
+        self.assertEqual(errors, ["ERROR:violation {}".format(i) for i in range(8)])
+
+
+if __name__ == '__main__':
+    unittest.main()
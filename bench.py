@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the cctrace event pipeline.
+
+Generates a synthetic, but realistic, sysdig event stream for a parallel
+build and measures how fast it flows through CCEvent.parse, the ProcTree
+handlers and Policy.check, and how ProcTree.print_tree scales.
+
+    $ python3 bench.py --processes 200000 --jobs 64
+    $ python3 bench.py --emit build.events   # for ./cctrace --replay
+"""
+import io
+import os
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import resource
+import tracemalloc
+import contextlib
+
+from ccevent import CCEvent, SYSDIG_NA
+from policy import Policy
+from proctable import ProcTable
+from proctree import ProcTree
+
+USER_UID = 1000
+
+
+def _b64(tokens) -> str:
+    payload = b'\0'.join(t.encode() for t in tokens)
+    return base64.b64encode(payload).decode()
+
+
+class BuildGenerator(object):
+    """
+    Emits sysdig records (as produced by `cctrace`'s format string with
+    --print-base64) for a recursive make/libtool build of C and C++ sources.
+
+    Up to `jobs` build jobs run concurrently; their events are interleaved
+    randomly the same way a `make -jN` build interleaves them. Events are
+    `event_us` microseconds apart on average.
+    """
+    compilers = ['/usr/bin/gcc', '/usr/bin/g++', '/usr/bin/cc', '/usr/bin/clang']
+    utils = ['/bin/sed', '/bin/grep', '/bin/mkdir', '/bin/rm', '/usr/bin/tr']
+
+    def __init__(self, processes=10000, jobs=64, depth=4, env_vars=60,
+                 na_ratio=0.02, seed=0, profile='full-env', event_us=50):
+        self.processes = processes
+        self.profile = profile
+        self.jobs = jobs
+        self.depth = depth
+        self.na_ratio = na_ratio
+        self.rand = random.Random(seed)
+        self._next_pid = 20000
+        self._spawned = 0
+        self.clock = 1700000000 * 10 ** 9  # ns since the epoch
+        self.event_ns = event_us * 1000
+        env = ["PWD=/home/user/src/project"]
+        env += ["VAR_{0}={1}".format(i, "x" * self.rand.randint(10, 80))
+                for i in range(env_vars)]
+        self.env = _b64(env)
+
+    def _pid(self) -> int:
+        self._next_pid += 1
+        self._spawned += 1
+        return self._next_pid
+
+    def _exepath(self, exe: str) -> str:
+        return SYSDIG_NA if self.rand.random() < self.na_ratio else exe
+
+    @staticmethod
+    def _comm(exe: str) -> str:
+        return exe.rsplit('/', 1)[-1][:15]
+
+    def _clone(self, exe: str, pid: int, ppid: int, gppid: int):
+        common = "exe={0} args={1} tid={{0}} pid={{0}} ptid={{1}} cwd= fdlimit=1024 " \
+                 "pgft_maj=0 pgft_min=0 vm_size=8192 vm_rss=1024 vm_swap=0 " \
+                 "comm={2} flags=25165824(CLONE_CHILD_CLEARTID|CLONE_CHILD_SETTID) " \
+                 "uid={3} gid={3} vtid={{0}} vpid={{0}}"
+        common = common.format(exe, _b64([self._comm(exe)]), self._comm(exe), USER_UID)
+        if self.profile != 'full-env':
+            common = self._projected(exe, [self._comm(exe)])
+        pname = self._comm(exe)
+        # clone returns in the parent (res=child pid) and in the child (res=0)
+        yield "{0}#clone#{1}#{2}#{0}#{3}#res={4} {5}##\n".format(
+            ppid, exe, pname, gppid, pid, common.format(ppid, gppid))
+        yield "{0}#clone#{1}#{2}#{0}#{3}#res=0 {4}##\n".format(
+            pid, self._exepath(exe), pname, ppid, common.format(pid, ppid))
+
+    def _projected(self, exe: str, argv) -> str:
+        """
+        event arguments as requested by the capture profiles in capture.py
+        """
+        eargs = "exe={0}".format(exe)
+        if self.profile == 'args-only':
+            eargs += " args=" + _b64(argv)
+        return eargs + " cwd=/home/user/src/project"
+
+    def _execve(self, exe: str, argv, pid: int, ppid: int, parent: str):
+        pname = self._comm(parent)
+        if self.profile != 'full-env':
+            # execve enter events are filtered out
+            yield "{0}#execve#{1}#{2}#{0}#{3}#res=0 {4}##\n".format(
+                pid, self._exepath(exe), pname, ppid, self._projected(exe, argv))
+            return
+        # the enter event still reports the (forked) parent executable
+        yield "{0}#execve#{1}#{2}#{0}#{3}#filename={4}##\n".format(
+            pid, parent, pname, ppid, exe)
+        eargs = "res=0 exe={0} args={1} tid={2} pid={2} ptid={3} cwd= fdlimit=1024 " \
+                "pgft_maj=0 pgft_min=0 vm_size=8192 vm_rss=1024 vm_swap=0 " \
+                "comm={4} env={5} tty=34817 pgid={3} loginuid={6}"
+        eargs = eargs.format(exe, _b64(argv), pid, ppid, self._comm(exe), self.env, USER_UID)
+        yield "{0}#execve#{1}#{2}#{0}#{3}#{4}##\n".format(
+            pid, self._exepath(exe), pname, ppid, eargs)
+
+    def _procexit(self, exe: str, pid: int, ppid: int):
+        eargs = "status=0 ret=0 sig=0 core=0"
+        if self.profile != 'full-env':
+            eargs = "res=<NA> exe=<NA> cwd=/home/user/src/project"
+        yield "{0}#procexit#{1}#{2}#{0}#{3}#{4}##\n".format(
+            pid, exe, self._comm(exe), ppid, eargs)
+
+    def _spawn(self, parent: str, exe: str, argv, ppid: int, gppid: int):
+        """
+        fork+exec of `exe` by `parent`; returns the pid and its records.
+        """
+        pid = self._pid()
+        records = list(self._clone(parent, pid, ppid, gppid))
+        records += self._execve(exe, argv, pid, ppid, parent)
+        return pid, records
+
+    def _compile(self, make_pid: int, make_ppid: int, n: int):
+        """
+        make -> sh -> libtool -> gcc -> {cc1, as}, one source file.
+        """
+        cc = self.rand.choice(self.compilers)
+        src = "src/dir{0}/file{1}.c".format(n % 97, n)
+        flags = ["-I/home/user/src/project/include/sub{0}".format(i) for i in range(12)]
+        flags += ["-DHAVE_CONFIG_H", "-O2", "-g", "-Wall", "-Wextra", "-fPIC"]
+        cc_argv = [cc.rsplit('/', 1)[-1]] + flags + ["-c", src, "-o", src[:-2] + ".o"]
+
+        sh, recs = self._spawn('/usr/bin/make', '/bin/sh',
+                               ['/bin/sh', '-c', " ".join(cc_argv)], make_pid, make_ppid)
+        yield from recs
+        lt, recs = self._spawn('/bin/sh', '/usr/bin/libtool',
+                               ['libtool', '--mode=compile'] + cc_argv, sh, make_pid)
+        yield from recs
+        gcc, recs = self._spawn('/usr/bin/libtool', cc, cc_argv, lt, sh)
+        yield from recs
+        for helper in ['/usr/lib/gcc/x86_64-linux-gnu/8/cc1', '/usr/bin/as']:
+            hpid, recs = self._spawn(cc, helper, [helper] + flags, gcc, lt)
+            yield from recs
+            yield from self._procexit(helper, hpid, gcc)
+        if self.rand.random() < 0.1:  # libtool runs utilities here and there
+            util = self.rand.choice(self.utils)
+            upid, recs = self._spawn('/usr/bin/libtool', util, [util, 'x'], lt, sh)
+            yield from recs
+            yield from self._procexit(util, upid, lt)
+        yield from self._procexit(cc, gcc, lt)
+        yield from self._procexit('/usr/bin/libtool', lt, sh)
+        yield from self._procexit('/bin/sh', sh, make_pid)
+
+    def _link(self, make_pid: int, make_ppid: int, n: int):
+        cc = self.rand.choice(self.compilers)
+        objs = ["obj{0}.o".format(i) for i in range(40)]
+        gcc, recs = self._spawn('/usr/bin/make', cc,
+                                [cc, '-o', 'lib{0}.so'.format(n), '-shared'] + objs,
+                                make_pid, make_ppid)
+        yield from recs
+        c2, recs = self._spawn(cc, '/usr/lib/gcc/x86_64-linux-gnu/8/collect2',
+                               ['collect2'] + objs, gcc, make_pid)
+        yield from recs
+        ld, recs = self._spawn('/usr/lib/gcc/x86_64-linux-gnu/8/collect2', '/usr/bin/ld',
+                               ['/usr/bin/ld'] + objs, c2, gcc)
+        yield from recs
+        yield from self._procexit('/usr/bin/ld', ld, c2)
+        yield from self._procexit('/usr/lib/gcc/x86_64-linux-gnu/8/collect2', c2, gcc)
+        yield from self._procexit(cc, gcc, make_pid)
+
+    def _make(self, level: int, ppid: int, gppid: int, parent_exe: str):
+        """
+        a (recursive) make process; leaf makes build targets in parallel.
+        """
+        make, recs = self._spawn(parent_exe, '/usr/bin/make',
+                                 ['make', '-j{0}'.format(self.jobs)], ppid, gppid)
+        yield from recs
+        if level < self.depth:
+            for _ in range(2):
+                yield from self._make(level + 1, make, ppid, '/usr/bin/make')
+        else:
+            n = 0
+            while self._spawned < self.processes:
+                n += 1
+                if n % 25 == 0:
+                    yield from self._link(make, ppid, n)
+                    break
+                yield from self._compile(make, ppid, n)
+        yield from self._procexit('/usr/bin/make', make, ppid)
+
+    def records(self):
+        """
+        yields records until (about) `self.processes` processes were spawned.
+        """
+        shell = self._pid()
+        active = []
+        while self._spawned < self.processes or active:
+            while len(active) < self.jobs and self._spawned < self.processes:
+                active.append(self._make(0, shell, 1, '/bin/bash'))
+            job = self.rand.randrange(len(active))
+            try:
+                record = next(active[job])
+            except StopIteration:
+                active.pop(job)
+                continue
+            self.clock += int(self.rand.expovariate(1.0) * self.event_ns)
+            yield "{} ts={}##\n".format(record[:-3], self.clock).encode()
+
+
+def percentiles(samples, ps=(50, 90, 99, 99.9)):
+    if not samples:
+        return {p: 0.0 for p in ps}
+    samples = sorted(samples)
+    n = len(samples)
+    return {p: samples[min(n - 1, int(n * p / 100.0))] for p in ps}
+
+
+def run_pipeline(records, p: Policy, timed=False, backend=ProcTree):
+    """
+    mirrors cctrace's handle_record/trace_execve without terminal output.
+    returns the populated tree and, if timed, per-stage latencies.
+    """
+    pt = backend()
+    stages = {'parse': [], 'tree': [], 'policy': []}
+    clock = time.perf_counter
+    for record in records:
+        t0 = clock()
+        evt = CCEvent.parse(record)
+        t1 = clock()
+        if evt.type == b'execve':
+            pt.handle_execve(evt)
+            t2 = clock()
+            if not evt.eargs.startswith(b'filename='):
+                if not p.check(evt.exepath, evt.args):
+                    p.is_checked(evt.exepath)
+                if timed:
+                    stages['policy'].append(clock() - t2)
+        elif evt.type == b'clone':
+            if b"res=0 " in evt.eargs:
+                pt.handle_clone(evt)
+            t2 = clock()
+        else:
+            pt.handle_procexit(evt)
+            t2 = clock()
+        if timed:
+            stages['parse'].append(t1 - t0)
+            stages['tree'].append(t2 - t1)
+    return pt, stages
+
+
+def bench_print_tree(gen_args: dict, p: Policy, sizes, backend=ProcTree) -> list:
+    results = []
+    for n in sizes:
+        gen = BuildGenerator(**dict(gen_args, processes=n))
+        pt, _ = run_pipeline(list(gen.records()), p, backend=backend)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            pt.print_tree(p)
+        results.append((n, time.perf_counter() - start))
+    return results
+
+
+def main():
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    default_policy = os.path.join(script_dir, 'policy/default.cctrace.json')
+
+    parser = argparse.ArgumentParser(description='benchmark the cctrace event pipeline.')
+    parser.add_argument('-n', '--processes', type=int, default=20000,
+                        help='number of processes in the synthetic build')
+    parser.add_argument('-j', '--jobs', type=int, default=64,
+                        help='number of concurrent build jobs')
+    parser.add_argument('--depth', type=int, default=4,
+                        help='depth of recursive make invocations')
+    parser.add_argument('--env-vars', type=int, default=60,
+                        help='number of environment variables per process')
+    parser.add_argument('--na-ratio', type=float, default=0.02,
+                        help='fraction of events with an <NA> exepath')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--capture', default='full-env',
+                        choices=['full-env', 'args-only', 'minimal'],
+                        help='capture profile (see capture.py) to emit records for')
+    parser.add_argument('-p', '--policy', default=default_policy,
+                        type=argparse.FileType('r'), help='policy to check against')
+    parser.add_argument('--tree-sizes', default='1000,5000,20000',
+                        help='comma separated process counts for print_tree scaling')
+    parser.add_argument('--tree-backend', default='anytree', choices=['anytree', 'table'],
+                        help='process tree implementation to benchmark')
+    parser.add_argument('--emit', metavar='FILE', default=None,
+                        help='write the generated stream to FILE and exit')
+    args = parser.parse_args()
+
+    gen_args = dict(jobs=args.jobs, depth=args.depth, env_vars=args.env_vars,
+                    na_ratio=args.na_ratio, seed=args.seed, profile=args.capture)
+    records = list(BuildGenerator(processes=args.processes, **gen_args).records())
+
+    if args.emit:
+        with open(args.emit, 'wb') as f:
+            f.writelines(records)
+        print("wrote {} records to {}".format(len(records), args.emit))
+        return
+
+    backend = ProcTable if args.tree_backend == 'table' else ProcTree
+    p = Policy()
+    p.configure(json.load(args.policy))
+    p.keep_going = True
+
+    print("events.......: {}".format(len(records)))
+    print("stream size..: {:.1f} MiB".format(sum(map(len, records)) / 2.0 ** 20))
+
+    start = time.perf_counter()
+    run_pipeline(records, p, backend=backend)
+    elapsed = time.perf_counter() - start
+    print("throughput...: {:.0f} events/s ({:.3f}s)".format(len(records) / elapsed, elapsed))
+
+    _, stages = run_pipeline(records, p, timed=True, backend=backend)
+    for stage, samples in sorted(stages.items()):
+        pcts = percentiles(samples)
+        pcts = "  ".join("p{}={:.2f}us".format(k, v * 1e6) for (k, v) in sorted(pcts.items()))
+        print("{:.<13}: {}".format(stage, pcts))
+
+    tracemalloc.start()
+    pt, _ = run_pipeline(records, p, backend=backend)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("peak traced..: {:.1f} MiB".format(peak / 2.0 ** 20))
+    print("tree memory..: {:.1f} MiB for {} processes".format(current / 2.0 ** 20, pt.node_count))
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("max rss......: {:.1f} MiB".format(maxrss / 1024.0))
+
+    sizes = [int(s) for s in args.tree_sizes.split(',') if s]
+    for (n, secs) in bench_print_tree(gen_args, p, sizes, backend):
+        print("print_tree...: {:>8} processes in {:.3f}s".format(n, secs))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,310 @@
+"""
+Compact binary trace format. A trace starts with MAGIC followed by
+length-prefixed records:
+
+    u32 length of the body, u8 kind, body
+
+STRING records append a string to the string table; their body is the raw
+bytes of the string and its id is the number of strings defined before it.
+EVENT records hold one event as a fixed-width part (EVENT_HEAD) followed
+by the string ids of the argv and environment tokens. exepaths, argv and
+environment tokens are interned, so each distinct string is written once.
+all integers are little-endian; the string ids are byte-swapped on
+big-endian hosts.
+"""
+import os
+import sys
+import time
+import mmap
+import struct
+import binascii
+import unittest
+from array import array
+
+from ccevent import CCEvent
+from tools import LRUCache
+
+MAGIC = b"CCTRACE\x01"
+RECORD_HEAD = struct.Struct("<IB")
+STRING = 1
+EVENT = 2
+# type, res, tid, pid, ppid, timestamp (ns), exepath, pname, exe, cwd, argc, envc
+EVENT_HEAD = struct.Struct("<BiiiiQIIIIII")
+EVENT_TYPES = (b'execve', b'clone', b'procexit')  # type code - 1
+NO_STRING = 0xffffffff  # id of a missing string, e.g. no cwd
+# string ids are handled as arrays, which use the native byte order
+SWAP_IDS = sys.byteorder == 'big'
+
+
+def is_bintrace(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class BinTraceWriter(object):
+    """
+    writes events to a binary trace as they are traced. execve enter
+    events carry nothing the exit event doesn't and are left out.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, 'wb', buffering=1 << 16)
+        self.file.write(MAGIC)
+        self.ids = dict()  # bytes -> string id
+        # most processes share their environment with their parent; skip
+        # decoding and interning payloads that were written before
+        self._token_ids = LRUCache(4096)  # raw payload -> (ids, count)
+        self.events = 0
+
+    def _intern(self, s: bytes) -> int:
+        sid = self.ids.get(s, None)
+        if sid is None:
+            sid = len(self.ids)
+            self.ids[s] = sid
+            self.file.write(RECORD_HEAD.pack(len(s), STRING) + s)
+        return sid
+
+    def _tokens(self, evt: CCEvent, name: bytes) -> tuple:
+        """
+        the string ids of the tokens in a base64 encoded event argument.
+        """
+        raw = evt.field(name)
+        if not raw:
+            return b'', 0
+        entry = self._token_ids.get(raw, None)
+        if entry is None:
+            intern = self._intern
+            payload = evt.payload(name)
+            ids = array('I', [intern(t) for t in payload.split(b'\0')] if payload else [])
+            if SWAP_IDS:
+                ids.byteswap()
+            entry = (ids.tobytes(), len(ids))
+            self._token_ids.put(raw, entry)
+        return entry
+
+    def write(self, evt: CCEvent, ts: int = None) -> None:
+        if evt.type == b'execve' and evt.eargs.startswith(b'filename='):
+            return
+        if ts is None:
+            ts = evt.ts or int(time.time() * 1e9)  # else time of receipt
+        res = evt.field(b"res")
+        try:
+            res = int(res) if res else 0
+        except ValueError:
+            res = 0
+
+        exe = evt.field(b"exe")
+        cwd = evt.field(b"cwd")
+        argv, argc = self._tokens(evt, b"args")
+        env, envc = self._tokens(evt, b"env")
+        head = EVENT_HEAD.pack(EVENT_TYPES.index(evt.type) + 1, res,
+                               evt.tid, evt.pid, evt.ppid, ts,
+                               self._intern(evt.exepath.encode('utf-8', 'surrogateescape')),
+                               self._intern(evt.pname.encode('utf-8', 'surrogateescape')),
+                               self._intern(exe) if exe else NO_STRING,
+                               self._intern(cwd) if cwd else NO_STRING,
+                               argc, envc)
+        body = argv + env
+        self.file.write(RECORD_HEAD.pack(len(head) + len(body), EVENT) + head + body)
+        self.events += 1
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class BinEvent(object):
+    """
+    one event read from a binary trace. strings are resolved, and copied
+    out of the mapped trace, only when accessed.
+    """
+    __slots__ = ('reader', 'type', 'res', 'tid', 'pid', 'ppid', 'ts',
+                 '_exepath', '_pname', '_exe', '_cwd', '_argv', '_env')
+
+    def __init__(self, reader, head: tuple, argv: memoryview, env: memoryview):
+        self.reader = reader
+        (code, self.res, self.tid, self.pid, self.ppid, self.ts,
+         self._exepath, self._pname, self._exe, self._cwd, _, _) = head
+        self.type = EVENT_TYPES[code - 1]
+        self._argv = argv
+        self._env = env
+
+    @property
+    def exepath(self) -> str:
+        return self.reader.string(self._exepath).decode('utf-8', 'surrogateescape')
+
+    @property
+    def pname(self) -> str:
+        return self.reader.string(self._pname).decode('utf-8', 'surrogateescape')
+
+    @property
+    def cwd(self) -> str:
+        if self._cwd == NO_STRING:
+            return None
+        return self.reader.string(self._cwd).decode(errors='replace')
+
+    @property
+    def argv(self) -> list:
+        return [self.reader.string(i).decode(errors='replace') for i in self._argv]
+
+    def _payload(self, ids: memoryview) -> bytes:
+        return b'\0'.join(self.reader.string(i) for i in ids)
+
+    def record(self) -> bytes:
+        """
+        the event as a record in the format read by CCEvent.parse.
+        """
+        string = self.reader.string
+        eargs = [b"%d#%s#%s#%s#%d#%d#res=%d" % (self.tid, self.type, string(self._exepath),
+                                                string(self._pname), self.pid, self.ppid,
+                                                self.res)]
+        if self._exe != NO_STRING:
+            eargs.append(b"exe=" + string(self._exe))
+        if len(self._argv):
+            eargs.append(b"args=" + binascii.b2a_base64(self._payload(self._argv), newline=False))
+        if len(self._env):
+            eargs.append(b"env=" + binascii.b2a_base64(self._payload(self._env), newline=False))
+        if self._cwd != NO_STRING:
+            eargs.append(b"cwd=" + string(self._cwd))  # may contain spaces
+        eargs.append(b"ts=%d" % self.ts)
+        return b" ".join(eargs)
+
+
+class BinTraceReader(object):
+    """
+    reads a binary trace through a read-only memory map. the file is not
+    copied into memory; records are decoded in place with struct.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ) if size else b''
+        self.view = memoryview(self.map)
+        if bytes(self.view[:len(MAGIC)]) != MAGIC:
+            raise ValueError("{} is not a cctrace binary trace".format(path))
+        self.offsets = array('Q')  # where each string starts
+        self.lengths = array('I')
+
+    def string(self, sid: int) -> bytes:
+        offset = self.offsets[sid]
+        return self.view[offset:offset + self.lengths[sid]].tobytes()
+
+    def events(self):
+        """
+        yields the events in the trace in the order they were written.
+        """
+        view = self.view
+        end = len(view)
+        offset = len(MAGIC)
+        head_size = RECORD_HEAD.size
+        while offset + head_size <= end:
+            length, kind = RECORD_HEAD.unpack_from(view, offset)
+            offset += head_size
+            if offset + length > end:
+                break  # truncated by a crash
+            if kind == STRING:
+                self.offsets.append(offset)
+                self.lengths.append(length)
+            elif kind == EVENT:
+                head = EVENT_HEAD.unpack_from(view, offset)
+                ids = view[offset + EVENT_HEAD.size:offset + length].cast('I')
+                if SWAP_IDS:
+                    ids = array('I', ids)
+                    ids.byteswap()
+                argc = head[-2]
+                yield BinEvent(self, head, ids[:argc], ids[argc:])
+            offset += length
+
+    def records(self):
+        for evt in self.events():
+            yield evt.record()
+
+    def close(self) -> None:
+        try:
+            self.view.release()
+            if self.map:
+                self.map.close()
+        except BufferError:
+            pass  # events still refer to the map; it goes away with them
+        self.file.close()
+
+
+class TestBinTrace(unittest.TestCase):
+
+    def test_roundtrip(self):
+        import tempfile
+        b64 = lambda *t: binascii.b2a_base64(b'\0'.join(t), newline=False).decode()
+        lines = [
+            "10#clone#/usr/bin/make#bash#10#1#res=0 exe=/usr/bin/make",
+            "10#execve#/usr/bin/make#bash#10#1#filename=/usr/bin/cc",
+            "10#execve#/usr/bin/cc#bash#10#1#res=0 exe=cc args={} env={} cwd=/my src".format(
+                b64(b"cc", b"-c", b"a.c"), b64(b"PWD=/my src", b"CC=cc")),
+            "11#execve#<NA>#make#11#10#res=0 exe=/usr/bin/cc args={}".format(
+                b64(b"cc", b"-c", b"b.c")),
+            "10#procexit#/usr/bin/cc#bash#10#0#status=0 ts=1700000000000000000",
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "trace.bin")
+            writer = BinTraceWriter(path)
+            for i, line in enumerate(lines):
+                evt = CCEvent.parse(line.encode())
+                writer.write(evt, ts=None if evt.ts else i)
+            writer.close()
+            self.assertEqual(writer.events, 4)  # execve enter left out
+            # "cc", "-c" and "/usr/bin/cc" are only stored once
+            self.assertEqual(len(writer.ids), 12)
+            self.assertTrue(is_bintrace(path))
+
+            reader = BinTraceReader(path)
+            events = list(reader.events())
+            self.assertEqual([e.ts for e in events], [0, 2, 3, 1700000000000000000])
+            self.assertEqual([e.type for e in events],
+                             [b'clone', b'execve', b'execve', b'procexit'])
+            self.assertEqual(events[1].argv, ["cc", "-c", "a.c"])
+            self.assertEqual(events[1].cwd, "/my src")
+            self.assertEqual(events[2].exepath, "<NA>")
+            self.assertEqual((events[2].pid, events[2].ppid), (11, 10))
+
+            # records read back parse to the same events
+            evts = [CCEvent.parse(e.record()) for e in events]
+            self.assertEqual(evts[1].args, "cc -c a.c")
+            self.assertEqual(evts[1].getenv("CC"), "cc")
+            self.assertEqual(evts[1].cwd, "/my src")
+            self.assertEqual(evts[2].exepath, "<NA>")
+            self.assertEqual(evts[2].field(b"exe"), b"/usr/bin/cc")
+            self.assertEqual(evts[0].field(b"res"), b"0")
+            self.assertEqual([e.ts for e in evts], [0, 2, 3, 1700000000000000000])
+            reader.close()
+
+    def test_id_byte_order(self):
+        import tempfile
+        global SWAP_IDS
+        args = binascii.b2a_base64(b"cc\0-c\0a.c", newline=False)
+        evt = CCEvent.parse(b"10#execve#/usr/bin/cc#make#10#1#res=0 args=" + args)
+
+        def roundtrip(path):
+            writer = BinTraceWriter(path)
+            writer.write(evt, ts=1)
+            writer.close()
+            reader = BinTraceReader(path)
+            self.assertEqual([e.argv for e in reader.events()], [["cc", "-c", "a.c"]])
+            reader.close()
+            with open(path, 'rb') as f:
+                return f.read()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # cc, -c and a.c are the first strings interned
+            self.assertTrue(roundtrip(os.path.join(tmpdir, "native.bin")).endswith(
+                struct.pack("<III", 0, 1, 2)))
+            # the reader undoes the swap of the writer, as on big-endian hosts
+            swap = SWAP_IDS
+            try:
+                SWAP_IDS = not swap
+                self.assertTrue(roundtrip(os.path.join(tmpdir, "other.bin")).endswith(
+                    struct.pack(">III", 0, 1, 2)))
+            finally:
+                SWAP_IDS = swap
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,278 @@
+"""
+Build time profile: how long each tool ran, which compiles and links took
+longest, and how many build jobs ran in parallel over time.
+"""
+import io
+import sys
+import math
+import heapq
+import binascii
+import unittest
+from array import array
+
+from ccevent import CCEvent
+from runtracker import Run, RunTracker
+from tools import ToolType
+
+# programs that are not build jobs themselves, but may start them
+NOT_JOBS = (ToolType.unknown, ToolType.util, ToolType.builder, ToolType.interpreter)
+
+
+def percentile(values: list, p: float) -> float:
+    """
+    the p-th percentile of the sorted `values` (nearest rank).
+
+    >>> percentile([1, 2, 3, 4], 50), percentile([1, 2, 3, 4], 90), percentile([], 50)
+    (2, 4, 0.0)
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(math.ceil(len(values) * p / 100.0)) - 1))]
+
+
+def job_kind(tt: ToolType, argv: list) -> str:
+    """
+    'compile' or 'link' for the compiler and linker invocations listed as
+    the slowest ones; None for everything else.
+
+    >>> job_kind(ToolType.c_compiler, ["cc", "-c", "a.c"])
+    'compile'
+    >>> job_kind(ToolType.c_compiler, ["cc", "-o", "a", "a.o"])
+    'link'
+    >>> job_kind(ToolType.c_compiler, ["cc", "-E", "a.c"]) is None
+    True
+    """
+    if tt.is_linker():
+        return 'link'
+    if not tt.is_compiler():
+        return None
+    if '-E' in argv or '-M' in argv or '-MM' in argv:
+        return None
+    if '-c' in argv or '-S' in argv:
+        return 'compile'
+    return 'link'
+
+
+class JobRun(Run):
+    """
+    a program run and the build job it belongs to.
+    """
+    __slots__ = ('job', 'in_job', 'kind', 'evt')
+
+
+class BuildProfile(RunTracker):
+    """
+    collects the wall time of every program run during the build from the
+    timestamps of its execve and procexit events, or the time the events
+    were received if they have none.
+
+    build jobs are the programs that are build tools (compilers, linkers,
+    assemblers, archivers, ...) but were not started by another build
+    tool; e.g. a gcc started by make is a job, the cc1 and ld it starts
+    are part of that job. the number of jobs running at a time is the
+    parallelism the build achieved.
+    """
+    run_type = JobRun
+
+    def __init__(self, top: int = 10):
+        super().__init__()
+        self.top = top
+        self.durations = dict()  # exepath -> array of seconds
+        self.types = dict()  # exepath -> ToolType
+        self.job_starts = array('q')
+        self.job_ends = array('q')
+        self.job_labels = []  # 'compile', 'link' or the tool type of other jobs
+        self.slowest = {'compile': [], 'link': []}  # min-heaps
+        self.unfinished = 0  # programs still running when tracing stopped
+        self._seq = 0
+
+    def _start(self, run: JobRun, evt: CCEvent, parent: JobRun, previous: JobRun) -> None:
+        inside = any(r is not None and r.in_job for r in (parent, previous))
+        run.job = not inside and run.tt not in NOT_JOBS
+        run.in_job = run.job or inside
+        run.kind = job_kind(run.tt, evt.argv) if run.job else None
+        run.evt = evt if run.kind else None  # kept for the arguments
+
+    def _finish(self, run: JobRun, ts: int) -> None:
+        seconds = max(0, ts - run.started) / 1e9
+        durations = self.durations.get(run.exepath, None)
+        if durations is None:
+            durations = self.durations[run.exepath] = array('d')
+            self.types[run.exepath] = run.tt
+        durations.append(seconds)
+        if run.job:
+            self.job_starts.append(run.started)
+            self.job_ends.append(max(ts, run.started))
+            self.job_labels.append(run.kind or run.tt.name)
+        if run.kind:
+            heap = self.slowest[run.kind]
+            if len(heap) < self.top or seconds > heap[0][0]:
+                self._seq += 1
+                entry = (seconds, self._seq, run.pid, run.exepath, run.evt.args)
+                if len(heap) < self.top:
+                    heapq.heappush(heap, entry)
+                else:
+                    heapq.heapreplace(heap, entry)
+
+    def close(self) -> None:
+        """
+        ends the programs that are still running at the time of the last event.
+        """
+        self.unfinished += self.finish_all()
+
+    def peak_parallelism(self) -> int:
+        points = sorted([(t, 1) for t in self.job_starts] + [(t, -1) for t in self.job_ends])
+        peak = running = 0
+        for (_, delta) in points:
+            running += delta
+            peak = max(peak, running)
+        return peak
+
+    def timeline(self, slots: int = 30) -> list:
+        """
+        splits the build into `slots` intervals of equal length. returns
+        (start offset in seconds, average number of jobs running, label of
+        the jobs that ran longest) for each interval; labels are 'compile',
+        'link', or the tool type of other jobs, e.g. 'archiver'.
+        """
+        if self.first is None or self.last <= self.first:
+            return []
+        span = (self.last - self.first) / slots
+        busy = [dict() for _ in range(slots)]  # label -> job ns
+        for (start, end, label) in zip(self.job_starts, self.job_ends, self.job_labels):
+            first = int((start - self.first) // span)
+            last = min(slots - 1, int((end - self.first) // span))
+            for i in range(first, last + 1):
+                lo = self.first + i * span
+                overlap = min(end, lo + span) - max(start, lo)
+                if overlap > 0:
+                    busy[i][label] = busy[i].get(label, 0) + overlap
+        rows = []
+        for (i, labels) in enumerate(busy):
+            top = max(labels, key=labels.get) if labels else ""
+            rows.append((i * span / 1e9, sum(labels.values()) / span, top))
+        return rows
+
+    def _table(self, out, title: str, rows: list) -> None:
+        out.write("\n{}\n".format(title))
+        out.write("{:<40} {:>7} {:>9} {:>8} {:>8} {:>8}\n".format(
+            "", "runs", "total s", "p50 s", "p90 s", "max s"))
+        for (name, values) in rows:
+            values = sorted(values)
+            out.write("{:<40} {:>7} {:>9.2f} {:>8.3f} {:>8.3f} {:>8.3f}\n".format(
+                name[-40:], len(values), sum(values), percentile(values, 50),
+                percentile(values, 90), values[-1]))
+
+    def write_report(self, out, top: int = None, slots: int = 30, width: int = 40) -> None:
+        self.close()
+        top = top or self.top
+        wall = (self.last - self.first) / 1e9 if self.first is not None else 0.0
+        job_time = sum(e - s for (s, e) in zip(self.job_starts, self.job_ends)) / 1e9
+        out.write("build profile: {:.2f}s wall time, {} programs run, {} build jobs, "
+                  "parallelism {:.1f} on average, {} at peak\n".format(
+                      wall, sum(len(d) for d in self.durations.values()),
+                      len(self.job_starts), job_time / wall if wall else 0.0,
+                      self.peak_parallelism()))
+        if self.unfinished:
+            out.write("{} programs were still running when tracing stopped\n".format(
+                self.unfinished))
+
+        by_type = dict()
+        for (exepath, durations) in self.durations.items():
+            by_type.setdefault(self.types[exepath].name, []).extend(durations)
+        rows = sorted(by_type.items(), key=lambda r: -sum(r[1]))
+        self._table(out, "wall time by tool type:", rows)
+        rows = sorted(((e, d) for (e, d) in self.durations.items()
+                       if self.types[e] not in NOT_JOBS or self.types[e] == ToolType.unknown),
+                      key=lambda r: -sum(r[1]))
+        self._table(out, "wall time by program (top {}):".format(top), rows[:top])
+
+        for kind in ('compile', 'link'):
+            heap = sorted(self.slowest[kind], reverse=True)
+            if heap:
+                out.write("\nslowest {}s:\n".format(kind))
+            for (seconds, _, pid, exepath, args) in heap:
+                args = args or exepath
+                out.write("{:>9.3f}s  {:>7}  {}\n".format(
+                    seconds, pid, args if len(args) <= 100 else args[:97] + "..."))
+
+        rows = self.timeline(slots)
+        if rows:
+            scale = max(r[1] for r in rows) or 1.0
+            out.write("\nbuild jobs running over time (average per {:.2f}s):\n".format(
+                wall / slots))
+            for (offset, jobs, label) in rows:
+                line = "{:>8.2f}s  {:<{w}} {:>6.1f}  {}".format(
+                    offset, "#" * int(round(jobs / scale * width)), jobs, label, w=width)
+                out.write(line.rstrip() + "\n")
+
+
+class TestBuildProfile(unittest.TestCase):
+
+    @staticmethod
+    def _profile() -> BuildProfile:
+        b64 = lambda *t: binascii.b2a_base64(b'\0'.join(t), newline=False).decode()
+        t0, ms = 1700000000000000000, 1000000
+        lines = [
+            # make starts two compiles in parallel, then links
+            "10#execve#/usr/bin/make#bash#10#1#res=0 ts={}".format(t0),
+            "11#clone#/usr/bin/make#make#11#10#res=0 ts={}".format(t0 + 1 * ms),
+            "11#execve#/usr/bin/gcc#make#11#10#res=0 args={} ts={}".format(
+                b64(b"gcc", b"-c", b"a.c"), t0 + 1 * ms),
+            "12#clone#/usr/bin/make#make#12#10#res=0 ts={}".format(t0 + 1 * ms),
+            "12#execve#/usr/bin/gcc#make#12#10#res=0 args={} ts={}".format(
+                b64(b"gcc", b"-c", b"b.c"), t0 + 1 * ms),
+            # gcc runs cc1, which is part of the compile job
+            "13#clone#/usr/bin/gcc#gcc#13#11#res=0 ts={}".format(t0 + 2 * ms),
+            "13#execve#/usr/lib/gcc/x86_64-linux-gnu/8/cc1#gcc#13#11#res=0 ts={}".format(
+                t0 + 2 * ms),
+            "13#procexit#x#x#13#11#status=0 ts={}".format(t0 + 90 * ms),
+            "11#procexit#x#x#11#10#status=0 ts={}".format(t0 + 101 * ms),
+            "12#procexit#x#x#12#10#status=0 ts={}".format(t0 + 51 * ms),
+            "14#clone#/usr/bin/make#make#14#10#res=0 ts={}".format(t0 + 101 * ms),
+            "14#execve#/usr/bin/ld#make#14#10#res=0 args={} ts={}".format(
+                b64(b"ld", b"-o", b"app", b"a.o", b"b.o"), t0 + 101 * ms),
+            "14#procexit#x#x#14#10#status=0 ts={}".format(t0 + 201 * ms),
+            "10#procexit#x#x#10#1#status=0 ts={}".format(t0 + 201 * ms),
+        ]
+        prof = BuildProfile(top=1)
+        for line in lines:
+            evt = CCEvent.parse(line.encode())
+            if evt.type == b'execve':
+                prof.handle_execve(evt)
+            elif evt.type == b'clone':
+                prof.handle_clone(evt)
+            else:
+                prof.handle_procexit(evt)
+        return prof
+
+    def test_jobs(self):
+        prof = self._profile()
+        self.assertEqual(len(prof.job_starts), 3)  # cc1 is no job of its own
+        self.assertEqual(sorted(prof.durations["/usr/bin/gcc"]), [0.05, 0.1])
+        self.assertEqual(prof.peak_parallelism(), 2)
+        self.assertEqual(prof.slowest['compile'][0][4], "gcc -c a.c")  # top 1
+        self.assertEqual(prof.slowest['link'][0][:1], (0.1,))
+        rows = prof.timeline(slots=2)
+        self.assertEqual([r[2] for r in rows], ['compile', 'link'])
+        self.assertAlmostEqual(rows[0][1], (0.0995 + 0.05) / 0.1005, places=5)  # 0-100.5ms
+
+    def test_report(self):
+        out = io.StringIO()
+        self._profile().write_report(out, slots=4, width=10)
+        report = out.getvalue()
+        self.assertTrue(report.startswith("build profile: 0.20s wall time, 5 programs run, "
+                                          "3 build jobs, parallelism 1.2 on average, "
+                                          "2 at peak\n"), report)
+        self.assertIn("\nslowest links:\n    0.100s       14  ld -o app a.o b.o\n", report)
+        self.assertTrue(report.splitlines()[-1].endswith("link"))
+
+
+def load_tests(loader, tests, ignore):
+    import doctest
+    tests.addTests(doctest.DocTestSuite(sys.modules[__name__]))
+    return tests
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+"""
+Builds the sysdig filter expression selecting the events cctrace needs
+and the format string describing the records sysdig prints for them.
+"""
+import unittest
+
+from tools import ToolType
+
+EVENTS_FILTER = "(evt.type=execve or evt.type=clone or evt.type=procexit) and evt.failed=false"
+
+# every record has the same fields (see CCEvent.parse), the last of which
+# holds the event arguments as `key=value` pairs. capture profiles differ
+# in which arguments they request; the full environment of each execve
+# is often several KB, the arguments are needed for policy checks only.
+# the time of the event goes last (see CCEvent.ts).
+FORMAT_FIELDS = "%thread.tid#%evt.type#%proc.exepath#%proc.pname#%proc.pid#%proc.ppid#"
+FORMAT_TIME = " ts=%evt.rawtime##"
+# the container of the process goes before the time when tracing several
+# containers (see CCEvent.container)
+FORMAT_CONTAINER = " ct=%container.id/%container.name"
+CAPTURE_PROFILES = {
+    'full-env': FORMAT_FIELDS + "%evt.args" + FORMAT_TIME,
+    'args-only': FORMAT_FIELDS + "res=%evt.rawres exe=%evt.arg.exe args=%evt.arg.args "
+                                 "cwd=%proc.cwd" + FORMAT_TIME,
+    'minimal': FORMAT_FIELDS + "res=%evt.rawres exe=%evt.arg.exe cwd=%proc.cwd" + FORMAT_TIME,
+}
+DEFAULT_PROFILE = 'full-env'
+# the enter event of execve only carries a filename argument, which the
+# projected profiles don't request; drop the enter event instead.
+NO_EXECVE_ENTER = "not (evt.type=execve and evt.dir=>)"
+
+
+def formatspec(profile: str = DEFAULT_PROFILE, containers: bool = False) -> str:
+    fmt = CAPTURE_PROFILES[profile]
+    if containers:
+        fmt = fmt[:-len(FORMAT_TIME)] + FORMAT_CONTAINER + FORMAT_TIME
+    return fmt
+
+
+# utilities that (practically) never start other programs. when they
+# classify as ToolType.util they can't be policed and their nodes would be
+# pruned from the process tree as boring leafs anyway.
+LEAF_UTILS = ('basename', 'cat', 'chmod', 'cmp', 'cp', 'cut', 'date', 'diff',
+              'dirname', 'echo', 'expr', 'false', 'grep', 'head', 'ln', 'ls',
+              'mkdir', 'mktemp', 'mv', 'printf', 'readlink', 'rm', 'rmdir',
+              'sed', 'sort', 'tail', 'tee', 'test', 'touch', 'tr', 'true',
+              'uname', 'uniq', 'wc')
+
+
+def scope_filter(user: str = None, container=None, pid: int = None,
+                 all_containers: bool = False) -> str:
+    """
+    `container` is the name of a container or a list of names.
+    """
+    if pid:  # the process and everything it starts
+        return "(proc.pid={0} or proc.apid={0})".format(pid)
+    if all_containers:
+        return "container.id!=host"
+    if isinstance(container, str):
+        container = [container]
+    if container and len(container) > 1:
+        return "container.name in ({})".format(", ".join(container))
+    if container:
+        return "container.name=" + container[0]
+    return "user.name=" + user
+
+
+def droppable_utils(p) -> list:
+    """
+    leaf utilities whose execve events can be dropped under policy p.
+    """
+    names = []
+    for name in LEAF_UTILS:
+        tt = ToolType.from_path("/usr/bin/" + name)
+        if tt == ToolType.util and not p.is_checked("/usr/bin/" + name):
+            names.append(name)
+    return names
+
+
+def prefilter(p) -> str:
+    """
+    a tighter replacement for EVENTS_FILTER that drops, in the kernel, the
+    events cctrace would discard anyway:
+
+    - execve enter events; everything we need is in the exit event,
+    - the parent side of clone and clones that create threads,
+    - procexit of threads other than the main thread,
+    - execve of leaf utilities (see `droppable_utils`). their processes
+      stay in the tree under the name of their parent, but are never
+      marked as having called execve, so the tree printer prunes them.
+
+    clones are never dropped based on the executable so that the ancestry
+    of every process stays intact.
+    """
+    execve = "evt.type=execve and evt.dir=<"
+    utils = droppable_utils(p)
+    if utils:
+        execve += " and not proc.name in ({})".format(", ".join(utils))
+    clone = "evt.type=clone and evt.dir=< and evt.rawres=0" \
+            " and not evt.arg.flags contains CLONE_THREAD"
+    procexit = "evt.type=procexit and thread.ismain=true"
+    return "(({}) or ({}) or ({})) and evt.failed=false".format(execve, clone, procexit)
+
+
+def build_filter(scope: str, p=None, use_prefilter=False,
+                 profile: str = DEFAULT_PROFILE) -> str:
+    """
+    the sysdig filter for the events of `scope`, or of all processes if
+    `scope` is None, e.g. for capture files from other hosts.
+    """
+    events = prefilter(p) if use_prefilter else EVENTS_FILTER
+    if profile != 'full-env' and not use_prefilter:
+        events += " and " + NO_EXECVE_ENTER
+    if scope is None:
+        return events
+    return events + "  and " + scope
+
+
+class TestCapture(unittest.TestCase):
+
+    def test_scope(self):
+        self.assertEqual(scope_filter(user="bob"), "user.name=bob")
+        self.assertEqual(scope_filter(user="bob", container="ci"), "container.name=ci")
+        self.assertEqual(scope_filter(user="bob", pid=42), "(proc.pid=42 or proc.apid=42)")
+        self.assertEqual(scope_filter(container=["ci"]), "container.name=ci")
+        self.assertEqual(scope_filter(container=["ci1", "ci2"]), "container.name in (ci1, ci2)")
+        self.assertEqual(scope_filter(all_containers=True), "container.id!=host")
+
+    def test_default_filter(self):
+        self.assertEqual(build_filter("user.name=bob"),
+                         EVENTS_FILTER + "  and user.name=bob")
+
+    def test_unscoped_filter(self):
+        # --read-scap traces all processes in the capture
+        self.assertEqual(build_filter(None), EVENTS_FILTER)
+        from policy import Policy
+        self.assertTrue(build_filter(None, Policy(), use_prefilter=True).endswith(
+            "evt.failed=false"))
+
+    def test_prefilter(self):
+        from policy import Policy
+        p = Policy()
+        filt = build_filter("user.name=bob", p, use_prefilter=True)
+        self.assertIn("evt.dir=<", filt)
+        self.assertIn("thread.ismain=true", filt)
+        self.assertTrue(filt.endswith("and user.name=bob"))
+        # only tools classified as utilities are ever dropped
+        utils = droppable_utils(p)
+        self.assertIn("sed", utils)
+        for name in utils:
+            self.assertEqual(ToolType.from_path("/bin/" + name), ToolType.util)
+
+    def test_profiles(self):
+        from ccevent import CCEvent
+        for profile in CAPTURE_PROFILES:
+            fmt = formatspec(profile)
+            self.assertTrue(fmt.endswith(" ts=%evt.rawtime##"))
+            self.assertEqual(fmt.count("#"), 8)
+            filt = build_filter("user.name=bob", profile=profile)
+            self.assertEqual(NO_EXECVE_ENTER in filt, profile != 'full-env')
+            fmt = formatspec(profile, containers=True)
+            self.assertTrue(fmt.endswith(FORMAT_CONTAINER + FORMAT_TIME))
+            self.assertEqual(fmt.count("#"), 8)
+        # what sysdig prints for an execve event with the args-only profile
+        evt = CCEvent.parse(b"7#execve#/usr/bin/cc#make#7#1#res=0 exe=/usr/bin/cc "
+                            b"args=Y2MALWMAYS5j cwd=/home/my src ts=1700000000123456789##\n")
+        self.assertEqual(evt.args, "cc -c a.c")
+        self.assertEqual(evt.cwd, "/home/my src")
+        self.assertEqual(evt.ts, 1700000000123456789)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 
-import base64
+import os
+import binascii
+import unittest
 
 # from typing import Optional, List  # not available in Python3.4
 
 from tools import ToolType
 
+SYSDIG_NA = '<NA>'  # sysdig's placeholder for values it does not know
+
 
 class Colors:
     # Terminal escape codes
@@ -22,7 +26,9 @@ class Colors:
 def get_color(exepath: str) -> str:
     color = get_color.cache.get(exepath, None)
     if color:
+        get_color.hits += 1
         return color
+    get_color.misses += 1
 
     tt = ToolType.from_path(exepath)
     if tt.is_compiler_or_linker():
@@ -45,6 +51,8 @@ def get_color(exepath: str) -> str:
 
 
 get_color.cache = dict()
+get_color.hits = 0
+get_color.misses = 0
 
 
 def _parse_pid(s: bytes) -> int:
@@ -54,15 +62,19 @@ def _parse_pid(s: bytes) -> int:
     try:
         return int(s[:s.index(b'(')])
     except ValueError:  # '(' not found
-        try:
-            return int(s)
-        except ValueError:
-            print(s)
-            assert False
+        return int(s)  # raises ValueError if s is not a pid
 
 
 class CCEvent(object):
+    """
+    One sysdig event. The event arguments (eargs) are kept as raw bytes;
+    the offsets of the individual `key=value` fields are found once, on
+    first use, and each base64 payload is decoded at most once.
+    """
+    __slots__ = ('tid', 'type', 'exepath', 'pname', 'pid', 'ppid', 'eargs',
+                 '_offsets', '_argv', '_args', '_envb', '_env')
     separator = b'#'
+    terminator = b'##\n'
 
     def __init__(self, tid: int, _type: bytes, exepath: str, pname: str,
                  pid: int, ppid: int, eargs: bytes):
@@ -73,47 +85,184 @@ class CCEvent(object):
         self.pid = pid
         self.ppid = ppid
         self.eargs = eargs
+        self._offsets = None  # type: dict[bytes, tuple[int, int]]
+        self._argv = None
+        self._args = None
+        self._envb = None
+        self._env = None
+
+    def _scan_eargs(self) -> dict:
+        """
+        maps field names to (start, end) offsets of their values in eargs.
+        values may contain spaces (e.g. exe=/path with spaces) in which case
+        the tokens without a '=' are appended to the preceding value.
+        """
+        offsets = dict()
+        eargs = self.eargs or b''
+        n = len(eargs)
+        i = 0
+        key = None
+        while i < n:
+            j = eargs.find(b' ', i)
+            if j < 0:
+                j = n
+            eq = eargs.find(b'=', i, j)
+            if eq > i:
+                key = eargs[i:eq]
+                offsets[key] = (eq + 1, j)
+            elif key is not None:
+                offsets[key] = (offsets[key][0], j)
+            i = j + 1
+        return offsets
 
-    def _parse_eargs_field(self, fieldname: bytes) -> str:
-        atoms = self.eargs.split()
-        flen = len(fieldname)
+    def field(self, name: bytes) -> bytes:
+        """
+        returns the raw value of the named event argument or None.
+        """
+        if self._offsets is None:
+            self._offsets = self._scan_eargs()
+        span = self._offsets.get(name, None)
+        if span is None:
+            return None
+        return self.eargs[span[0]:span[1]]
+
+    def _decode_field(self, name: bytes) -> bytes:
+        payload = self.field(name)
+        if not payload:
+            return b''
         try:
-            for a in atoms:
-                if a.startswith(fieldname):
-                    # get list of bytearrays
-                    payload = base64.decodebytes(a[flen:]).split(b'\0') 
-                    payload = map(lambda n: n.decode(), payload)
-                    return payload
-        except:
-            pass
-        return None
-        # return "(could not decode {})".format(fieldname.decode())
+            return binascii.a2b_base64(payload)
+        except binascii.Error:
+            return b''
+
+    def payload(self, name: bytes) -> bytes:
+        """
+        returns the decoded value of a base64 encoded event argument (args,
+        env), with tokens separated by NUL bytes, or b''.
+        """
+        if name == b"env":
+            return self._env_bytes()
+        return self._decode_field(name)
 
     @property
     def color(self):
         return get_color(self.exepath)
 
+    @property
+    def resolved_exepath(self) -> str:
+        """
+        exepath, or the exe (else filename) argument when sysdig reports
+        the exepath as <NA>; <NA> if neither is known.
+        """
+        exepath = self.exepath
+        if exepath == SYSDIG_NA:
+            exe = self.field(b"exe") or self.field(b"filename")
+            if exe:
+                return exe.decode(errors='replace')
+        return exepath
+
+    @property
+    def argv(self) -> list:
+        if self._argv is None:
+            payload = self._decode_field(b"args")
+            if payload:
+                payload = payload.split(b'\0')
+                self._argv = [a.decode(errors='replace') for a in payload]
+            else:
+                self._argv = []
+        return self._argv
+
     @property
     def args(self) -> str:
-        args = self._parse_eargs_field(b"args=")
-        if args:
-            return " ".join(args)
-        else:
-            return ""
+        if self._args is None:
+            self._args = " ".join(self.argv)
+        return self._args
+
+    def _env_bytes(self) -> bytes:
+        if self._envb is None:
+            self._envb = self._decode_field(b"env")
+        return self._envb
 
     @property
     def env(self) -> dict:
-        pairs = self._parse_eargs_field(b"env=")
-        res = dict()
-        for p in pairs:
-            i = p.find("=")
-            res[p[:i]] = p[i+1:]
-        return res
+        if self._env is None:
+            res = dict()
+            envb = self._env_bytes()
+            if envb:
+                for pair in envb.split(b'\0'):
+                    pair = pair.decode(errors='replace')
+                    i = pair.find("=")
+                    res[pair[:i]] = pair[i+1:]
+            self._env = res
+        return self._env
+
+    def getenv(self, key: str) -> str:
+        """
+        looks up a single environment variable without building `env`.
+        """
+        if self._env is not None:
+            return self._env.get(key, None)
+        envb = self._env_bytes()
+        needle = key.encode() + b'='
+        if envb.startswith(needle):
+            start = len(needle)
+        else:
+            start = envb.find(b'\0' + needle)
+            if start < 0:
+                return None
+            start += len(needle) + 1
+        end = envb.find(b'\0', start)
+        if end < 0:
+            end = len(envb)
+        return envb[start:end].decode(errors='replace')
+
+    @property
+    def ts(self) -> int:
+        """
+        time of the event in ns since the epoch or None; recorded as the
+        last event argument, `ts=%evt.rawtime`, by the capture profiles.
+        """
+        eargs = self.eargs
+        i = eargs.rfind(b" ts=") if eargs else -1
+        if i < 0:
+            return None
+        try:
+            return int(eargs[i + 4:])
+        except ValueError:
+            return None
+
+    @property
+    def container(self) -> str:
+        """
+        `id/name` of the container of the process or None; recorded before
+        the time, `ct=%container.id/%container.name`, when tracing several
+        containers. processes outside containers are in `host/host`.
+        """
+        eargs = self.eargs
+        i = eargs.rfind(b" ct=") if eargs else -1
+        if i < 0:
+            return None
+        j = eargs.find(b' ', i + 4)
+        return eargs[i + 4:j if j >= 0 else len(eargs)].decode(errors='replace')
+
+    @property
+    def cwd(self) -> str:
+        """
+        working directory of the process; `cwd` isn't set by all
+        capture profiles and sysdig versions, fall back to $PWD.
+        """
+        cwd = self.field(b"cwd")
+        if cwd:
+            return cwd.decode(errors='replace')
+        return self.getenv("PWD")
 
     @staticmethod
     def parse(line: bytes) -> object:
-        tokens = line.split(CCEvent.separator)  # type: List[Optional[bytes]]
-        if len(tokens) == 7:
+        if line.endswith(CCEvent.terminator):
+            line = line[:-len(CCEvent.terminator)]
+        # eargs is the last field; don't split it
+        tokens = line.split(CCEvent.separator, 6)  # type: List[Optional[bytes]]
+        if len(tokens) == 6:
             tokens.append(None)
         return CCEvent(tid=_parse_pid(tokens[0]),
                        _type=tokens[1],
@@ -122,3 +271,106 @@ class CCEvent(object):
                        pid=_parse_pid(tokens[4]),
                        ppid=_parse_pid(tokens[5]),
                        eargs=tokens[6])
+
+
+def read_records(fd: int, chunk_size: int = 1 << 16, tee=None):
+    """
+    yields the records, stripped of their terminator, that sysdig writes to
+    the file descriptor fd. reads large chunks and splits them on the record
+    terminator; partial records are carried over to the next chunk and a
+    truncated record at EOF is dropped. if tee is given, everything read is
+    also written to it unmodified.
+    """
+    eol = CCEvent.terminator
+    pending = b''
+    while True:
+        chunk = os.read(fd, chunk_size)
+        if not chunk:
+            return
+        if tee:
+            tee.write(chunk)
+        if pending:
+            chunk = pending + chunk
+        end = chunk.rfind(eol)
+        if end < 0:
+            pending = chunk
+            continue
+        pending = chunk[end + len(eol):]
+        yield from chunk[:end].split(eol)
+
+
+class TestCCEvent(unittest.TestCase):
+
+    @staticmethod
+    def _b64(*tokens) -> bytes:
+        return binascii.b2a_base64(b'\0'.join(tokens), newline=False)
+
+    def _execve(self) -> CCEvent:
+        eargs = b"res=0 exe=/opt/my tools/cc args=" + self._b64(b"cc", b"-c", b"a.c") + \
+            b" tid=7 pid=7 ptid=1 cwd= env=" + self._b64(b"HOME=/root", b"PWD=/src", b"OLDPWD=/")
+        return CCEvent.parse(b"7#execve#/opt/my tools/cc#make#7#1#" + eargs)
+
+    def test_fields(self):
+        evt = self._execve()
+        self.assertEqual(evt.field(b"res"), b"0")
+        self.assertEqual(evt.field(b"exe"), b"/opt/my tools/cc")
+        self.assertEqual(evt.field(b"cwd"), b"")
+        self.assertIsNone(evt.field(b"filename"))
+        self.assertIsNone(evt.ts)  # recorded without timestamps
+        evt = CCEvent.parse(b"7#procexit#/usr/bin/cc#make#7#1#status=0 ts=42")
+        self.assertEqual(evt.ts, 42)
+        self.assertIsNone(evt.container)
+        evt = CCEvent.parse(b"7#execve#/usr/bin/cc#make#7#1#res=0 exe=/usr/bin/cc "
+                            b"cwd=/src/a ct=ab12cd34ef56/ci1 ts=42")
+        self.assertEqual((evt.container, evt.ts), ("ab12cd34ef56/ci1", 42))
+        self.assertEqual(evt.cwd, "/src/a")
+
+    def test_resolved_exepath(self):
+        self.assertEqual(self._execve().resolved_exepath, "/opt/my tools/cc")
+        evt = CCEvent.parse(b"7#execve#<NA>#make#7#1#res=0 exe=/usr/bin/cc")
+        self.assertEqual(evt.resolved_exepath, "/usr/bin/cc")
+        evt = CCEvent.parse(b"7#execve#<NA>#make#7#1#filename=/usr/bin/cc")
+        self.assertEqual(evt.resolved_exepath, "/usr/bin/cc")
+        evt = CCEvent.parse(b"7#execve#<NA>#make#7#1#res=0")
+        self.assertEqual(evt.resolved_exepath, SYSDIG_NA)
+
+    def test_args_and_env(self):
+        evt = self._execve()
+        self.assertEqual(evt.argv, ["cc", "-c", "a.c"])
+        self.assertEqual(evt.args, "cc -c a.c")
+        self.assertEqual(evt.getenv("PWD"), "/src")
+        self.assertEqual(evt.getenv("HOME"), "/root")
+        self.assertIsNone(evt.getenv("OLD"))
+        self.assertEqual(evt.env, {"HOME": "/root", "PWD": "/src", "OLDPWD": "/"})
+        self.assertEqual(evt.cwd, "/src")
+
+    def test_no_payload(self):
+        evt = CCEvent.parse(b"7#procexit#/bin/sh#make#7#1#status=0 ret=0 sig=0 core=0")
+        self.assertEqual(evt.args, "")
+        self.assertEqual(evt.env, {})
+        self.assertIsNone(evt.getenv("PWD"))
+
+
+class TestReadRecords(unittest.TestCase):
+
+    def _read(self, data: bytes, chunk_size: int) -> list:
+        rfd, wfd = os.pipe()
+        try:
+            os.write(wfd, data)
+            os.close(wfd)
+            return list(read_records(rfd, chunk_size))
+        finally:
+            os.close(rfd)
+
+    def test_records_split_across_chunks(self):
+        data = b"1#clone#a##\n2#execve#b\nc##\n3#procexit#d##\n"
+        expected = [b"1#clone#a", b"2#execve#b\nc", b"3#procexit#d"]
+        for chunk_size in [1, 2, 3, 7, 64]:
+            self.assertEqual(self._read(data, chunk_size), expected)
+
+    def test_truncated_record_is_dropped(self):
+        self.assertEqual(self._read(b"1#clone#a##\n2#exe", 4), [b"1#clone#a"])
+
+
+if __name__ == '__main__':
+    unittest.main()
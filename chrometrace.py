@@ -0,0 +1,145 @@
+"""
+Export of the programs run during a build to the Chrome trace event format,
+for viewing in chrome://tracing or https://ui.perfetto.dev.
+
+each program is a complete ('X') event that spans its execve to its exit or
+next execve. events are written as soon as the program ends, so memory use
+depends on the number of programs running at a time, not on the size of
+the build. the JSON array is closed on `close`; both viewers also load a
+file that was cut short, e.g. because cctrace was killed.
+"""
+import os
+import json
+import unittest
+
+from ccevent import CCEvent
+from runtracker import Run, RunTracker
+from tools import ToolType
+
+MAX_CMD = 4096  # longer command lines are cut in the event arguments
+
+
+class LaneRun(Run):
+    """
+    a program run, shown as a slice in lane `lane`.
+    """
+    __slots__ = ('cmd', 'lane')
+
+
+class ChromeTrace(RunTracker):
+    """
+    writes a trace event file to `path` from the clone, execve and procexit
+    events of the build.
+
+    programs are laid out in lanes (shown as threads) so that a program is
+    drawn below the program that started it, as long as that program is
+    not running anything else at the time; otherwise the program goes to
+    the first free lane. a process that forks without calling execve is
+    part of the program it runs.
+    """
+    run_type = LaneRun
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.out = open(path, 'w')
+        self.out.write("[\n")
+        self.lanes = []  # stacks of the runs in each lane
+        self.written = 0
+
+    def _us(self, ts: int) -> float:
+        return round((ts - self.first) / 1e3, 3)
+
+    def _write(self, event: dict) -> None:
+        if self.written:
+            self.out.write(",\n")
+        self.out.write(json.dumps(event, separators=(',', ':')))
+        self.written += 1
+
+    def _lane(self, parent: LaneRun) -> int:
+        if parent is not None and self.lanes[parent.lane][-1] is parent:
+            return parent.lane
+        for (lane, stack) in enumerate(self.lanes):
+            if not stack:
+                return lane
+        self.lanes.append([])
+        return len(self.lanes) - 1
+
+    def _start(self, run: LaneRun, evt: CCEvent, parent: LaneRun, previous: LaneRun) -> None:
+        run.cmd = evt.args[:MAX_CMD]
+        run.lane = self._lane(parent)
+        self.lanes[run.lane].append(run)
+
+    def _finish(self, run: LaneRun, ts: int) -> None:
+        stack = self.lanes[run.lane]
+        if stack and stack[-1] is run:
+            stack.pop()
+        else:
+            stack.remove(run)  # outlived by a program it started
+        self._write({"name": os.path.basename(run.exepath), "cat": run.tt.name, "ph": "X",
+                     "ts": self._us(run.started),
+                     "dur": round(max(0, ts - run.started) / 1e3, 3), "pid": 1, "tid": run.lane,
+                     "args": {"pid": run.pid, "ppid": run.ppid, "cmd": run.cmd}})
+
+    def close(self) -> None:
+        """
+        ends the programs that are still running at the time of the last
+        event, names the lanes and closes the file.
+        """
+        self.finish_all()
+        self._write({"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "build"}})
+        for lane in range(len(self.lanes)):
+            self._write({"name": "thread_name", "ph": "M", "pid": 1, "tid": lane,
+                         "args": {"name": "lane {}".format(lane)}})
+        self.out.write("\n]\n")
+        self.out.close()
+
+
+class TestChromeTrace(unittest.TestCase):
+
+    def test_trace(self):
+        import tempfile
+        s = 10 ** 9
+        lines = [
+            "10#execve#/usr/bin/make#bash#10#1#res=0 exe=make ts={}".format(1 * s),
+            "11#clone#/usr/bin/make#make#11#10#res=0 exe=make ts={}".format(2 * s),
+            "11#execve#/usr/bin/gcc#make#11#10#res=0 exe=gcc ts={}".format(2 * s),
+            "12#clone#/usr/bin/make#make#12#10#res=0 exe=make ts={}".format(2 * s),
+            "12#execve#/usr/bin/gcc#make#12#10#res=0 exe=gcc ts={}".format(2 * s),
+            "13#clone#/usr/bin/gcc#gcc#13#11#res=0 exe=gcc ts={}".format(3 * s),
+            "13#execve#/usr/lib/gcc/x86_64-linux-gnu/8/cc1#gcc#13#11#res=0 exe=cc1 ts={}".format(3 * s),
+            "13#procexit#x#x#13#0#status=0 ts={}".format(5 * s),
+            "11#procexit#x#x#11#0#status=0 ts={}".format(6 * s),
+            "12#procexit#x#x#12#0#status=0 ts={}".format(7 * s),
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "build.json")
+            trace = ChromeTrace(path)
+            for line in lines:
+                evt = CCEvent.parse(line.encode())
+                getattr(trace, "handle_" + evt.type.decode())(evt)
+            trace.out.flush()
+            with open(path) as f:
+                partial = f.read()
+            trace.close()
+            with open(path) as f:
+                events = json.load(f)
+
+        # streamed: the first programs to end were written before close
+        self.assertTrue(partial.startswith('[\n{"name":"cc1"'))
+        slices = [(e["name"], e["ts"], e["dur"], e["tid"]) for e in events if e["ph"] == "X"]
+        self.assertEqual(slices, [
+            ("cc1", 2e6, 2e6, 0),
+            ("gcc", 1e6, 4e6, 0),  # nested below make
+            ("gcc", 1e6, 5e6, 1),  # ran in parallel to the first gcc
+            ("make", 0.0, 6e6, 0),  # still running, ends with the last event
+        ])
+        self.assertEqual(events[0]["args"]["pid"], 13)
+        self.assertEqual(events[0]["cat"], ToolType.from_path(
+            "/usr/lib/gcc/x86_64-linux-gnu/8/cc1").name)
+        names = [e["args"]["name"] for e in events if e["ph"] == "M"]
+        self.assertEqual(names, ["build", "lane 0", "lane 1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
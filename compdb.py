@@ -0,0 +1,179 @@
+"""
+Compilation database export. Compiler invocations are appended to a JSONL
+file as they are traced; `finalize` turns that file into the
+compile_commands.json read by clang tooling, like `bear` would write.
+"""
+import os
+import sys
+import json
+import unittest
+
+from tools import ToolType
+
+SOURCE_EXTS = ('.c', '.i', '.cc', '.cp', '.cpp', '.cxx', '.c++', '.C', '.ii',
+               '.m', '.mm', '.s', '.S', '.sx', '.cu')
+# options whose value is the next argument
+OPTS_WITH_VALUE = ('-o', '-I', '-D', '-U', '-L', '-x', '-include', '-imacros',
+                   '-isystem', '-iquote', '-idirafter', '-isysroot', '-MF', '-MT',
+                   '-MQ', '-Xlinker', '-Xassembler', '-Xpreprocessor', '-Xclang',
+                   '-arch', '-target', '-aux-info')
+
+
+def compile_entries(arguments: list, directory: str) -> list:
+    """
+    compilation database entries, one per source file, for a compiler
+    invoked with `arguments` (including argv[0]) in `directory`.
+
+    >>> compile_entries(["cc", "-c", "-Iinc", "-o", "a.o", "a.c"], "/src")
+    [{'directory': '/src', 'arguments': ['cc', '-c', '-Iinc', '-o', 'a.o', 'a.c'], 'file': 'a.c', 'output': 'a.o'}]
+    >>> [e['output'] for e in compile_entries(["cc", "-c", "a.c", "b/b.c"], "/src")]
+    ['a.o', 'b.o']
+    >>> compile_entries(["cc", "-E", "a.c"], "/src")
+    []
+    >>> compile_entries(["clang", "-cc1", "-emit-obj", "a.c"], "/src")
+    []
+    """
+    # skip preprocessing only and the frontend invocations of clang
+    if '-E' in arguments or '-cc1' in arguments or '-cc1as' in arguments:
+        return []
+    compile_only = '-c' in arguments
+    output = None
+    files = []
+    args = iter(arguments[1:])
+    for arg in args:
+        if arg in OPTS_WITH_VALUE:
+            value = next(args, None)
+            if arg == '-o':
+                output = value
+        elif arg.startswith('-o') and len(arg) > 2:
+            output = arg[2:]
+        elif not arg.startswith('-') and os.path.splitext(arg)[1] in SOURCE_EXTS:
+            files.append(arg)
+
+    entries = []
+    for f in files:
+        entry = {'directory': directory, 'arguments': arguments, 'file': f}
+        if output and len(files) == 1:
+            entry['output'] = output
+        elif compile_only:
+            entry['output'] = os.path.splitext(os.path.basename(f))[0] + ".o"
+        entries.append(entry)
+    return entries
+
+
+def evt_arguments(evt) -> list:
+    """
+    the command line of an execve event. depending on the event source
+    the captured arguments may or may not start with argv[0].
+    """
+    exe = evt.field(b"exe")
+    exe = exe.decode(errors='replace') if exe else evt.exepath
+    argv = evt.argv
+    if argv and os.path.basename(argv[0]) == os.path.basename(exe):
+        return argv
+    return [exe] + argv
+
+
+class CompDB(object):
+    """
+    appends the compiler invocations seen while tracing to a JSONL file,
+    one compilation database entry per line, `batch` entries at a time.
+    the file is only ever appended to, so it accumulates the entries of
+    successive (e.g. incremental) builds.
+    """
+
+    def __init__(self, path: str, batch: int = 256):
+        self.path = path
+        self.batch = batch
+        self.pending = []  # List[str]
+        self.entries = 0
+        self.file = open(path, 'a', buffering=1 << 16)
+
+    def add(self, evt) -> None:
+        exepath = evt.resolved_exepath
+        if not ToolType.from_path(exepath).is_compiler():
+            return
+        for entry in compile_entries(evt_arguments(evt), evt.cwd or ""):
+            self.pending.append(json.dumps(entry) + "\n")
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.pending:
+            self.file.write("".join(self.pending))
+            self.entries += len(self.pending)
+            self.pending = []
+        self.file.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self.file.close()
+
+
+def finalize(jsonl_path: str, json_path: str) -> int:
+    """
+    writes the entries in `jsonl_path` to the compilation database at
+    `json_path`. when a file was compiled more than once in the same
+    directory to the same output, the last invocation wins. returns the
+    number of entries written.
+    """
+    entries = dict()
+    with open(jsonl_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # truncated by a crash
+            key = (entry['directory'], entry['file'], entry.get('output'))
+            entries.pop(key, None)  # keep the order of the last invocations
+            entries[key] = entry
+    tmp = "{}.{}".format(json_path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(list(entries.values()), f, indent=2)
+    os.replace(tmp, json_path)
+    return len(entries)
+
+
+class TestCompDB(unittest.TestCase):
+
+    def test_export(self):
+        import tempfile
+        from ccevent import CCEvent
+
+        def execve(pid, exe, args, cwd):
+            line = "{0}#execve#{1}#make#{0}#1#res=0 exe={1} args={2} cwd={3}".format(
+                pid, exe, args, cwd)
+            return CCEvent.parse(line.encode())
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            jsonl = os.path.join(tmpdir, "compile_commands.jsonl")
+            db = CompDB(jsonl, batch=2)
+            db.add(execve(10, "/usr/bin/cc", "Y2MALWMAYS5j", "/src"))  # cc -c a.c
+            db.add(execve(11, "/usr/bin/ld", "bGQAYS5v", "/src"))  # ld a.o
+            self.assertEqual(db.entries, 0)  # still buffered
+            db.add(execve(12, "/usr/bin/cc", "Y2MALWMAYS5j", "/src"))
+            self.assertEqual(db.entries, 2)
+            db.add(execve(13, "/usr/bin/cc", "Y2MALWMAYi5j", "/src"))  # cc -c b.c
+            # sysdig may not know the exepath; the exe field has it
+            db.add(CCEvent.parse(b"14#execve#<NA>#make#14#1#res=0 exe=/usr/bin/cc "
+                                 b"args=Y2MALWMAYy5j cwd=/src"))  # cc -c c.c
+            db.close()
+
+            out = os.path.join(tmpdir, "compile_commands.json")
+            self.assertEqual(finalize(jsonl, out), 3)
+            with open(out) as f:
+                entries = json.load(f)
+            self.assertEqual([e['file'] for e in entries], ['a.c', 'b.c', 'c.c'])
+            self.assertEqual(entries[0], {'directory': '/src',
+                                          'arguments': ['cc', '-c', 'a.c'],
+                                          'file': 'a.c', 'output': 'a.o'})
+
+
+def load_tests(loader, tests, ignore):
+    import doctest
+    tests.addTests(doctest.DocTestSuite(sys.modules[__name__]))
+    return tests
+
+
+if __name__ == '__main__':
+    unittest.main()
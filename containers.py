@@ -0,0 +1,361 @@
+"""
+Tracing several containers in one capture session. events are routed by
+the container recorded with each of them (see CCEvent.container) to a
+process tree per container, log records are tagged with the container and
+copied to a log file per container, and the events of different containers
+can be processed by a pool of worker processes.
+"""
+import io
+import os
+import sys
+import time
+import queue
+import logging
+import threading
+import unittest
+import multiprocessing
+from collections import OrderedDict
+
+from ccevent import CCEvent
+
+HOST = "host/host"  # processes outside of containers
+UNTAGGED = "-"  # log records not about an event of a container
+
+current = UNTAGGED  # name of the container of the event being processed
+
+
+def container_name(container: str) -> str:
+    return container.partition("/")[2] or container
+
+
+def container_of(record: bytes) -> bytes:
+    """
+    the id of the container of a record, without parsing the record.
+
+    >>> container_of(b"7#procexit#x#x#7#1#status=0 ct=ab12cd34ef56/ci1 ts=42")
+    b'ab12cd34ef56'
+    >>> container_of(b"7#procexit#x#x#7#1#status=0 ts=42")
+    b'host'
+    """
+    i = record.rfind(b" ct=")
+    if i < 0:
+        return b"host"
+    j = record.find(b"/", i)
+    return record[i + 4:j] if j >= 0 else b"host"
+
+
+class ContainerTrees(object):
+    """
+    a process tree per container, used in place of a ProcTree. `make_tree`
+    creates the tree of a container when its first event is seen.
+    """
+
+    def __init__(self, make_tree):
+        self.make_tree = make_tree
+        self.trees = OrderedDict()  # id/name -> tree
+
+    def _tree(self, evt: CCEvent):
+        global current
+        container = evt.container or HOST
+        tree = self.trees.get(container, None)
+        if tree is None:
+            tree = self.trees[container] = self.make_tree()
+        current = container_name(container)
+        return tree
+
+    def handle_clone(self, evt: CCEvent) -> None:
+        self._tree(evt).handle_clone(evt)
+
+    def handle_execve(self, evt: CCEvent) -> None:
+        self._tree(evt).handle_execve(evt)
+
+    def handle_procexit(self, evt: CCEvent) -> None:
+        self._tree(evt).handle_procexit(evt)
+
+    def format_single_branch(self, evt: CCEvent, fancy_output=True) -> str:
+        return self._tree(evt).format_single_branch(evt, fancy_output)
+
+    @property
+    def node_count(self) -> int:
+        return sum(t.node_count for t in list(self.trees.values()))
+
+    @property
+    def pruned(self) -> int:
+        return sum(t.pruned for t in self.trees.values())
+
+    @property
+    def evicted(self) -> int:
+        return sum(t.evicted for t in self.trees.values())
+
+    def exepaths(self) -> set:
+        return set().union(*(t.exepaths() for t in self.trees.values()))
+
+    def sections(self) -> list:
+        """
+        (container name, tree) by name.
+        """
+        return sorted(((container_name(c), t) for (c, t) in list(self.trees.items())),
+                      key=lambda s: s[0])
+
+    def write_tree(self, p, out, fancy_output=True, max_depth=None, max_width=None) -> int:
+        count = 0
+        for (name, tree) in self.sections():
+            out.write("container {}:\n".format(name))
+            count += 1 + tree.write_tree(p, out, fancy_output, max_depth, max_width)
+        return count
+
+    def print_tree(self, p) -> None:
+        self.write_tree(p, sys.stdout)
+
+    def write_critical_path(self, out, limit: int = 20) -> None:
+        for (name, tree) in self.sections():
+            out.write("container {}: ".format(name))
+            tree.write_critical_path(out, limit)
+
+    def reports(self, p, critical_path: bool = False) -> list:
+        """
+        (container name, report) with the process tree and, optionally,
+        the critical path of each container.
+        """
+        reports = []
+        for (name, tree) in self.sections():
+            out = io.StringIO()
+            tree.write_tree(p, out)
+            if critical_path:
+                out.write("\n")
+                tree.write_critical_path(out)
+            reports.append((name, out.getvalue()))
+        return reports
+
+
+def tag_log_records() -> None:
+    """
+    sets the `container` attribute of the log records created on the main
+    thread to the container of the event being processed, and to UNTAGGED
+    for the records of other threads.
+    """
+    factory = logging.getLogRecordFactory()
+    main = threading.main_thread()
+
+    def make_record(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        record.container = current if threading.current_thread() is main else UNTAGGED
+        return record
+    logging.setLogRecordFactory(make_record)
+
+
+class ContainerLogHandler(logging.Handler):
+    """
+    copies the log records of each container to a log file named after
+    `logfile`, e.g. cctrace.ci1.log for container ci1 if it is cctrace.log.
+    """
+
+    def __init__(self, logfile: str):
+        super(ContainerLogHandler, self).__init__()
+        (self.stem, self.ext) = os.path.splitext(logfile)
+        self.files = dict()  # container name -> FileHandler
+
+    def path(self, name: str) -> str:
+        return "{}.{}{}".format(self.stem, name, self.ext)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        name = getattr(record, 'container', UNTAGGED)
+        if name == UNTAGGED:
+            return
+        handler = self.files.get(name, None)
+        if handler is None:
+            handler = self.files[name] = logging.FileHandler(self.path(name), mode='w')
+            handler.setFormatter(self.formatter)
+        handler.emit(record)
+
+    def close(self) -> None:
+        for handler in self.files.values():
+            handler.close()
+        super(ContainerLogHandler, self).close()
+
+
+class WorkerPool(object):
+    """
+    processes the records of each container in one of `n` worker processes.
+    containers are assigned to workers round robin when their first event
+    is seen. records are sent in batches of up to `batch` records, or
+    `latency` seconds after the last batch when polled.
+
+    `work(records, reports)` runs in each worker. it processes the lists
+    of records it gets from the queue `records` until it gets None, then
+    puts a list of (container name, report) in the queue `reports`. the
+    workers are forked; create the pool before starting any threads.
+    """
+
+    def __init__(self, n: int, work, batch: int = 256, latency: float = 0.1):
+        ctx = multiprocessing.get_context('fork')
+        self.batch = batch
+        self.latency = latency
+        self.queues = [ctx.Queue(64) for _ in range(n)]
+        self.reports = ctx.Queue()
+        self.workers = [ctx.Process(target=work, args=(q, self.reports),
+                                    name="cctrace-worker-{}".format(i))
+                        for (i, q) in enumerate(self.queues)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+        self.pending = [[] for _ in range(n)]
+        self.shards = dict()  # container id -> worker index
+        self._due = time.monotonic() + latency
+
+    def put(self, record: bytes) -> None:
+        container = container_of(record)
+        i = self.shards.get(container, None)
+        if i is None:
+            i = self.shards[container] = len(self.shards) % len(self.workers)
+        pending = self.pending[i]
+        pending.append(record)
+        if len(pending) >= self.batch:
+            self._send(i)
+
+    def _send(self, i: int) -> None:
+        (batch, self.pending[i]) = (self.pending[i], [])
+        self._put(i, batch)
+
+    def _put(self, i: int, item) -> None:
+        while True:
+            try:
+                self.queues[i].put(item, timeout=0.5)
+                return
+            except queue.Full:
+                if not self.workers[i].is_alive():
+                    return  # see `failed`
+
+    def poll(self) -> int:
+        """
+        sends the pending records if they waited long enough. returns the
+        exit code of a worker that exited, e.g. on a policy violation.
+        """
+        now = time.monotonic()
+        if now < self._due:
+            return None
+        self._due = now + self.latency
+        for i in range(len(self.workers)):
+            if self.pending[i]:
+                self._send(i)
+        return self.failed()
+
+    def failed(self) -> int:
+        for worker in self.workers:
+            if worker.exitcode:
+                return worker.exitcode
+        return None
+
+    def close(self) -> list:
+        """
+        sends the pending records, waits for the workers to process them
+        and returns their reports by container name.
+        """
+        for i in range(len(self.workers)):
+            if self.pending[i]:
+                self._send(i)
+            self._put(i, None)
+        reports = []
+        left = len(self.workers)
+        while left:
+            try:
+                reports.extend(self.reports.get(timeout=0.5))
+                left -= 1
+            except queue.Empty:
+                if not any(w.is_alive() for w in self.workers) and self.reports.empty():
+                    break  # some exited without reporting
+        for worker in self.workers:
+            worker.join()
+        return sorted(reports)
+
+
+def _work(records, reports):
+    """
+    counts the records of each container, for the tests.
+    """
+    counts = dict()
+    while True:
+        batch = records.get()
+        if batch is None:
+            break
+        for record in batch:
+            evt = CCEvent.parse(record)
+            name = container_name(evt.container or HOST)
+            counts[name] = counts.get(name, 0) + 1
+    reports.put(sorted(counts.items()))
+
+
+class TestContainers(unittest.TestCase):
+
+    @staticmethod
+    def _events() -> list:
+        lines = []
+        for (cid, name) in (("aaaaaaaaaaaa", "ci1"), ("bbbbbbbbbbbb", "ci2")):
+            pid = 100 if name == "ci1" else 200
+            lines += [
+                "{0}#execve#/usr/bin/make#bash#{0}#1#res=0 exe=make ct={1}/{2} ts=1",
+                "{3}#clone#/usr/bin/make#make#{3}#{0}#res=0 exe=make ct={1}/{2} ts=2",
+                "{3}#execve#/usr/bin/gcc#make#{3}#{0}#res=0 exe=gcc ct={1}/{2} ts=3",
+            ]
+            lines[-3:] = [l.format(pid, cid, name, pid + 1) for l in lines[-3:]]
+        return [l.encode() for l in lines]
+
+    def test_trees(self):
+        from proctree import ProcTree
+        from policy import Policy
+        trees = ContainerTrees(ProcTree)
+        for line in self._events():
+            evt = CCEvent.parse(line)
+            getattr(trees, "handle_" + evt.type.decode())(evt)
+            self.assertEqual(current, container_name(evt.container))
+        self.assertEqual(trees.node_count, 6)
+        self.assertEqual([name for (name, _) in trees.sections()], ["ci1", "ci2"])
+        self.assertIn("/usr/bin/gcc (201)", trees.format_single_branch(evt, fancy_output=False))
+        self.assertEqual(trees.exepaths(), {"[unknown executable]", "/usr/bin/make", "/usr/bin/gcc"})
+        reports = trees.reports(Policy())
+        self.assertIn("/usr/bin/gcc (101)", reports[0][1])
+        self.assertNotIn("/usr/bin/gcc (201)", reports[0][1])
+
+    def test_logs(self):
+        import tempfile
+        global current
+        root = logging.getLogger()
+        level = root.level
+        factory = logging.getLogRecordFactory()
+        with tempfile.TemporaryDirectory() as tmp:
+            handler = ContainerLogHandler(os.path.join(tmp, "cctrace.log"))
+            handler.setFormatter(logging.Formatter("%(container)s:%(message)s"))
+            root.addHandler(handler)
+            root.setLevel(logging.INFO)
+            tag_log_records()
+            try:
+                current = "ci1"
+                logging.info("violation")
+                current = UNTAGGED
+                logging.info("not about a container")
+            finally:
+                root.removeHandler(handler)
+                handler.close()
+                logging.setLogRecordFactory(factory)
+                root.setLevel(level)
+            self.assertEqual(sorted(os.listdir(tmp)), ["cctrace.ci1.log"])
+            with open(os.path.join(tmp, "cctrace.ci1.log")) as f:
+                self.assertEqual(f.read(), "ci1:violation\n")
+
+    def test_pool(self):
+        pool = WorkerPool(2, _work, batch=2)
+        for line in self._events():
+            pool.put(line)
+        self.assertEqual(pool.shards, {b"aaaaaaaaaaaa": 0, b"bbbbbbbbbbbb": 1})
+        self.assertEqual(pool.close(), [("ci1", 3), ("ci2", 3)])
+        self.assertIsNone(pool.failed())
+
+
+def load_tests(loader, tests, ignore):
+    import doctest
+    tests.addTests(doctest.DocTestSuite(sys.modules[__name__]))
+    return tests
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,381 @@
+"""
+Sources of event records. Each source yields records in the format
+described by capture.formatspec, so that everything downstream of
+CCEvent.parse works the same no matter where the events come from.
+"""
+import os
+import abc
+import time
+import struct
+import socket
+import binascii
+import subprocess
+import unittest
+
+from ccevent import CCEvent, SYSDIG_NA, read_records
+from bintrace import BinTraceReader, is_bintrace
+
+
+class EventSource(abc.ABC):
+    """
+    base class of all event sources.
+    """
+    name = "abstract"
+    needs_root = False
+    offline = False  # True if the source reads a finite, recorded stream
+
+    def start(self) -> None:
+        """
+        starts capturing, if that takes time, ahead of `records`.
+        """
+        pass
+
+    @abc.abstractmethod
+    def records(self):
+        """
+        yields event records (bytes) until the source is exhausted or,
+        for live sources, closed.
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class SysdigSource(EventSource):
+    """
+    events captured live by `sudo sysdig`.
+    """
+    name = "sysdig"
+    needs_root = True
+
+    def __init__(self, sysdig_exe: str, filtspec: str, formatspec: str, tee=None):
+        self.cmd = ['sudo', sysdig_exe, '--print-base64',
+                    '-p', formatspec,
+                    filtspec]
+        self.tee = tee
+        self.proc = None
+
+    def start(self) -> None:
+        if self.proc:
+            return
+        # unbuffered; read_records does its own (chunked) reads
+        self.proc = subprocess.Popen(self.cmd,
+                                     stdout=subprocess.PIPE,
+                                     bufsize=0,
+                                     shell=False)
+
+    def records(self):
+        self.start()
+        return read_records(self.proc.stdout.fileno(), tee=self.tee)
+
+    def close(self) -> None:
+        """
+        stops sysdig, unless it already exited, e.g. after a SIGINT from
+        the terminal. sudo passes the signal on.
+        """
+        if not self.proc or self.proc.poll() is not None:
+            return
+        self.proc.terminate()
+        try:
+            self.proc.wait(5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+class ScapFileSource(SysdigSource):
+    """
+    events read from a capture file written by `sysdig -w`.
+    """
+    name = "scap"
+    needs_root = False
+    offline = True
+
+    def __init__(self, sysdig_exe: str, path: str, filtspec: str, formatspec: str, tee=None):
+        super(ScapFileSource, self).__init__(sysdig_exe, filtspec, formatspec, tee)
+        self.cmd = [sysdig_exe, '-r', path] + self.cmd[2:]
+
+
+class ReplaySource(EventSource):
+    """
+    events saved by `cctrace --record` or `cctrace --binlog`.
+    """
+    name = "replay"
+    offline = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+
+    def records(self):
+        if is_bintrace(self.path):
+            self.file = BinTraceReader(self.path)
+            return self.file.records()
+        self.file = open(self.path, 'rb')
+        return read_records(self.file.fileno())
+
+    def close(self) -> None:
+        if self.file:
+            self.file.close()
+
+
+def _read_proc(pid: int, entry: str) -> bytes:
+    try:
+        with open("/proc/{}/{}".format(pid, entry), 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _readlink_proc(pid: int, entry: str) -> str:
+    try:
+        return os.readlink("/proc/{}/{}".format(pid, entry))
+    except OSError:
+        return None
+
+
+class ProcConnectorSource(EventSource):
+    """
+    fork, exec and exit notifications from the Linux process events
+    connector (netlink). much cheaper than sysdig, but the notifications
+    only carry pids; the executable, arguments and environment are read
+    from /proc when the exec notification arrives and are missing
+    (<NA>) for processes that exited before that.
+
+    events are scoped to the processes of user `uid`, or to the process
+    `root` and its descendants.
+    """
+    name = "netlink"
+    needs_root = True
+
+    NETLINK_CONNECTOR = 11
+    CN_IDX_PROC = 1
+    CN_VAL_PROC = 1
+    NLMSG_DONE = 3
+    PROC_CN_MCAST_LISTEN = 1
+    PROC_EVENT_FORK = 0x00000001
+    PROC_EVENT_EXEC = 0x00000002
+    PROC_EVENT_EXIT = 0x80000000
+
+    POLL_CLOSED = 0.2  # seconds between checks whether the source was closed
+
+    nlmsghdr = struct.Struct("=IHHII")
+    cn_msg = struct.Struct("=IIIIHH")
+    proc_event = struct.Struct("=IIQ")
+    fork_event = struct.Struct("=iiii")
+    exec_event = struct.Struct("=ii")
+
+    def __init__(self, uid: int = None, profile: str = 'full-env', tee=None,
+                 root: int = None):
+        self.uid = uid
+        self.root = root
+        self.with_args = profile != 'minimal'
+        self.with_env = profile == 'full-env'
+        self.tee = tee
+        self.sock = None
+        self.closed = False
+        self.pids = set()  # processes we reported and not yet saw exit
+        if root:
+            self.pids.add(root)
+        # events are stamped with CLOCK_MONOTONIC; offset to the epoch
+        self.epoch_ns = int((time.time() - time.monotonic()) * 1e9)
+
+    def _subscribe(self) -> None:
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                  ProcConnectorSource.NETLINK_CONNECTOR)
+        self.sock.bind((os.getpid(), ProcConnectorSource.CN_IDX_PROC))
+        # closing the socket does not wake up a thread blocked reading it
+        self.sock.settimeout(ProcConnectorSource.POLL_CLOSED)
+        op = struct.pack("=I", ProcConnectorSource.PROC_CN_MCAST_LISTEN)
+        cn = ProcConnectorSource.cn_msg.pack(ProcConnectorSource.CN_IDX_PROC,
+                                             ProcConnectorSource.CN_VAL_PROC,
+                                             0, 0, len(op), 0)
+        size = ProcConnectorSource.nlmsghdr.size + len(cn) + len(op)
+        hdr = ProcConnectorSource.nlmsghdr.pack(size, ProcConnectorSource.NLMSG_DONE,
+                                                0, 0, os.getpid())
+        self.sock.send(hdr + cn + op)
+
+    def _in_scope(self, pid: int, ppid: int = None) -> bool:
+        if self.root:
+            return pid in self.pids or ppid in self.pids
+        if self.uid is None:
+            return True
+        try:
+            return os.stat("/proc/{}".format(pid)).st_uid == self.uid
+        except OSError:
+            return False
+
+    @staticmethod
+    def _ppid(pid: int) -> int:
+        stat = _read_proc(pid, "stat")
+        if not stat:
+            return 0
+        # the command name may contain spaces and parentheses
+        return int(stat[stat.rindex(b')') + 2:].split(b' ', 2)[1])
+
+    @staticmethod
+    def _comm(pid: int) -> str:
+        comm = _read_proc(pid, "comm")
+        return comm.rstrip(b'\n').decode(errors='replace') if comm else SYSDIG_NA
+
+    @staticmethod
+    def _b64(payload: bytes) -> str:
+        return binascii.b2a_base64(payload).decode().rstrip()
+
+    def _clone(self, pid: int, ppid: int) -> str:
+        # a forked child runs the executable of its parent (until it execs,
+        # which it may already have done by the time we look)
+        exe = _readlink_proc(ppid, "exe") or _readlink_proc(pid, "exe") or SYSDIG_NA
+        return "{0}#clone#{1}#{2}#{0}#{3}#res=0 exe={1}".format(
+            pid, exe, self._comm(ppid), ppid)
+
+    def _execve(self, pid: int) -> str:
+        exe = _readlink_proc(pid, "exe") or SYSDIG_NA
+        ppid = self._ppid(pid)
+        eargs = "res=0 exe=" + exe
+        if self.with_args:
+            cmdline = _read_proc(pid, "cmdline") or b''
+            eargs += " args=" + self._b64(cmdline.rstrip(b'\0'))
+        if self.with_env:
+            environ = _read_proc(pid, "environ") or b''
+            eargs += " env=" + self._b64(environ.rstrip(b'\0'))
+        # cwd goes last; it may contain spaces
+        eargs += " cwd=" + (_readlink_proc(pid, "cwd") or "")
+        return "{0}#execve#{1}#{2}#{0}#{3}#{4}".format(
+            pid, exe, self._comm(ppid), ppid, eargs)
+
+    def _record(self, data: bytes, offset: int) -> str:
+        what, _, timestamp = ProcConnectorSource.proc_event.unpack_from(data, offset)
+        record = self._event(what, data, offset + ProcConnectorSource.proc_event.size)
+        if record:
+            record += " ts={}".format(self.epoch_ns + timestamp)
+        return record
+
+    def _event(self, what: int, data: bytes, offset: int) -> str:
+        if what == ProcConnectorSource.PROC_EVENT_FORK:
+            _, ptgid, cpid, ctgid = ProcConnectorSource.fork_event.unpack_from(data, offset)
+            if cpid != ctgid or not self._in_scope(ctgid, ptgid):
+                return None  # new thread or somebody else's process
+            self.pids.add(ctgid)
+            return self._clone(ctgid, ptgid)
+        elif what == ProcConnectorSource.PROC_EVENT_EXEC:
+            _, tgid = ProcConnectorSource.exec_event.unpack_from(data, offset)
+            if not self._in_scope(tgid):
+                return None
+            self.pids.add(tgid)
+            return self._execve(tgid)
+        elif what == ProcConnectorSource.PROC_EVENT_EXIT:
+            pid, tgid = ProcConnectorSource.exec_event.unpack_from(data, offset)
+            if pid != tgid or tgid not in self.pids:
+                return None
+            self.pids.discard(tgid)
+            return "{0}#procexit#<NA>#<NA>#{0}#0#res=0".format(tgid)
+        return None
+
+    def records(self):
+        self._subscribe()
+        hdr_size = ProcConnectorSource.nlmsghdr.size + ProcConnectorSource.cn_msg.size
+        while not self.closed:
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                if self.closed:
+                    return
+                raise
+            offset = 0
+            while offset + hdr_size <= len(data):
+                msg_len = ProcConnectorSource.nlmsghdr.unpack_from(data, offset)[0]
+                record = self._record(data, offset + hdr_size)
+                if record:
+                    record = record.encode()
+                    if self.tee:
+                        self.tee.write(record + CCEvent.terminator)
+                    yield record
+                if msg_len <= 0:
+                    break
+                offset += (msg_len + 3) & ~3  # NLMSG_ALIGN
+
+    def close(self) -> None:
+        """
+        ends `records` within POLL_CLOSED seconds, also if it runs on
+        another thread.
+        """
+        self.closed = True
+        if self.sock:
+            self.sock.close()
+
+
+class TestProcConnectorSource(unittest.TestCase):
+
+    def _msg(self, what: int, *payload) -> bytes:
+        body = ProcConnectorSource.proc_event.pack(what, 0, int(time.monotonic() * 1e9))
+        body += struct.pack("={}i".format(len(payload)), *payload)
+        cn = ProcConnectorSource.cn_msg.pack(1, 1, 0, 0, len(body), 0)
+        size = ProcConnectorSource.nlmsghdr.size + len(cn) + len(body)
+        return ProcConnectorSource.nlmsghdr.pack(size, 3, 0, 0, 0) + cn + body
+
+    def test_records(self):
+        src = ProcConnectorSource(uid=os.getuid(), profile='args-only')
+        hdr_size = ProcConnectorSource.nlmsghdr.size + ProcConnectorSource.cn_msg.size
+        pid, ppid = os.getpid(), os.getppid()
+
+        # a thread being created is ignored
+        msg = self._msg(ProcConnectorSource.PROC_EVENT_FORK, ppid, ppid, pid + 1, pid)
+        self.assertIsNone(src._record(msg, hdr_size))
+
+        msg = self._msg(ProcConnectorSource.PROC_EVENT_FORK, ppid, ppid, pid, pid)
+        evt = CCEvent.parse(src._record(msg, hdr_size).encode())
+        self.assertEqual((evt.type, evt.pid, evt.ppid), (b'clone', pid, ppid))
+        self.assertEqual(evt.field(b'res'), b'0')
+
+        msg = self._msg(ProcConnectorSource.PROC_EVENT_EXEC, pid, pid)
+        evt = CCEvent.parse(src._record(msg, hdr_size).encode())
+        self.assertEqual((evt.type, evt.pid, evt.ppid), (b'execve', pid, ppid))
+        self.assertEqual(evt.exepath, os.readlink("/proc/self/exe"))
+        self.assertEqual(evt.cwd, os.getcwd())
+        self.assertLess(abs(evt.ts - time.time() * 1e9), 60e9)
+        self.assertTrue(evt.argv)
+        self.assertIsNone(evt.field(b'env'))
+
+        msg = self._msg(ProcConnectorSource.PROC_EVENT_EXIT, pid, pid, 0, 0)
+        evt = CCEvent.parse(src._record(msg, hdr_size).encode())
+        self.assertEqual((evt.type, evt.pid), (b'procexit', pid))
+        # exit of a process that was never reported is ignored
+        self.assertIsNone(src._record(msg, hdr_size))
+
+    def test_root_scope(self):
+        pid, ppid = os.getpid(), os.getppid()
+        src = ProcConnectorSource(profile='minimal', root=ppid)
+        hdr_size = ProcConnectorSource.nlmsghdr.size + ProcConnectorSource.cn_msg.size
+        fork = ProcConnectorSource.PROC_EVENT_FORK
+        # children of the root and their children are in scope, others not
+        self.assertIsNone(src._record(self._msg(fork, 1, 1, pid, pid), hdr_size))
+        self.assertIsNotNone(src._record(self._msg(fork, ppid, ppid, pid, pid), hdr_size))
+        self.assertIsNotNone(src._record(self._msg(fork, pid, pid, pid + 1, pid + 1), hdr_size))
+        msg = self._msg(ProcConnectorSource.PROC_EVENT_EXEC, ppid, ppid)
+        self.assertIsNotNone(src._record(msg, hdr_size))
+
+    @unittest.skipUnless(os.geteuid() == 0, "the process events connector requires root")
+    def test_close(self):
+        import threading
+        src = ProcConnectorSource(profile='minimal', root=os.getpid())
+        records = []
+
+        def read():
+            for record in src.records():
+                records.append(record)
+        reader = threading.Thread(target=read)
+        reader.start()
+        deadline = time.monotonic() + 5
+        while not records and time.monotonic() < deadline:
+            subprocess.call(['true'])  # until the reader is subscribed
+            time.sleep(0.01)
+        self.assertTrue(records)
+        src.close()  # while the reader waits for the next event
+        reader.join(5)
+        self.assertFalse(reader.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
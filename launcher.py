@@ -0,0 +1,248 @@
+"""
+Runs the build command for `cctrace run`. the command's process is forked
+before tracing starts so that its pid can scope the trace to the build,
+but only runs the command once cctrace is ready. until then it runs the
+readiness probes, which are in the traced scope as its children.
+"""
+import os
+import pwd
+import sys
+import time
+import signal
+import struct
+import threading
+import unittest
+
+from ready import PROBE
+
+_pid = struct.Struct("=i")
+
+
+def exit_code(status: int) -> int:
+    """
+    the exit code a shell reports for a wait status.
+
+    >>> exit_code(3 << 8), exit_code(signal.SIGINT)
+    (3, 130)
+    """
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class Launcher(object):
+    """
+    forks the process that will run `argv` as `user`, if cctrace runs as
+    root and `user` is someone else. fork before starting any threads.
+    """
+
+    def __init__(self, argv: list, user: str = None):
+        self.argv = argv
+        self.status = None  # exit code once the command exited
+        self.traced_exit = False  # True once its procexit event was seen
+        self.tracing = True  # cleared when tracing ended for other reasons
+        self._exited = threading.Event()
+        self._watched = False
+        self._lock = threading.Lock()
+        self._probing = False  # True while waiting for a probe to exit
+        creds = None
+        if user and user != 'root' and os.geteuid() == 0:
+            pw = pwd.getpwnam(user)
+            creds = (user, pw.pw_uid, pw.pw_gid)
+        (req_r, self._req) = os.pipe()
+        (self._rep, rep_w) = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                os.close(self._req)
+                os.close(self._rep)
+                self._child(req_r, rep_w, creds)
+            finally:
+                os._exit(127)
+        os.close(req_r)
+        os.close(rep_w)
+
+    def _child(self, req_r: int, rep_w: int, creds: tuple) -> None:
+        """
+        runs in the forked process. sticks to plain system calls; other
+        threads of cctrace may have held locks, e.g. of the logging
+        module, when it was forked.
+        """
+        while True:
+            cmd = os.read(req_r, 1)
+            if cmd != b'p':
+                break
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    os.execvp(PROBE[0], PROBE)
+                finally:
+                    os._exit(127)
+            os.write(rep_w, _pid.pack(pid))  # started
+            os.waitpid(pid, 0)
+            os.write(rep_w, _pid.pack(pid))  # exited
+        if cmd != b'g':
+            os._exit(1)  # cctrace exited before it was ready
+        os.close(req_r)
+        os.close(rep_w)
+        if creds:
+            (user, uid, gid) = creds
+            os.initgroups(user, gid)
+            os.setgid(gid)
+            os.setuid(uid)
+        try:
+            os.execvp(self.argv[0], self.argv)
+        except OSError as e:
+            os.write(2, "cctrace: {}: {}\n".format(self.argv[0], e.strerror).encode())
+
+    def probe(self) -> tuple:
+        """
+        starts a probe process; returns its pid and a function that waits
+        for it to exit.
+        """
+        with self._lock:
+            os.write(self._req, b'p')
+            reply = os.read(self._rep, _pid.size)
+            if len(reply) < _pid.size:
+                raise OSError("the build command's process exited")
+            self._probing = True
+        return (_pid.unpack(reply)[0], self._probe_exited)
+
+    def _probe_exited(self) -> None:
+        os.read(self._rep, _pid.size)  # empty if the process exited
+        with self._lock:
+            self._probing = False
+            if self._req < 0:
+                self._close()  # `go` left the pipe to us
+
+    def go(self) -> None:
+        """
+        lets the process run the command.
+        """
+        with self._lock:
+            try:
+                os.write(self._req, b'g')
+            except OSError:
+                pass  # it already exited
+            self._release()
+
+    def _release(self) -> None:
+        """
+        closes the pipes, but leaves the reply pipe to a pending probe wait.
+        """
+        if self._probing:
+            try:
+                os.close(self._req)
+            except OSError:
+                pass
+            self._req = -1
+        else:
+            self._close()
+
+    def _close(self) -> None:
+        for fd in (self._req, self._rep):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._req = self._rep = -1
+
+    def handle_procexit(self, evt) -> None:
+        if evt.pid == self.pid:
+            self.traced_exit = True
+
+    def watch(self, grace: float = 5.0) -> None:
+        """
+        reaps the command when it exits. if its procexit event has not
+        been traced `grace` seconds later, e.g. because it was dropped,
+        interrupts tracing with SIGINT.
+        """
+        def run():
+            self._wait()
+            deadline = time.monotonic() + grace
+            while self.tracing and not self.traced_exit and time.monotonic() < deadline:
+                time.sleep(0.05)
+            if self.tracing and not self.traced_exit:
+                os.kill(os.getpid(), signal.SIGINT)
+        self._watched = True
+        thread = threading.Thread(target=run, name="build-watcher")
+        thread.daemon = True
+        thread.start()
+
+    def _wait(self) -> None:
+        try:
+            (_, status) = os.waitpid(self.pid, 0)
+            self.status = exit_code(status)
+        except ChildProcessError:
+            pass  # reaped by another thread
+        self._exited.set()
+
+    def wait(self) -> int:
+        """
+        the exit code of the command. if it was never run, e.g. because
+        tracing failed to start, the process is told to exit.
+        """
+        with self._lock:
+            self._release()
+        if not self._watched and not self._exited.is_set():
+            self._wait()
+        self._exited.wait()
+        return self.status
+
+    def stop(self) -> None:
+        """
+        asks the command to exit, e.g. when a policy violation ends tracing.
+        """
+        if not self._exited.is_set():
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+class TestLauncher(unittest.TestCase):
+
+    def test_run(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            marker = os.path.join(tmp, "ran")
+            run = Launcher(['sh', '-c', 'touch {}; exit 3'.format(marker)])
+            (pid, wait) = run.probe()
+            wait()
+            probes = {pid}
+            (pid, wait) = run.probe()
+            probes.add(pid)
+            self.assertEqual(len(probes), 2)
+            self.assertNotIn(run.pid, probes)
+            self.assertFalse(os.path.exists(marker))  # not before go
+            run.go()  # while the second probe may still run
+            wait()
+            self.assertEqual(run.wait(), 3)
+            self.assertTrue(os.path.exists(marker))
+
+    def test_never_run(self):
+        run = Launcher(['sh', '-c', 'exit 0'])
+        self.assertEqual(run.wait(), 1)
+
+    def test_not_found(self):
+        stderr = os.dup(2)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 2)  # the forked child reports the error on fd 2
+        try:
+            run = Launcher(['/no/such/command'])
+            run.go()
+            self.assertEqual(run.wait(), 127)
+        finally:
+            os.dup2(stderr, 2)
+            os.close(stderr)
+            os.close(devnull)
+
+
+def load_tests(loader, tests, ignore):
+    import doctest
+    tests.addTests(doctest.DocTestSuite(sys.modules[__name__]))
+    return tests
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,274 @@
+"""
+Metrics about cctrace itself: event counts, per-stage processing times and
+cache hit rates. Exposed in the Prometheus text format, as a file that is
+rewritten periodically (for the node_exporter textfile collector) or by a
+local HTTP endpoint, and summarized on exit.
+"""
+import os
+import sys
+import time
+import bisect
+import logging
+import threading
+import unittest
+from collections import OrderedDict
+
+# processing stages of an event
+PARSE = 'parse'    # CCEvent.parse
+TREE = 'tree'      # process tree update
+POLICY = 'policy'  # policy check
+RENDER = 'render'  # process tree excerpt of a violation
+LOG = 'log'        # log and terminal output
+STAGES = (PARSE, TREE, POLICY, RENDER, LOG)
+
+
+class Histogram(object):
+    """
+    counts observed durations (in seconds) in fixed buckets, like a
+    Prometheus histogram.
+
+    >>> h = Histogram()
+    >>> for s in (2e-6, 3e-6, 4e-6, 2e-3): h.observe(s)
+    >>> h.count, h.quantile(0.5), h.quantile(0.99)
+    (4, 5e-06, 0.0025)
+    """
+    bounds = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+              1e-3, 2.5e-3, 5e-3, 1e-2, 0.1, 1.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float) -> float:
+        """
+        the upper bound of the bucket holding the q-quantile.
+        """
+        rank = q * self.count
+        seen = 0
+        for (i, n) in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else float('inf')
+        return 0.0
+
+
+def _fmt(value) -> str:
+    return "{:g}".format(value) if isinstance(value, float) else str(value)
+
+
+class Metrics(object):
+    """
+    counters and stage histograms updated by the trace loop. values that
+    are kept elsewhere, e.g. cache statistics, are read when the metrics
+    are exported via the callables passed to `add_gauge`.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stopped = None  # set when tracing ends
+        self.events = OrderedDict()  # event type -> count
+        self.parse_failures = 0
+        self.stages = OrderedDict((s, Histogram()) for s in STAGES)
+        self.caches = OrderedDict()  # name -> object with hits and misses
+        self.gauges = []  # (name, type, help, fn)
+
+    def count_event(self, typ: bytes) -> None:
+        self.events[typ] = self.events.get(typ, 0) + 1
+
+    def observe(self, stage: str, seconds: float) -> None:
+        self.stages[stage].observe(seconds)
+
+    def add_cache(self, name: str, cache) -> None:
+        self.caches[name] = cache
+
+    def add_gauge(self, name: str, fn, help: str, typ: str = 'gauge') -> None:
+        self.gauges.append((name, typ, help, fn))
+
+    def total_events(self) -> int:
+        return sum(list(self.events.values()))
+
+    def rate(self) -> float:
+        elapsed = (self.stopped or time.monotonic()) - self.started
+        return self.total_events() / elapsed if elapsed > 0 else 0.0
+
+    def prometheus(self) -> str:
+        """
+        the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+
+        def metric(name, typ, help, samples):
+            lines.append("# HELP cctrace_{} {}".format(name, help))
+            lines.append("# TYPE cctrace_{} {}".format(name, typ))
+            for (labels, value) in samples:
+                lines.append("cctrace_{}{} {}".format(name, labels, _fmt(value)))
+
+        metric("events_total", "counter", "Events processed, by type.",
+               [('{{type="{}"}}'.format(t.decode()), n) for (t, n) in list(self.events.items())])
+        metric("events_per_second", "gauge", "Mean event rate while tracing.",
+               [("", self.rate())])
+        metric("parse_failures_total", "counter", "Event records that could not be parsed.",
+               [("", self.parse_failures)])
+        samples = []
+        for (stage, h) in self.stages.items():
+            seen = 0
+            for (bound, n) in zip(Histogram.bounds + ('+Inf',), h.counts):
+                seen += n
+                samples.append(('_bucket{{stage="{}",le="{}"}}'.format(stage, _fmt(bound)), seen))
+            samples.append(('_sum{{stage="{}"}}'.format(stage), h.sum))
+            samples.append(('_count{{stage="{}"}}'.format(stage), h.count))
+        lines.append("# HELP cctrace_stage_seconds Time spent per event in each processing stage.")
+        lines.append("# TYPE cctrace_stage_seconds histogram")
+        lines.extend("cctrace_stage_seconds{} {}".format(l, _fmt(v)) for (l, v) in samples)
+        for kind in ('hits', 'misses'):
+            metric("cache_{}_total".format(kind), "counter", "Cache {}, by cache.".format(kind),
+                   [('{{cache="{}"}}'.format(name), getattr(c, kind))
+                    for (name, c) in self.caches.items()])
+        for (name, typ, help, fn) in self.gauges:
+            metric(name, typ, help, [("", fn())])
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> list:
+        """
+        lines summarizing the metrics for humans.
+        """
+        events = ", ".join("{} {}".format(n, t.decode()) for (t, n) in list(self.events.items()))
+        lines = ["events: {} ({:.0f}/s), {} parse failures".format(
+            events or 0, self.rate(), self.parse_failures)]
+        for (stage, h) in self.stages.items():
+            if h.count:
+                lines.append("{:<6}: {} events, {:.3f}s total, p50 <= {:g}s, p99 <= {:g}s".format(
+                    stage, h.count, h.sum, h.quantile(0.5), h.quantile(0.99)))
+        for (name, c) in self.caches.items():
+            lookups = c.hits + c.misses
+            if lookups:
+                lines.append("{} cache: {:.1%} hits of {} lookups".format(
+                    name, c.hits / lookups, lookups))
+        return lines
+
+
+class TextfileExporter(object):
+    """
+    rewrites the metrics file at `path` at most every `interval` seconds
+    when polled by the trace loop, and once more on `close`. the file is
+    replaced atomically so collectors never read a partial file.
+    """
+
+    def __init__(self, metrics: Metrics, path: str, interval: float = 15.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._due = time.monotonic()
+
+    def poll(self) -> None:
+        if time.monotonic() >= self._due:
+            self.write()
+
+    def write(self) -> None:
+        tmp = "{}.{}".format(self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                f.write(self.metrics.prometheus())
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logging.warning("could not write metrics to %s: %s", self.path, e)
+        self._due = time.monotonic() + self.interval
+
+    def close(self) -> None:
+        self.write()
+
+
+def serve(metrics: Metrics, port: int):
+    """
+    serves the metrics on http://127.0.0.1:`port`/metrics from a daemon
+    thread. only the loopback interface is bound.
+    """
+    # imported here; http.server takes longer to import than the rest of
+    # cctrace and is only needed with --metrics-port
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            logging.debug("metrics: " + fmt, *args)
+
+    server = HTTPServer(('127.0.0.1', port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class TestMetrics(unittest.TestCase):
+
+    @staticmethod
+    def _metrics() -> Metrics:
+        from tools import LRUCache
+        m = Metrics()
+        m.count_event(b'execve')
+        m.count_event(b'execve')
+        m.count_event(b'clone')
+        m.observe(PARSE, 3e-6)
+        cache = LRUCache()
+        cache.put("a", 1)
+        cache.get("a")
+        cache.get("b")
+        m.add_cache("tooltype", cache)
+        m.add_gauge("tree_processes", lambda: 7, "Processes in the tree.")
+        return m
+
+    def test_prometheus(self):
+        text = self._metrics().prometheus()
+        lines = text.splitlines()
+        self.assertIn('cctrace_events_total{type="execve"} 2', lines)
+        self.assertIn('cctrace_stage_seconds_bucket{stage="parse",le="2.5e-06"} 0', lines)
+        self.assertIn('cctrace_stage_seconds_bucket{stage="parse",le="5e-06"} 1', lines)
+        self.assertIn('cctrace_stage_seconds_bucket{stage="parse",le="+Inf"} 1', lines)
+        self.assertIn('cctrace_stage_seconds_count{stage="tree"} 0', lines)
+        self.assertIn('cctrace_cache_hits_total{cache="tooltype"} 1', lines)
+        self.assertIn('cctrace_tree_processes 7', lines)
+        self.assertIn('# TYPE cctrace_tree_processes gauge', lines)
+
+    def test_summary(self):
+        lines = self._metrics().summary()
+        self.assertTrue(lines[0].startswith("events: 2 execve, 1 clone ("))
+        self.assertTrue(lines[1].startswith("parse : 1 events"))
+        self.assertEqual(lines[-1], "tooltype cache: 50.0% hits of 2 lookups")
+
+    def test_http(self):
+        import urllib.request
+        server = serve(self._metrics(), 0)
+        try:
+            url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+            with urllib.request.urlopen(url, timeout=5) as resp:
+                body = resp.read().decode()
+            self.assertIn('cctrace_events_total{type="clone"} 1', body)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def load_tests(loader, tests, ignore):
+    import doctest
+    tests.addTests(doctest.DocTestSuite(sys.modules[__name__]))
+    return tests
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import queue
+import logging
+import threading
+import unittest
+
+
+class RecordQueue(object):
+    """
+    Decouples reading event records from processing them. A reader thread
+    drains `records` into a bounded queue so that a slow processing step
+    does not stall the sysdig pipe (at which point sysdig starts dropping
+    kernel events). Iterate over the RecordQueue to consume records.
+    """
+    _done = object()  # sentinel marking the end of the record stream
+
+    def __init__(self, records, depth: int = 4096, drop_when_full=False):
+        self._records = records
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._reader = threading.Thread(target=self._read, name="record-reader")
+        self._reader.daemon = True
+        self.depth = depth
+        self.drop_when_full = drop_when_full
+        # counters
+        self.received = 0     # records read from the stream
+        self.dropped = 0      # records discarded because the queue was full
+        self.stalls = 0       # times the reader had to wait for the consumer
+        self.max_backlog = 0  # high-water mark of queued records
+
+    @property
+    def backlog(self) -> int:
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        self._reader.start()
+
+    def stop(self) -> None:
+        """
+        ask the reader to stop after the current record.
+        """
+        self._stop.set()
+
+    def _read(self) -> None:
+        try:
+            for record in self._records:
+                self.received += 1
+                try:
+                    self._queue.put_nowait(record)
+                except queue.Full:
+                    if self.drop_when_full:
+                        self.dropped += 1
+                        continue
+                    self.stalls += 1
+                    self._queue.put(record)
+                backlog = self._queue.qsize()
+                if backlog > self.max_backlog:
+                    self.max_backlog = backlog
+                if self._stop.is_set():
+                    break
+        finally:
+            self._queue.put(RecordQueue._done)
+
+    def __iter__(self):
+        while True:
+            record = self._queue.get()
+            if record is RecordQueue._done:
+                return
+            yield record
+
+    def drain(self, timeout: float = 5.0):
+        """
+        yields the records still queued or in flight, e.g. after Ctrl-C.
+        gives up if the reader produces nothing for `timeout` seconds.
+        """
+        while True:
+            try:
+                record = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                logging.warning("gave up draining record queue after %.1fs", timeout)
+                return
+            if record is RecordQueue._done:
+                return
+            yield record
+
+    def summary(self) -> str:
+        return "{} records queued, max backlog {}/{}, {} dropped, {} stalls".format(
+            self.received, self.max_backlog, self.depth, self.dropped, self.stalls)
+
+
+class TestRecordQueue(unittest.TestCase):
+
+    def test_passes_all_records_in_order(self):
+        records = [str(i).encode() for i in range(1000)]
+        q = RecordQueue(iter(records), depth=8)
+        q.start()
+        self.assertEqual(list(q), records)
+        self.assertEqual(q.received, 1000)
+        self.assertEqual(q.dropped, 0)
+        self.assertLessEqual(q.max_backlog, 8)
+
+    def test_drop_when_full(self):
+        gate = threading.Event()
+
+        def records():
+            for i in range(10):
+                yield i
+            gate.set()
+
+        q = RecordQueue(records(), depth=4, drop_when_full=True)
+        q.start()
+        gate.wait()
+        seen = list(q.drain())
+        self.assertEqual(seen, [0, 1, 2, 3])
+        self.assertEqual(q.dropped, 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
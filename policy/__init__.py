@@ -7,10 +7,46 @@ from collections import defaultdict
 
 from itertools import chain
 
-from tools import ToolType
+from tools import ToolType, LRUCache
 from ccevent import Colors
 
 
+def _any_of(*regexes):
+    """
+    combines regexes used with `search` into one.
+    """
+    patterns = [r.pattern[2:] if r.pattern.startswith(".*") else r.pattern
+                for r in regexes]
+    return re.compile("|".join("(?:{})".format(p) for p in patterns))
+
+
+def _token_matches(token: str, expected: str) -> bool:
+    """
+    expected arguments ending in '=' only name an option, e.g.
+    -frandom-seed=, and match any value given to it.
+    """
+    return token == expected or (expected.endswith("=") and token.startswith(expected))
+
+
+def _contains_tokens(tokens: list, token_set: set, expected: list) -> bool:
+    """
+    True if `expected` occurs as a contiguous run of whole tokens.
+    """
+    if not expected:
+        return True
+    if expected[0].endswith("="):
+        pass  # matched by prefix below
+    elif len(expected) == 1:
+        return expected[0] in token_set
+    elif expected[0] not in token_set:
+        return False
+    n = len(expected)
+    for i in range(len(tokens) - n + 1):
+        if all(_token_matches(t, e) for (t, e) in zip(tokens[i:i + n], expected)):
+            return True
+    return False
+
+
 class PolicyError(object):
     def __init__(self, message, tt, expected, observed):
         self.tt = tt
@@ -30,7 +66,7 @@ class PolicyError(object):
         message = message.format(tt.name)
         return PolicyError(message, tt, expected, observed)
 
-    def print(self, observed_diag=None) -> None:
+    def print(self, observed_diag=None, file=None) -> None:
         emsg = "{}Error{}: {}.\n"
         emsg += "Expected: {}{}{}\nObserved: "
         cfmt = [Colors.LRED, Colors.NO_COLOR, self.message,
@@ -41,7 +77,7 @@ class PolicyError(object):
         else:
             emsg += self.observed
 
-        print(emsg)
+        print(emsg, file=file)
 
     def log(self, observed_diag=None) -> None:
         emsg = "{}.\nExpected: {}\nObserved:"
@@ -81,9 +117,16 @@ class Policy(object):
     linker_help_check_re = re.compile(r"(\s|^)(-?-(help|h))(\s|$)")
     linker_version_check_re = re.compile(r"(\s|^)(-?-(vers|versi|versio|q?version)|-v|-V)(\s|$)")
     linker_conftest_check_re = re.compile(r".*((-o conftest(\s|$))|/tmp/conftest-\S*\.o)")
-    
 
-    def __init__(self):
+    # one regex per tool kind matching all invocations we don't police
+    compiler_ignore_re = _any_of(preprocess_re, version_check_re,
+                                 conftest_re, printer_check_re)
+    linker_ignore_re = _any_of(linker_help_check_re, linker_version_check_re,
+                               linker_conftest_check_re)
+
+    _no_verdict = object()  # marks verdict cache misses
+
+    def __init__(self, memo_size: int = 4096):
         self.name = "default"
         self.keep_going = False
         self.ignore_prefix = None
@@ -91,6 +134,31 @@ class Policy(object):
         self._args_expect = dict()                  # type: dict[ToolType, list[str]]
         self._compile_args_expect = dict()          # type: dict[ToolType, list[str]]
         self._compile_link_args_expect = dict()     # type: dict[ToolType, list[str]]
+        self._tables = None                         # see _compile
+        self._verdicts = LRUCache(memo_size)        # (exepath, hash of args) -> PolicyError
+        self._realpaths = LRUCache(memo_size)       # exepath -> realpath
+
+    def _invalidate(self) -> None:
+        self._tables = None
+        self._verdicts.clear()
+
+    def _compile(self) -> dict:
+        """
+        turns the expectations into a decision table per tool type that maps
+        the kind of invocation to the (arg, tokens) pairs it must contain.
+        """
+        def tokenized(args):
+            return [(a, a.split()) for a in args]
+
+        tables = dict()
+        for tt in Policy.tools:
+            always = tokenized(self._args_expect.get(tt, []))
+            tables[tt] = {
+                'always': always,
+                'compile': always + tokenized(self._compile_args_expect.get(tt, [])),
+                'link': always + tokenized(self._compile_link_args_expect.get(tt, [])),
+            }
+        return tables
 
     def expect_tool_path(self, t: ToolType, path: str) -> None:
         """
@@ -100,6 +168,7 @@ class Policy(object):
         path = os.path.expanduser(path)
         path = os.path.realpath(path)
         self._path_expect[t].add(path)
+        self._invalidate()
 
     def expect_tool_args(self, t: ToolType, args: list,
                          expect_when_compiling=False,
@@ -114,6 +183,7 @@ class Policy(object):
             self._compile_link_args_expect[t] = args
         else:
             self._args_expect[t] = args
+        self._invalidate()
 
     def configure(self, config: dict) -> None:
 
@@ -180,60 +250,76 @@ class Policy(object):
 
         self.name = config.pop("name", self.name)
         self.keep_going = config.pop("keep_going", self.keep_going)
+        self._invalidate()
 
     def check(self, exepath: str, args: str = "") -> PolicyError:
+        # large builds run identical command lines over and over. keyed
+        # on a hash of the arguments so that long command lines are not
+        # kept alive by the cache.
+        key = (exepath, hash(args))
+        verdict = self._verdicts.get(key, Policy._no_verdict)
+        if verdict is Policy._no_verdict:
+            verdict = self._check(exepath, args)
+            self._verdicts.put(key, verdict)
+        return verdict
+
+    def _realpath(self, exepath: str) -> str:
+        path = self._realpaths.get(exepath, None)
+        if path is None:
+            path = os.path.realpath(exepath)
+            self._realpaths.put(exepath, path)
+        return path
+
+    def _check(self, exepath: str, args: str) -> PolicyError:
         tt = ToolType.from_path(exepath)  # type: ToolType
 
-        def check_args(exp_args) -> PolicyError:
-            for expected in exp_args:
-                if expected not in args:
-                    return PolicyError.argument_mismatch(tt,
-                                                         expected,
-                                                         args)
-            return None
-
-        expected_args = self._args_expect.get(tt, [])
-        if tt.is_compiler():
-            # look for compiler invocations that we don't care about
-            if self.preprocess_re.search(args) or \
-                    self.version_check_re.search(args) or \
-                    self.conftest_re.search(args) or \
-                    self.printer_check_re.search(args):
-                # don't police preprocessor invocations, version checks
-                # or invocations by configure scripts.
+        if self._tables is None:
+            self._tables = self._compile()
+        table = self._tables.get(tt, None)
+
+        tokens = args.split()
+        expected_args = []
+        if not table:
+            pass  # not a tool we police
+        elif tt.is_compiler():
+            # don't police preprocessor invocations, version checks
+            # or invocations by configure scripts.
+            if self.compiler_ignore_re.search(args):
                 expected_args = []
-            # look for the -c flag which must either be preceeded (followed)
-            # by a space or the start (end) of the line.
-            elif self.compile_re.search(args):
-                expected_args = list(expected_args)
-                expected_args += self._compile_args_expect.get(tt, [])
+            elif "-c" in tokens:
+                expected_args = table['compile']
             else:  # compile and link
-                expected_args = list(expected_args)
-                expected_args += self._compile_link_args_expect.get(tt, [])
-                
+                expected_args = table['link']
         elif tt.is_linker():
             # look for linker invocations we don't care about
-            if self.linker_help_check_re.search(args) or \
-               self.linker_version_check_re.search(args) or \
-               self.linker_conftest_check_re.search(args):
-                expected_args = []
+            if not self.linker_ignore_re.search(args):
+                expected_args = table['always']
+        else:
+            expected_args = table['always']
 
-        result = check_args(expected_args)
-        if result:
-            return result
+        if expected_args:
+            token_set = set(tokens)
+            for (expected, expected_tokens) in expected_args:
+                if not _contains_tokens(tokens, token_set, expected_tokens):
+                    return PolicyError.argument_mismatch(tt, expected, args)
 
-        expected_paths = self._path_expect[tt]  # type: defaultdict[set]
-        observed_path = os.path.realpath(exepath)
+        expected_paths = self._path_expect.get(tt, None)  # type: set[str]
         if expected_paths:
-            for expected_path in expected_paths:
-                if expected_path == observed_path:
-                    break
-            else:  # no break -> no match
+            observed_path = self._realpath(exepath)
+            if observed_path not in expected_paths:
                 expected_str = "\n or ".join(expected_paths)
                 return PolicyError.tool_mismatch(tt, expected_str, observed_path)
 
         return None
 
+    def checks_args(self) -> bool:
+        """
+        True if any tool is expected to be invoked with certain arguments.
+        """
+        return bool(self._args_expect or
+                    self._compile_args_expect or
+                    self._compile_link_args_expect)
+
     def is_checked(self, exepath: str) -> bool:
         tt = ToolType.from_path(exepath)  # type: ToolType
         has_path_expect = len(self._path_expect[tt])
@@ -362,6 +448,59 @@ class TestPolicy(unittest.TestCase):
         self.assertIsInstance(c, PolicyError)
         self.assertEqual(c.message, "missing argument to c_compiler")
 
+    def test_args_match_whole_tokens(self):
+        tt = ToolType.c_compiler
+        p = Policy()
+        p.expect_tool_args(tt, ["-flto", "-Xclang -fsanitize-cfi"])
+
+        c = p.check(self.gcc_path, "-flto=thin -Xclang -fsanitize-cfi a.c")
+        self.assertIsInstance(c, PolicyError)
+        self.assertEqual(c.expected, "-flto")
+
+        c = p.check(self.gcc_path, "-flto -Xclang -fsanitize-cfi a.c")
+        self.assertIsNone(c)
+
+        c = p.check(self.gcc_path, "-flto -Xclang -O2 -fsanitize-cfi a.c")
+        self.assertIsInstance(c, PolicyError)
+        self.assertEqual(c.expected, "-Xclang -fsanitize-cfi")
+
+    def test_option_prefixes(self):
+        tt = ToolType.c_compiler
+        p = Policy()
+        p.expect_tool_args(tt, ["-frandom-seed=", "-Xlinker --random-seed="])
+        self.assertIsNone(p.check(self.gcc_path, "-frandom-seed=1 -Xlinker --random-seed=2 a.c"))
+        c = p.check(self.gcc_path, "-frandom-seed -Xlinker --random-seed=2 a.c")
+        self.assertEqual(c.expected, "-frandom-seed=")
+        c = p.check(self.gcc_path, "-frandom-seed=1 --random-seed=2 a.c")
+        self.assertEqual(c.expected, "-Xlinker --random-seed=")
+
+    def test_multicompiler_policy(self):
+        import json
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "multicompiler.cctrace.json")
+        with open(path) as f:
+            config = json.load(f)
+        p = Policy()
+        p.configure(config)
+        clang = os.path.expanduser("~/selfrando-testing/local/bin/clang")
+        ld = os.path.expanduser("~/selfrando-testing/local/bin/ld.gold")
+        self.assertIsNone(p.check(clang, "clang -flto -frandom-seed=1234 -c a.c"))
+        self.assertIsNone(p.check(clang, "clang -flto -random-seed=1234 a.o -o a"))
+        self.assertIsNone(p.check(ld, "ld.gold -Wl,--plugin-opt,-random-seed=1 "
+                                      "-Wl,--random-seed=1 a.o"))
+        c = p.check(clang, "clang -flto -c a.c")
+        self.assertIsInstance(c, PolicyError)
+        self.assertEqual(c.expected, "-frandom-seed=")
+
+    def test_verdicts_follow_configuration(self):
+        tt = ToolType.c_compiler
+        p = Policy()
+        self.assertIsNone(p.check(self.gcc_path, "-c a.c"))
+        # memoized verdicts must not outlive a change of expectations
+        p.expect_tool_args(tt, ["-g"])
+        self.assertIsInstance(p.check(self.gcc_path, "-c a.c"), PolicyError)
+        self.assertIsNone(p.check(self.gcc_path, "-c -g a.c"))
+
     def test_ignored_version_flags(self):
         tt = ToolType.c_compiler
         p = Policy()
@@ -0,0 +1,210 @@
+import unittest
+from array import array
+
+from ccevent import CCEvent, SYSDIG_NA
+from proctree import CCNode, ProcTree, UNKNOWN_PROC_LABEL
+from policy import Policy
+from tools import wait_tool_vers
+
+EXECD = 1  # process called execve
+EXITED = 2  # process exited
+NO_TIME = 0  # start or end time not known
+
+
+class ProcTable(object):
+    """
+    Process tree stored as parallel arrays indexed by the order in which
+    processes were first seen: pid, index of the parent (-1 for roots),
+    id of the interned executable path, flags and start and end times (ns
+    since the epoch). Uses a small fraction
+    of the memory of a ProcTree, whose anytree nodes are only built when
+    the tree is rendered. Handles the same events as ProcTree.
+    """
+
+    def __init__(self, prune_unexeced=False):
+        self.prune_unexeced = prune_unexeced
+        self.pids = array('i')
+        self.parents = array('i')
+        self.exe_ids = array('i')
+        self.flags = bytearray()
+        self.started = array('q')
+        self.ended = array('q')
+        self.exes = []  # exe id -> path
+        self._exe_ids = dict()  # path -> exe id
+        self.index_by_pid = dict()  # holds indices of active processes
+        self.pruned = 0  # never prunes; see ProcTree
+        self.evicted = 0
+
+    @property
+    def node_count(self) -> int:
+        return len(self.pids)
+
+    def _intern(self, exepath: str) -> int:
+        exe_id = self._exe_ids.get(exepath, None)
+        if exe_id is None:
+            exe_id = len(self.exes)
+            self.exes.append(exepath)
+            self._exe_ids[exepath] = exe_id
+        return exe_id
+
+    def _new(self, exepath: str, pid: int, parent: int = -1, started: int = None) -> int:
+        idx = len(self.pids)
+        self.pids.append(pid)
+        self.parents.append(parent)
+        self.exe_ids.append(self._intern(exepath))
+        self.flags.append(0)
+        self.started.append(started or NO_TIME)
+        self.ended.append(NO_TIME)
+        self.index_by_pid[pid] = idx
+        return idx
+
+    def exepaths(self) -> set:
+        return set(self.exes[i] for i in set(self.exe_ids))
+
+    def handle_procexit(self, evt: CCEvent):
+        idx = self.index_by_pid.pop(evt.pid, None)
+        if idx is not None:
+            self.flags[idx] |= EXITED
+            self.ended[idx] = evt.ts or NO_TIME
+
+    def handle_clone(self, evt: CCEvent):
+        child_pid, parent_pid = evt.pid, evt.ppid
+        assert child_pid > 0, "Unexpected child pid: {}".format(child_pid)
+        assert parent_pid != child_pid
+
+        pidx = self.index_by_pid.get(parent_pid, None)
+        if pidx is None:
+            pidx = self._new(evt.exepath, parent_pid)
+        if child_pid not in self.index_by_pid:
+            self._new(evt.exepath, child_pid, pidx, evt.ts)
+
+    def handle_execve(self, evt: CCEvent):
+        child_pid, parent_pid = evt.pid, evt.ppid
+
+        child = evt.resolved_exepath
+        if child == SYSDIG_NA:
+            print(evt.eargs)
+            assert False
+
+        pidx = self.index_by_pid.get(parent_pid, None)
+        if pidx is None:
+            pidx = self._new(UNKNOWN_PROC_LABEL, parent_pid)
+
+        cidx = self.index_by_pid.get(child_pid, None)
+        if cidx is None:
+            cidx = self._new(child, child_pid, pidx, evt.ts)
+        else:
+            self.exe_ids[cidx] = self._intern(child)
+        self.flags[cidx] |= EXECD
+
+    def _node(self, idx: int) -> CCNode:
+        node = CCNode(self.exes[self.exe_ids[idx]], pid=self.pids[idx])
+        node.execd = bool(self.flags[idx] & EXECD)
+        node.prune_unexeced = self.prune_unexeced
+        node.exited = bool(self.flags[idx] & EXITED)
+        node.started = self.started[idx] or None
+        node.ended = self.ended[idx] or None
+        return node
+
+    def materialize(self, indices=None) -> ProcTree:
+        """
+        builds a ProcTree holding the processes at `indices` (all by default).
+        `indices` must include the parents of every process it contains.
+        """
+        pt = ProcTree(prune_unexeced=self.prune_unexeced)
+        if indices is None:
+            indices = range(len(self.pids))
+        nodes = dict()
+        children = dict()
+        for idx in sorted(indices):
+            node = self._node(idx)
+            nodes[idx] = node
+            parent = self.parents[idx]
+            if parent < 0:
+                pt.roots.add(node)
+            else:
+                children.setdefault(parent, []).append(node)
+            if self.index_by_pid.get(node.pid, None) == idx:
+                pt.nodes_by_pid[node.pid] = node
+        # attach children bottom-up, keeping siblings in the order seen
+        for idx in sorted(children, reverse=True):
+            nodes[idx].children = children[idx]
+        pt.node_count = len(nodes)
+        return pt
+
+    def format_single_branch(self, evt: CCEvent, fancy_output=True) -> str:
+        branch = []
+        idx = self.index_by_pid[evt.pid]
+        while idx >= 0:
+            branch.append(idx)
+            idx = self.parents[idx]
+        return self.materialize(branch).format_single_branch(evt, fancy_output)
+
+    def write_tree(self, p: Policy, out, fancy_output=True, max_depth=None, max_width=None) -> int:
+        return self.materialize().write_tree(p, out, fancy_output, max_depth, max_width)
+
+    def print_tree(self, p: Policy) -> None:
+        self.materialize().print_tree(p)
+
+    def critical_path(self) -> list:
+        return self.materialize().critical_path()
+
+    def write_critical_path(self, out, limit: int = 20) -> None:
+        self.materialize().write_critical_path(out, limit)
+
+
+class TestProcTable(unittest.TestCase):
+
+    def _events(self):
+        lines = [
+            "10#clone#/bin/bash#x#10#1#res=0 exe=/bin/bash",
+            "10#execve#/usr/bin/make#x#10#1#res=0 exe=/usr/bin/make",
+            "11#clone#/usr/bin/make#x#11#10#res=0 exe=/usr/bin/make ts=100",
+            "11#execve#/usr/bin/gcc#x#11#10#res=0 exe=/usr/bin/gcc args=Z2NjAC1j",
+            "12#clone#/usr/bin/make#x#12#10#res=0 exe=/usr/bin/make",
+            "12#execve#<NA>#x#12#10#res=0 exe=/usr/bin/ld",
+            "11#procexit#x#x#11#0#status=0 ts=250",
+            "30#execve#/usr/bin/as#x#30#20#res=0 exe=/usr/bin/as ts=300",
+        ]
+        return [CCEvent.parse(l.encode()) for l in lines]
+
+    @staticmethod
+    def _feed(pt, evt):
+        if evt.type == b'clone':
+            pt.handle_clone(evt)
+        elif evt.type == b'execve':
+            pt.handle_execve(evt)
+        else:
+            pt.handle_procexit(evt)
+
+    @staticmethod
+    def _shape(pt: ProcTree):
+        def shape(n):
+            return (n.name, n.pid, n.execd, n.exited, n.started, n.ended,
+                    [shape(c) for c in n.children])
+        return sorted(shape(r) for r in pt.roots)
+
+    def test_same_tree_as_proctree(self):
+        table, tree = ProcTable(), ProcTree()
+        for evt in self._events():
+            self._feed(table, evt)
+            self._feed(tree, evt)
+        self.assertEqual(table.node_count, tree.node_count)
+        self.assertEqual(table.exepaths(), tree.exepaths())
+        self.assertEqual(self._shape(table.materialize()), self._shape(tree))
+        self.assertEqual(len(table.exes), 6)  # exepaths are interned
+        self.assertEqual((table.started[2], table.ended[2]), (100, 250))
+
+    def test_format_single_branch(self):
+        table, tree = ProcTable(), ProcTree()
+        for evt in self._events():
+            self._feed(table, evt)
+            self._feed(tree, evt)
+        evt = self._events()[5]
+        wait_tool_vers(tree.exepaths())
+        self.assertEqual(table.format_single_branch(evt, fancy_output=False),
+                         tree.format_single_branch(evt, fancy_output=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
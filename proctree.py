@@ -1,11 +1,15 @@
+import io
 import os
 import re
+import sys
+import unittest
+from collections import deque
 
-from anytree import Node, RenderTree
+from anytree import Node, PreOrderIter
 from anytree.render import AsciiStyle, ContStyle
 
-from ccevent import CCEvent, get_color, Colors
-from tools import get_tool_ver
+from ccevent import CCEvent, get_color, Colors, SYSDIG_NA
+from tools import get_tool_ver, wait_tool_vers
 from policy import Policy
 
 
@@ -15,54 +19,271 @@ STY = ContStyle if LANG_IS_UTF8 else AsciiStyle
 
 
 class CCNode(Node):
+    """
+    process tree node. maintains Merkle-style hashes of the part of the
+    subtree below the node that print_tree shows (`subtree_hash`) and of
+    the path from the root down to it (`path_hash`); both are recomputed
+    lazily, and only for the nodes whose hash went stale since it was
+    last read.
+
+    a stale subtree hash implies stale subtree hashes of all ancestors and
+    a stale path hash implies stale path hashes of all descendants, so
+    invalidation stops at the first node that is already stale.
+    """
     separator = b"|"
+    prune_unexeced = False  # set to treat processes that never called execve as boring
+    exited = False  # set once we saw the process exit
+    started = None  # time the process was first seen, ns since the epoch
+    ended = None  # time the process exited, ns since the epoch
+    outlived = False  # set while eviction waits for live descendants
+    dropped = False  # set once the node was removed from the tree
+    _execd = False
+    _shown = False  # see `shown`; current unless the subtree hash is stale
+    _subtree_hash = None  # None when stale
+    _path_hash = None  # None when stale
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @name.setter
+    def name(self, value: str) -> None:
+        self._name = value
+        self._invalidate_subtree_hash()
+        self._invalidate_path_hash()
+
+    @property
+    def execd(self) -> bool:
+        """
+        set once we saw the process call execve.
+        """
+        return self._execd
+
+    @execd.setter
+    def execd(self, value: bool) -> None:
+        self._execd = value
+        self._invalidate_subtree_hash()
 
     @property
     def color(self):
         return get_color(self.name)
 
+    @property
+    def configure(self) -> bool:
+        return self.name.endswith("configure")
+
+    @property
+    def boring(self) -> bool:
+        """
+        True if the process is not worth printing unless it has interesting
+        children.
+        """
+        if self.color in [Colors.DGRAY, Colors.NO_COLOR]:
+            return True
+        return self.prune_unexeced and not self._execd
+
+    def _invalidate_subtree_hash(self) -> None:
+        n = self
+        while n is not None and n._subtree_hash is not None:
+            n._subtree_hash = None
+            n = n.parent
+
+    def _invalidate_path_hash(self) -> None:
+        stack = [self]
+        while stack:
+            n = stack.pop()
+            if n._path_hash is not None:
+                n._path_hash = None
+                stack.extend(n.children)
+
+    def _post_attach(self, parent) -> None:
+        parent._invalidate_subtree_hash()
+        self._invalidate_path_hash()
+
+    def _post_detach(self, parent) -> None:
+        parent._invalidate_subtree_hash()
+        self._invalidate_path_hash()
+
+    @property
+    def subtree_hash(self) -> int:
+        """
+        hash of the names in the shown part of the subtree rooted at this
+        node.
+        """
+        if self._subtree_hash is None:
+            # post-order walk over the stale nodes only
+            stack = [(self, False)]
+            while stack:
+                n, expanded = stack.pop()
+                if expanded:
+                    shown = [c for c in n.children if c._shown]
+                    n._shown = not n.configure and (bool(shown) or not n.boring)
+                    n._subtree_hash = hash((hash(n.name),) +
+                                           tuple(c._subtree_hash for c in shown))
+                elif n._subtree_hash is None:
+                    stack.append((n, True))
+                    stack.extend((c, False) for c in n.children
+                                 if c._subtree_hash is None)
+        return self._subtree_hash
+
+    @property
+    def path_hash(self) -> int:
+        """
+        hash of the names on the path from the root to this node.
+        """
+        if self._path_hash is None:
+            stale = []
+            n = self
+            while n is not None and n._path_hash is None:
+                stale.append(n)
+                n = n.parent
+            for n in reversed(stale):
+                if n.parent is None:
+                    n._path_hash = hash((hash(n.name),))
+                else:
+                    n._path_hash = hash((hash(n.name), n.parent._path_hash))
+        return self._path_hash
+
+    @property
+    def shown(self) -> bool:
+        """
+        False if print_tree leaves out the subtree rooted at this node.
+        configure processes are never printed, along with their children,
+        and neither are boring leafs (leafs once their boring children are
+        left out).
+        """
+        if self._subtree_hash is None:
+            self.subtree_hash
+        return self._shown
+
     def hash_subtree(self):
-        res = [hash(self.name)]
-        for child in self.children:
-            res.append(child.hash_subtree())
-        return hash(tuple(res))
+        return self.subtree_hash
 
     def hash_roots(self):
-        res = [hash(self.name)]
-        if not self.is_root:
-            res.append(self.parent.hash_roots())
-        return hash(tuple(res))
+        return self.path_hash
 
     def __hash__(self):
         return hash(self.name)
 
 
-SYSDIG_NA = '<NA>'
 UNKNOWN_PROC_LABEL = "[unknown executable]"
 UNKNOWN_PROC_COLOR = Colors.LRED
 
 
+def _processes(n: int) -> str:
+    return "process" if n == 1 else "processes"
+
+
 class ProcTree(object):
-    _eargs_re = re.compile(r".*exe=(.*)\sargs=")
 
-    def __init__(self):
+    def __init__(self, prune_unexeced=False, prune_exited=False, max_nodes=None):
         self.nodes_by_pid = dict()  # holds nodes for active processes
-        self.roots = set()  # holds root nodes; never shrinks
+        self.roots = set()  # holds root nodes; only shrinks when pruning
+        # treat leafs that never called execve as boring; set when the
+        # execve events of some programs are filtered out by sysdig.
+        self.prune_unexeced = prune_unexeced
+        # bound memory use of long tracing sessions by dropping exited
+        # processes that print_tree would prune anyway and, when there
+        # are more than max_nodes nodes, the processes that exited first.
+        self.prune_exited = prune_exited
+        self.max_nodes = max_nodes
+        self.node_count = 0
+        self.pruned = 0  # nodes dropped because they were boring
+        self.evicted = 0  # nodes dropped to stay below max_nodes
+        self._exited = deque()  # exited nodes, oldest first
+
+    def exepaths(self) -> set:
+        """
+        names of all processes in the tree.
+        """
+        return {n.name for r in self.roots for n in PreOrderIter(r)}
+
+    def _new_node(self, name: str, pid: int, parent: CCNode = None,
+                  started: int = None) -> CCNode:
+        node = CCNode(name, parent=parent, pid=pid)
+        node.started = started
+        node.prune_unexeced = self.prune_unexeced
+        self.nodes_by_pid[pid] = node
+        self.node_count += 1
+        if self.max_nodes and self.node_count > self.max_nodes:
+            self._evict()
+        return node
+
+    def _is_boring_leaf(self, n: CCNode) -> bool:
+        return n.is_leaf and n.boring
+
+    def _drop(self, n: CCNode) -> int:
+        """
+        removes the subtree rooted at n; returns its number of nodes.
+        """
+        size = 0
+        for d in PreOrderIter(n):
+            d.dropped = True
+            size += 1
+        parent = n.parent
+        n.parent = None
+        self.roots.discard(n)
+        self.node_count -= size
+        if parent is not None and parent.outlived:
+            # it exited before n; try again, ahead of later exits
+            parent.outlived = False
+            self._exited.appendleft(parent)
+        return size
+
+    def _prune(self, n: CCNode) -> None:
+        """
+        drops exited nodes that print_tree would not print, starting at the
+        node n that just exited and moving up the tree.
+        """
+        # configure processes are never printed, along with their children
+        for a in n.iter_path_reverse():
+            if a.exited and a.configure:
+                if all(d.exited for d in a.descendants):
+                    self.pruned += self._drop(a)
+                return
+        # remove boring leafs; their parents may become boring leafs
+        while n and n.exited and self._is_boring_leaf(n):
+            parent = n.parent
+            self.pruned += self._drop(n)
+            n = parent
+
+    def _evict(self) -> None:
+        """
+        drops the processes that exited first until the tree has 10% less
+        than max_nodes nodes. live processes are never dropped; a process
+        that exited before its descendants is queued again once one of
+        them is dropped.
+        """
+        target = self.max_nodes * 9 // 10
+        while self.node_count > target and self._exited:
+            n = self._exited.popleft()
+            if n.dropped:
+                continue  # along with an ancestor or by _prune
+            if all(d.exited for d in n.descendants):
+                self.evicted += self._drop(n)
+            else:
+                n.outlived = True
 
     def handle_procexit(self, evt: CCEvent):
-        self.nodes_by_pid.pop(evt.pid, None)  # remove node if present
+        node = self.nodes_by_pid.pop(evt.pid, None)  # remove node if present
+        if node:
+            node.exited = True
+            node.ended = evt.ts
+            if self.max_nodes:
+                self._exited.append(node)
+            if self.prune_exited:
+                self._prune(node)
 
     def handle_clone(self, evt: CCEvent):
         child_pid, parent_pid = evt.pid, evt.ppid
         assert child_pid > 0, "Unexpected child pid: {}".format(child_pid)
         assert parent_pid != child_pid
 
-        pnode = self.nodes_by_pid.setdefault(parent_pid,
-                                             CCNode(evt.exepath, pid=parent_pid))
-        cnode = self.nodes_by_pid.setdefault(child_pid, None)
-        if not cnode:
-            cnode = CCNode(evt.exepath, parent=pnode, pid=child_pid)
-            self.nodes_by_pid[child_pid] = cnode
+        pnode = self.nodes_by_pid.get(parent_pid, None)
+        if not pnode:
+            pnode = self._new_node(evt.exepath, parent_pid)
+        if not self.nodes_by_pid.get(child_pid, None):
+            self._new_node(evt.exepath, child_pid, parent=pnode, started=evt.ts)
 
         if pnode.is_root:
             self.roots.add(pnode)
@@ -70,31 +291,26 @@ class ProcTree(object):
     def handle_execve(self, evt: CCEvent):
         child_pid, parent_pid = evt.pid, evt.ppid
 
-        child = evt.exepath
         # sometimes 'exepath' is blank. TODO: can this be avoided?
+        child = evt.resolved_exepath
         if child == SYSDIG_NA:
-            eargs = str(evt.eargs)
-            m = ProcTree._eargs_re.match(eargs)
-            if m:
-                child = m.group(1)
-            elif "filename=" in eargs:
-                child = eargs[9:]
-            else:
-                print(evt.eargs)
-                assert False
+            print(evt.eargs)
+            assert False
 
         # the lookup of the parent process can fail if the process was
         # started before we started running sysdig
-        rnode = CCNode(UNKNOWN_PROC_LABEL, pid=parent_pid)
-        pnode = self.nodes_by_pid.setdefault(parent_pid, rnode)
+        pnode = self.nodes_by_pid.get(parent_pid, None)
+        if not pnode:
+            pnode = self._new_node(UNKNOWN_PROC_LABEL, parent_pid)
+            self.roots.add(pnode)
 
         cnode = self.nodes_by_pid.get(child_pid, None)
         if cnode:
             cnode.name = child
         else:
             # happens if a process executes multiple execve calls
-            cnode = CCNode(child, parent=pnode, pid=child_pid)
-            self.nodes_by_pid[child_pid] = cnode
+            cnode = self._new_node(child, child_pid, parent=pnode, started=evt.ts)
+        cnode.execd = True
 
     def print_single_branch(self, evt: CCEvent):
         print(self.format_single_branch(evt))
@@ -105,24 +321,17 @@ class ProcTree(object):
         """
         dgray = Colors.DGRAY if fancy_output else ""
         nocol = Colors.NO_COLOR if fancy_output else ""
+        sty = STY() if fancy_output else AsciiStyle()
 
-        branch = set()
-        root = self.nodes_by_pid[evt.pid]
-        # prints the node of interest as an only child
-        if root.parent:
-            root.parent.children = [root]
-        branch.add(root)
-        while not root.is_root:
-            root = root.parent
-            branch.add(root)
-
+        # prints each node on the branch as an only child
+        branch = list(self.nodes_by_pid[evt.pid].iter_path_reverse())
+        branch.reverse()
         lines = []  # List[str]
-        indent = 0
-        sty = STY if fancy_output else AsciiStyle
-        for pre, _, node in RenderTree(root, style=sty):
-            if node not in branch:
-                continue
-            ncolor = get_color(node.name) if sty == ContStyle else ""
+        pre = ""
+        for depth, node in enumerate(branch):
+            if depth:
+                pre = sty.empty * (depth - 1) + sty.end
+            ncolor = get_color(node.name) if isinstance(sty, ContStyle) else ""
             line = "{}{}{} ({})".format(pre, ncolor, node.name, node.pid)
             # nodes representing compiler drivers or linkers have version info
             cc_ver = get_tool_ver(node.name)
@@ -130,80 +339,406 @@ class ProcTree(object):
                 line += dgray + " " + cc_ver
             line = line + nocol
             lines.append(line)
-            indent = len(pre)
+        indent = len(pre)
 
         # print args of event
         line = " " * indent + dgray
         line += evt.args + nocol
         lines.append(line)
 
-        env = evt.env
-        pwd = env.get("PWD", None)
+        pwd = evt.cwd
         if pwd:
             line = " " * indent + "$PWD=" + pwd
             lines.append(line)
 
         return "\n".join(lines)
 
-    def print_tree(self, p: Policy) -> None:
+    def iter_tree(self, p: Policy, fancy_output=True, max_depth=None, max_width=None):
         """
-        NOTE: this function is called right before cctrace.py exits and only once.
-        NOTE: this is a best effort to compactly represent the process tree.
+        yields the lines print_tree prints, one at a time, leaving the tree
+        untouched. subtrees that repeat a subtree printed earlier at the
+        same path (e.g. the same compiler invocation run twice by one make
+        process) are left out. children below `max_depth` and all but the
+        first `max_width` children of a process are summarized in one line.
         """
+        sty = STY() if fancy_output else AsciiStyle()
+        dgray = Colors.DGRAY if fancy_output else ""
+        nocol = Colors.NO_COLOR if fancy_output else ""
+        roots = list(self.roots)
+        seen = set()  # markers of the subtrees printed so far
+
+        # entries are (node or elision text, depth, prefix, fill for children)
+        stack = [(r, 0, "", "") for r in reversed(roots) if r.shown]
+        while stack:
+            node, depth, pre, fill = stack.pop()
+            if isinstance(node, str):
+                yield "{}{}{}{}".format(pre, dgray, node, nocol)
+                continue
 
-        def keeper(n: CCNode) -> bool:
-            """
-            Returns True if this node is interesting, False otherwise.
-            """
-            # configure processes are never keepers
-            if n.name.endswith("configure"):
-                return False
-
-            # prune children
-            n.children = filter(lambda c: keeper(c), n.children)
-
-            # boring leafs are never keepers
-            if n.is_leaf and n.color in [Colors.DGRAY, Colors.NO_COLOR]:
-                return False
-
-            return True
-
-        roots = [r for r in self.roots if keeper(r)]
-
-        duplicates = set()
-        forrest = []
-
-        # first remove duplicate subtrees
-        for root in roots:
-            for _, _, node in RenderTree(root, style=STY):
-
-                marker = node.hash_subtree()
-                if node.parent:
-                    marker = hash((marker, node.parent.hash_roots()))
-                if marker in duplicates:
-                    par = node.parent
-                    if par:
-                        par.children = [c for c in par.children if c != node]
-                else:
-                    duplicates.add(marker)
-
-        # ... then print the forrest
-        for root in roots:
-            for pre, _, node in RenderTree(root, style=STY):
-
-                ncolor = node.color
+            ncolor = node.color if fancy_output else ""
+            # color policy-checked nodes green
+            if fancy_output and p.is_checked(node.name) and p.check(node.name) is None:
+                ncolor = Colors.LGREEN
+            line = "{}{}{} ({})".format(pre, ncolor, node.name, node.pid)
+            # nodes representing compiler drivers have version information
+            cc_ver = get_tool_ver(node.name)
+            if cc_ver:
+                line += dgray + " " + cc_ver
+            yield line + nocol
+
+            children = []
+            for c in node.children:
+                if not c.shown:
+                    continue
+                marker = hash((c.subtree_hash, node.path_hash))
+                if marker not in seen:
+                    seen.add(marker)
+                    children.append(c)
+            if not children:
+                continue
 
-                # color policy-checked nodes green
-                if p.is_checked(node.name) and p.check(node.name) is None:
-                    ncolor = Colors.LGREEN
+            elided = None
+            if max_depth is not None and depth >= max_depth:
+                elided = "... {} {} below".format(len(children), _processes(len(children)))
+                children = []
+            elif max_width is not None and len(children) > max_width:
+                hidden = len(children) - max_width
+                elided = "... {} more {}".format(hidden, _processes(hidden))
+                children = children[:max_width]
+
+            entries = []
+            for i, c in enumerate(children):
+                last = i == len(children) - 1 and not elided
+                entries.append((c, depth + 1,
+                                fill + (sty.end if last else sty.cont),
+                                fill + (sty.empty if last else sty.vertical)))
+            if elided:
+                entries.append((elided, depth + 1, fill + sty.end, None))
+            stack.extend(reversed(entries))
+
+    def write_tree(self, p: Policy, out, fancy_output=True, max_depth=None, max_width=None) -> int:
+        """
+        writes the tree to `out` line by line; returns the number of lines.
+        """
+        count = 0
+        for line in self.iter_tree(p, fancy_output, max_depth, max_width):
+            out.write(line + "\n")
+            count += 1
+        return count
 
-                # line = "{}{}{}".format(pre, ncolor, node.name)
-                line = "{}{}{} ({})".format(pre, ncolor, node.name, node.pid)
-                # nodes representing compiler drivers have version information
-                cc_ver = get_tool_ver(node.name)
-                if cc_ver:
-                    line += Colors.DGRAY + " " + cc_ver
-                line = line + Colors.NO_COLOR
-                forrest.append(line)
+    def print_tree(self, p: Policy) -> None:
+        """
+        NOTE: this is a best effort to compactly represent the process tree.
+        """
+        self.write_tree(p, sys.stdout)
 
-        print("\n".join(forrest))
+    def _spans(self, roots: list) -> dict:
+        """
+        maps the id of every node to its (start, end) time. nodes created
+        for processes that were only seen as parents start with their first
+        child; processes that did not exit end with the last event.
+        """
+        spans = dict()
+        last = None
+        stack = [(r, False) for r in roots]
+        while stack:
+            n, expanded = stack.pop()
+            if not expanded:
+                stack.append((n, True))
+                stack.extend((c, False) for c in n.children)
+                continue
+            start = n.started
+            if start is None:
+                start = min((spans[id(c)][0] for c in n.children
+                             if spans[id(c)][0] is not None), default=None)
+            spans[id(n)] = (start, n.ended)
+            for t in (start, n.ended):
+                if t is not None and (last is None or t > last):
+                    last = t
+        return {k: (s, last if e is None else e) for (k, (s, e)) in spans.items()}
+
+    def critical_path(self) -> list:
+        """
+        the chain of processes that bounds the wall time of the build, as
+        (node, depth, start, end, self time) in the order they ran. times
+        are in ns; the self time of a process is the part of its run time
+        not spent waiting for the next process on the path.
+
+        the path starts at the root that ended last. a process waits for
+        the child that ended last before it, which was started after the
+        child that ended last before that one started, and so on; the
+        children on this chain are expanded the same way.
+        """
+        roots = list(self.roots)
+        spans = self._spans(roots)
+        roots = [r for r in roots if spans[id(r)][0] is not None]
+        if not roots:
+            return []
+        root = max(roots, key=lambda r: (spans[id(r)][1], -spans[id(r)][0]))
+        path = []
+        stack = [(root, 0)]
+        while stack:
+            n, depth = stack.pop()
+            start, end = spans[id(n)]
+            children = sorted((c for c in n.children if spans[id(c)][0] is not None),
+                              key=lambda c: spans[id(c)][1], reverse=True)
+            chain = []  # latest first
+            t = end
+            for c in children:
+                cstart, cend = spans[id(c)]
+                if cend <= t and cstart >= start:
+                    chain.append(c)
+                    t = cstart
+            waited = sum(spans[id(c)][1] - spans[id(c)][0] for c in chain)
+            path.append((n, depth, start, end, end - start - waited))
+            stack.extend((c, depth + 1) for c in chain)
+        return path
+
+    def write_critical_path(self, out, limit: int = 20) -> None:
+        """
+        writes the processes on the critical path that contributed the most
+        to it, in the order they ran.
+        """
+        path = self.critical_path()
+        if not path:
+            out.write("critical path: no event times recorded\n")
+            return
+        total = path[0][3] - path[0][2]
+        out.write("critical path: {:.2f}s through {} processes\n".format(
+            total / 1e9, len(path)))
+        shown = sorted(range(len(path)), key=lambda i: path[i][4], reverse=True)[:limit]
+        shown = [i for i in sorted(shown) if path[i][4] > 0]
+        out.write("{:>10} {:>10} {:>10}  {}\n".format("start", "duration", "self", "process"))
+        for i in shown:
+            node, depth, start, end, own = path[i]
+            out.write("{:>9.2f}s {:>9.2f}s {:>9.2f}s  {} ({})\n".format(
+                (start - path[0][2]) / 1e9, (end - start) / 1e9, own / 1e9,
+                node.name, node.pid))
+        hidden = len(path) - len(shown)
+        if hidden:
+            out.write("{:>9}  ... {} more {} with less time of their own\n".format(
+                "", hidden, _processes(hidden)))
+
+
+class TestProcTree(unittest.TestCase):
+
+    @staticmethod
+    def _ts(ts: int) -> str:
+        return " ts={}".format(ts) if ts is not None else ""
+
+    @staticmethod
+    def _clone(pt: ProcTree, exe: str, pid: int, ppid: int, ts: int = None):
+        line = "{0}#clone#{1}#x#{0}#{2}#res=0 exe={1}".format(pid, exe, ppid)
+        pt.handle_clone(CCEvent.parse((line + TestProcTree._ts(ts)).encode()))
+
+    @staticmethod
+    def _execve(pt: ProcTree, exe: str, pid: int, ppid: int, ts: int = None):
+        line = "{0}#execve#{1}#x#{0}#{2}#res=0 exe={1}".format(pid, exe, ppid)
+        pt.handle_execve(CCEvent.parse((line + TestProcTree._ts(ts)).encode()))
+
+    @staticmethod
+    def _exit(pt: ProcTree, pid: int, ts: int = None):
+        line = "{0}#procexit#x#x#{0}#0#status=0".format(pid)
+        pt.handle_procexit(CCEvent.parse((line + TestProcTree._ts(ts)).encode()))
+
+    def _spawn(self, pt: ProcTree, exe: str, pid: int, ppid: int, parent: str,
+               ts: int = None):
+        self._clone(pt, parent, pid, ppid, ts)
+        self._execve(pt, exe, pid, ppid, ts)
+
+    def test_critical_path(self):
+        pt = ProcTree()
+        s = 10 ** 9
+        self._spawn(pt, "/usr/bin/make", 10, 1, "/bin/bash", ts=0 * s)
+        # two compiles in parallel, then a link waiting for both
+        self._spawn(pt, "/usr/bin/gcc", 11, 10, "/usr/bin/make", ts=1 * s)
+        self._spawn(pt, "/usr/bin/gcc", 12, 10, "/usr/bin/make", ts=1 * s)
+        self._spawn(pt, "/usr/lib/gcc/x86_64-linux-gnu/8/cc1", 13, 11, "/usr/bin/gcc", ts=2 * s)
+        self._exit(pt, 13, ts=5 * s)
+        self._exit(pt, 12, ts=3 * s)
+        self._exit(pt, 11, ts=6 * s)
+        self._spawn(pt, "/usr/bin/ld", 14, 10, "/usr/bin/make", ts=6 * s)
+        self._exit(pt, 14, ts=9 * s)
+        self._exit(pt, 10, ts=10 * s)
+        path = [(n.pid, depth, own // s) for (n, depth, _, _, own) in pt.critical_path()]
+        # bash (1) is still running and ends with the last event
+        self.assertEqual(path, [(1, 0, 0), (10, 1, 2), (11, 2, 2), (13, 3, 3), (14, 2, 3)])
+
+        out = io.StringIO()
+        pt.write_critical_path(out, limit=2)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], "critical path: 10.00s through 5 processes")
+        self.assertEqual(lines[1].split(), ["start", "duration", "self", "process"])
+        self.assertEqual(lines[2], "     2.00s      3.00s      3.00s  "
+                                   "/usr/lib/gcc/x86_64-linux-gnu/8/cc1 (13)")
+        self.assertTrue(lines[3].endswith("/usr/bin/ld (14)"))
+        self.assertTrue(lines[4].endswith("... 3 more processes with less time of their own"))
+
+    def test_prune_exited(self):
+        pt = ProcTree(prune_exited=True)
+        self._spawn(pt, "/usr/bin/make", 10, 1, "/bin/bash")
+        self._spawn(pt, "/bin/sh", 11, 10, "/usr/bin/make")
+        self._spawn(pt, "/bin/sed", 12, 11, "/bin/sh")
+        self._spawn(pt, "/usr/bin/gcc", 13, 11, "/bin/sh")
+        self.assertEqual(pt.node_count, 5)
+
+        self._exit(pt, 12)  # boring leaf
+        self.assertEqual(pt.pruned, 1)
+        self._exit(pt, 13)  # compilers are always kept
+        self._exit(pt, 11)
+        self.assertEqual(pt.pruned, 1)
+        self.assertEqual(pt.node_count, 4)
+
+    def test_prune_configure(self):
+        pt = ProcTree(prune_exited=True)
+        self._spawn(pt, "/usr/bin/make", 10, 1, "/bin/bash")
+        self._spawn(pt, "/src/configure", 11, 10, "/usr/bin/make")
+        self._spawn(pt, "/usr/bin/gcc", 12, 11, "/src/configure")
+        self._exit(pt, 11)
+        self.assertEqual(pt.pruned, 0)  # gcc still running
+        self._exit(pt, 12)
+        self.assertEqual(pt.pruned, 2)
+        self.assertEqual(pt.node_count, 2)
+
+    def test_max_nodes(self):
+        pt = ProcTree(max_nodes=10)
+        self._spawn(pt, "/usr/bin/make", 10, 1, "/bin/bash")
+        for pid in range(100, 200):
+            self._spawn(pt, "/usr/bin/gcc", pid, 10, "/usr/bin/make")
+            self._exit(pt, pid)
+        self.assertLessEqual(pt.node_count, 10)
+        self.assertEqual(pt.node_count + pt.evicted, 102)
+        # live processes are never evicted
+        self.assertIn(10, pt.nodes_by_pid)
+        self.assertIs(pt.nodes_by_pid[10].root, pt.nodes_by_pid[1])
+
+    def test_max_nodes_parent_exits_first(self):
+        pt = ProcTree(max_nodes=4)
+        self._spawn(pt, "/usr/bin/make", 10, 1, "/bin/bash")
+        for pid in range(100, 200, 3):
+            # sh exits before the compiler it started, which is still
+            # running when the next process makes room in the tree
+            self._spawn(pt, "/bin/sh", pid, 10, "/usr/bin/make")
+            self._spawn(pt, "/usr/bin/gcc", pid + 1, pid, "/bin/sh")
+            self._exit(pt, pid)
+            self._spawn(pt, "/usr/bin/ld", pid + 2, 10, "/usr/bin/make")
+            self._exit(pt, pid + 1)
+            self._exit(pt, pid + 2)
+        self._spawn(pt, "/bin/sh", 200, 10, "/usr/bin/make")
+        self.assertLessEqual(pt.node_count, 4)
+        self.assertEqual(pt.node_count + pt.evicted, 105)
+
+    def test_max_nodes_dropped_descendants(self):
+        pt = ProcTree(prune_exited=True, max_nodes=70)
+        self._spawn(pt, "/usr/bin/make", 10, 1, "/bin/bash")
+        self._spawn(pt, "/src/configure", 20, 10, "/usr/bin/make")
+        self._spawn(pt, "/usr/bin/gcc", 21, 20, "/src/configure")
+        self._exit(pt, 20)
+        self._exit(pt, 21)  # pruned along with configure
+        for pid in range(100, 160, 2):
+            # sh exits before the compiler it started
+            self._spawn(pt, "/bin/sh", pid, 10, "/usr/bin/make")
+            self._spawn(pt, "/usr/bin/gcc", pid + 1, pid, "/bin/sh")
+            self._exit(pt, pid)
+            self._exit(pt, pid + 1)
+        for pid in range(200, 210):
+            self._spawn(pt, "/usr/bin/ld", pid, 10, "/usr/bin/make")
+        # neither the nodes dropped by _prune nor the children of evicted
+        # processes are dropped again
+        self.assertEqual(pt.node_count, sum(1 for r in pt.roots for _ in PreOrderIter(r)))
+        self.assertLessEqual(pt.node_count, 70)
+        self.assertEqual(pt.node_count + pt.pruned + pt.evicted, 74)
+
+    @staticmethod
+    def _fresh_hashes(n: CCNode):
+        def shown(n):
+            return not n.name.endswith("configure") and \
+                (any(shown(c) for c in n.children) or not n.boring)
+
+        def subtree(n):
+            return hash((hash(n.name),) + tuple(subtree(c) for c in n.children if shown(c)))
+
+        def path(n):
+            if n.parent is None:
+                return hash((hash(n.name),))
+            return hash((hash(n.name), path(n.parent)))
+        return subtree(n), path(n)
+
+    def _assert_hashes_current(self, pt: ProcTree):
+        for r in pt.roots:
+            for n in PreOrderIter(r):
+                self.assertEqual((n.subtree_hash, n.path_hash), self._fresh_hashes(n))
+
+    def test_hashes_follow_changes(self):
+        pt = ProcTree(prune_exited=True)
+        self._spawn(pt, "/usr/bin/make", 10, 1, "/bin/bash")
+        self._clone(pt, "/usr/bin/make", 11, 10)
+        self._assert_hashes_current(pt)
+        self._execve(pt, "/bin/sh", 11, 10)  # renames a node
+        self._spawn(pt, "/usr/bin/gcc", 12, 11, "/bin/sh")
+        self._assert_hashes_current(pt)
+        self._spawn(pt, "/bin/sed", 13, 11, "/bin/sh")
+        self._assert_hashes_current(pt)
+        self._exit(pt, 13)  # pruned
+        self.assertEqual(pt.pruned, 1)
+        self._assert_hashes_current(pt)
+
+    @staticmethod
+    def _pids(lines) -> list:
+        return [int(m.group(1)) for m in (re.search(r"\((\d+)\)", l) for l in lines) if m]
+
+    def test_dedup(self):
+        pt = ProcTree()
+        self._spawn(pt, "/usr/bin/make", 10, 1, "/bin/bash")
+        for pid in (11, 12, 13):
+            self._spawn(pt, "/bin/sh", pid, 10, "/usr/bin/make")
+            self._spawn(pt, "/usr/bin/gcc", pid + 10, pid, "/bin/sh")
+        self._spawn(pt, "/usr/bin/ld", 30, 13, "/bin/sh")
+        self._spawn(pt, "/bin/sh", 14, 10, "/usr/bin/make")
+        self._spawn(pt, "/usr/bin/gcc", 24, 14, "/bin/sh")
+        self._spawn(pt, "/bin/sed", 34, 14, "/bin/sh")
+        lines = list(pt.iter_tree(Policy(), fancy_output=False))
+        # the second `sh -> gcc` is left out, `sh -> gcc, ld` is not; gcc
+        # under the third sh repeats the gcc printed under the first one.
+        # the last sh only adds sed, which is not printed.
+        self.assertEqual(self._pids(lines), [1, 10, 11, 21, 13, 30])
+        # rendering leaves the tree alone
+        self.assertEqual(len(pt.nodes_by_pid[10].children), 4)
+        self._assert_hashes_current(pt)
+        # the hashes follow what is shown
+        self.assertFalse(pt.nodes_by_pid[34].shown)
+        self.assertEqual(pt.nodes_by_pid[14].subtree_hash, pt.nodes_by_pid[11].subtree_hash)
+        pt.nodes_by_pid[34].name = "/usr/bin/as"
+        self.assertNotEqual(pt.nodes_by_pid[14].subtree_hash, pt.nodes_by_pid[11].subtree_hash)
+        self._assert_hashes_current(pt)
+
+    def test_limits(self):
+        pt = ProcTree()
+        self._spawn(pt, "/usr/bin/make", 10, 1, "/bin/bash")
+        for pid in range(11, 21):
+            self._spawn(pt, "/opt/gcc{}/bin/gcc".format(pid), pid, 10, "/usr/bin/make")
+        self._spawn(pt, "/usr/bin/ld", 30, 11, "/opt/gcc11/bin/gcc")
+        lines = list(pt.iter_tree(Policy(), fancy_output=False, max_width=3))
+        self.assertEqual(self._pids(lines), [1, 10, 11, 30, 12, 13])
+        self.assertEqual(lines[-1], "    +-- ... 7 more processes")
+        lines = list(pt.iter_tree(Policy(), fancy_output=False, max_depth=1))
+        self.assertEqual(self._pids(lines), [1, 10])
+        self.assertEqual(lines[-1], "    +-- ... 10 processes below")
+
+    def test_format_single_branch(self):
+        pt = ProcTree()
+        self._spawn(pt, "/usr/bin/make", 10, 1, "/bin/bash")
+        self._spawn(pt, "/usr/bin/gcc", 11, 10, "/usr/bin/make")
+        self._spawn(pt, "/usr/bin/ld", 12, 10, "/usr/bin/make")
+        evt = CCEvent.parse(b"11#execve#/usr/bin/gcc#x#11#10#res=0 exe=/usr/bin/gcc "
+                            b"args=Z2NjAC1jAGEuYw== cwd=/src")
+        wait_tool_vers(pt.exepaths())
+        lines = pt.format_single_branch(evt, fancy_output=False).split("\n")
+        self.assertEqual(self._pids(lines), [1, 10, 11])
+        self.assertTrue(lines[2].startswith("    +-- /usr/bin/gcc (11)"))
+        self.assertEqual(lines[3:], ["        gcc -c a.c", "        $PWD=/src"])
+        # the siblings of the process stay in the tree
+        self.assertEqual(len(pt.nodes_by_pid[10].children), 2)
+
+if __name__ == '__main__':
+    unittest.main()
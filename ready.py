@@ -0,0 +1,277 @@
+"""
+Tells scripts when cctrace is ready, i.e. when processes they start will be
+traced. sysdig takes a while to load its driver and says nothing once it
+is capturing, so cctrace runs short-lived probe processes until the events
+of one of them come through. the probes themselves are not traced.
+"""
+import os
+import pwd
+import time
+import logging
+import threading
+import subprocess
+import unittest
+
+PROBE = ['true']
+
+
+def _record_pid(record: bytes) -> int:
+    fields = record.split(b'#', 6)
+    try:
+        return int(fields[4])
+    except (IndexError, ValueError):
+        return None
+
+
+class Readiness(object):
+    """
+    signals readiness by creating the file `path` and by writing "ready"
+    to the file descriptor `fd` and closing it. a stale file is removed
+    first, so scripts can wait for it to appear. if tracing ends before
+    cctrace is ready, `fd` is closed without writing to it.
+
+    with sources that are not live, cctrace is ready right away. if no
+    probe is seen within `timeout` seconds, e.g. because the probes are
+    not in the traced scope, readiness is signaled anyway. probes run as
+    `user` if cctrace runs as root, so that they match a user scope.
+    `spawn`, if given, starts a probe some other way and returns its pid
+    and a function that waits for it to exit; `on_ready` is called when
+    cctrace is ready. a probe whose procexit was not seen within `timeout`
+    seconds is forgotten, so that a process reusing its pid is traced.
+    """
+
+    def __init__(self, path: str = None, fd: int = None, timeout: float = 10.0,
+                 interval: float = 0.2, user: str = None, spawn=None, on_ready=None):
+        self.path = path
+        self.fd = fd
+        self.timeout = timeout
+        self.interval = interval
+        self.user = user
+        self.spawn = spawn or self._spawn
+        self.on_ready = on_ready
+        self._preexec_fn = None
+        self.ready = threading.Event()
+        self.how = None  # 'offline', 'probe' or 'timeout' once ready
+        self.checking = False  # True while records may come from probes
+        self.outstanding = dict()  # pids of probes that may still be traced -> expiry
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = time.monotonic()
+        if path:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def start(self, live: bool = True) -> None:
+        """
+        call once the event source is running.
+        """
+        self._started = time.monotonic()
+        if not live:
+            self._signal('offline')
+            return
+        self.checking = True
+        self._thread = threading.Thread(target=self._run, name="ready-probe")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _preexec(self):
+        if self.user and os.geteuid() == 0:
+            pw = pwd.getpwnam(self.user)
+            uid, gid = pw.pw_uid, pw.pw_gid
+
+            def drop_privileges():
+                os.setgid(gid)
+                os.setuid(uid)
+            return drop_privileges
+        return None
+
+    def _spawn(self) -> tuple:
+        proc = subprocess.Popen(PROBE, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL,
+                                preexec_fn=self._preexec_fn)
+        return (proc.pid, proc.wait)
+
+    def _run(self) -> None:
+        deadline = self._started + self.timeout
+        try:
+            self._preexec_fn = self._preexec()
+        except KeyError:
+            pass
+        while not self._stop.is_set():
+            with self._lock:
+                if self.ready.is_set():
+                    return
+                if time.monotonic() >= deadline:
+                    logging.warning("no probe traced within %gs, assuming cctrace is ready",
+                                    self.timeout)
+                    self.checking = False
+                    self._signal('timeout')
+                    return
+                # holding the lock, so that the probe is known before
+                # `is_probe` sees its events; it is waited for without it
+                try:
+                    (pid, wait) = self.spawn()
+                except OSError as e:
+                    logging.warning("could not run readiness probe: %s", e)
+                    self.checking = False
+                    self._signal('timeout')
+                    return
+                self.outstanding[pid] = time.monotonic() + self.timeout
+            wait()
+            self.ready.wait(self.interval)
+
+    def _expire(self) -> None:
+        """
+        forgets the probes whose procexit is overdue, e.g. because sysdig
+        dropped it. probes expire in the order they were started.
+        """
+        now = time.monotonic()
+        while self.outstanding:
+            pid = next(iter(self.outstanding))
+            if self.outstanding[pid] > now:
+                break
+            del self.outstanding[pid]
+        if self.ready.is_set():
+            self.checking = bool(self.outstanding)
+
+    def is_probe(self, record: bytes) -> bool:
+        """
+        True for the records of probe processes, which are not part of
+        the build. the first one seen signals readiness. only needs to be
+        called while `checking` is set.
+        """
+        pid = _record_pid(record)
+        with self._lock:
+            self._expire()
+            if pid not in self.outstanding:
+                return False
+            if not self.ready.is_set():
+                # earlier probes ran before tracing started
+                for earlier in list(self.outstanding):
+                    if earlier == pid:
+                        break
+                    del self.outstanding[earlier]
+                self._signal('probe')
+            if b'#procexit#' in record:
+                del self.outstanding[pid]
+                self.checking = bool(self.outstanding)
+        return True
+
+    def _signal(self, how: str) -> None:
+        if self.ready.is_set():
+            return
+        self.how = how
+        self.ready.set()
+        logging.info("ready to trace after %.3fs (%s)", time.monotonic() - self._started, how)
+        if self.path:
+            tmp = "{}.{}".format(self.path, os.getpid())
+            try:
+                with open(tmp, 'w') as f:
+                    f.write("{}\n".format(os.getpid()))
+                os.replace(tmp, self.path)
+            except OSError as e:
+                logging.warning("could not write ready file %s: %s", self.path, e)
+        if self.fd is not None:
+            try:
+                os.write(self.fd, b"ready\n")
+            except OSError as e:
+                logging.warning("could not write to ready fd %d: %s", self.fd, e)
+            self._close_fd()
+        if self.on_ready:
+            self.on_ready()
+
+    def _close_fd(self) -> None:
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
+
+    def close(self) -> None:
+        self._stop.set()
+        with self._lock:
+            self._close_fd()
+            self.checking = False
+
+
+class TestReadiness(unittest.TestCase):
+
+    def test_probe(self):
+        import tempfile
+        rfd, wfd = os.pipe()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "ready")
+            with open(path, 'w') as f:
+                f.write("stale\n")
+            ready = Readiness(path=path, fd=wfd, timeout=30, interval=0.01)
+            self.assertFalse(os.path.exists(path))
+            ready.start()
+            while len(ready.outstanding) < 3:  # probes before tracing started are lost
+                time.sleep(0.01)
+            pid = list(ready.outstanding)[1]
+            other = "7#clone#/usr/bin/make#bash#7#1#res=0 exe=make ts=1##"
+            self.assertFalse(ready.is_probe(other.encode()))
+            self.assertFalse(ready.ready.is_set())
+            clone = "{0}#clone#/usr/bin/python3#python3#{0}#{1}#res=0 exe=python3 ts=1##"
+            self.assertTrue(ready.is_probe(clone.format(pid, os.getpid()).encode()))
+            self.assertTrue(ready.ready.is_set())
+            self.assertEqual(ready.how, 'probe')
+            with open(path) as f:
+                self.assertEqual(f.read(), "{}\n".format(os.getpid()))
+            self.assertEqual(os.read(rfd, 64), b"ready\n")
+            self.assertEqual(os.read(rfd, 64), b"")  # closed
+            os.close(rfd)
+            ready._thread.join(5)
+            # events of later probes are still dropped, until they exited
+            for pid in list(ready.outstanding):
+                exit = "{0}#procexit#/bin/true#python3#{0}#{1}#status=0 ts=2##"
+                self.assertTrue(ready.is_probe(exit.format(pid, os.getpid()).encode()))
+            self.assertFalse(ready.checking)
+            ready.close()
+
+    def test_probe_not_traced(self):
+        pids = iter(range(1000, 2000))
+        exited = threading.Event()
+        ready = Readiness(timeout=0.5, interval=0.01, spawn=lambda: (next(pids), exited.wait))
+        ready.start()
+        while not ready.outstanding:
+            time.sleep(0.01)
+        # the event thread is not held up while the probe runs
+        self.assertTrue(ready._lock.acquire(timeout=5))
+        ready._lock.release()
+        clone = "1000#clone#/usr/bin/python3#python3#1000#{}#res=0 exe=python3 ts=1##"
+        self.assertTrue(ready.is_probe(clone.format(os.getpid()).encode()))
+        self.assertEqual(ready.how, 'probe')
+        exited.set()
+        ready._thread.join(5)
+        self.assertTrue(ready.checking)
+        # its procexit was lost; a later process with the same pid is traced
+        time.sleep(0.5)
+        clone = "1000#clone#/usr/bin/make#make#1000#7#res=0 exe=make ts=2##"
+        self.assertFalse(ready.is_probe(clone.encode()))
+        self.assertFalse(ready.checking)
+        ready.close()
+
+    def test_timeout(self):
+        ready = Readiness(timeout=0.05, interval=0.01)
+        with self.assertLogs(level='WARNING'):
+            ready.start()
+            self.assertTrue(ready.ready.wait(5))
+        self.assertEqual(ready.how, 'timeout')
+        self.assertFalse(ready.checking)
+
+    def test_not_ready(self):
+        rfd, wfd = os.pipe()
+        ready = Readiness(fd=wfd, timeout=30)
+        ready.close()
+        self.assertEqual(os.read(rfd, 64), b"")
+        os.close(rfd)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+"""
+Programs run during a build, followed through the clone, execve and
+procexit events of their processes. The build profile and the Chrome
+trace export are built on it.
+"""
+import abc
+import time
+import unittest
+
+from ccevent import CCEvent
+from tools import ToolType
+
+
+class Run(object):
+    """
+    a program run by a process, from its execve to its exit or next execve.
+    """
+    __slots__ = ('exepath', 'tt', 'started', 'pid', 'ppid')
+
+    def __init__(self, exepath: str, tt: ToolType, started: int, pid: int, ppid: int):
+        self.exepath = exepath
+        self.tt = tt
+        self.started = started
+        self.pid = pid
+        self.ppid = ppid
+
+
+class RunTracker(abc.ABC):
+    """
+    keeps the program each process runs. a process that forks without
+    calling execve is part of the program it runs. subclasses fill in
+    their subclass of Run (`run_type`) in `_start` and are told in
+    `_finish` when the program ended.
+
+    times are the ones sysdig recorded, or the time the events were
+    received if they have none; `first` and `last` are the earliest and
+    the latest time seen.
+    """
+    run_type = Run
+
+    def __init__(self):
+        self.runs_by_pid = dict()  # pid -> (Run, True if the process runs it)
+        self.first = None
+        self.last = None
+
+    def _time(self, evt: CCEvent) -> int:
+        ts = evt.ts or int(time.time() * 1e9)  # else time of receipt
+        if self.first is None:
+            self.first = ts
+        if self.last is None or ts > self.last:
+            self.last = ts
+        return ts
+
+    @abc.abstractmethod
+    def _start(self, run: Run, evt: CCEvent, parent: Run, previous: Run) -> None:
+        """
+        called when the execve `evt` started `run`. `parent` is the program
+        that started the process, `previous` the program the process ran
+        before; at most one of them is set.
+        """
+
+    @abc.abstractmethod
+    def _finish(self, run: Run, ts: int) -> None:
+        """
+        called when `run` ended at `ts`.
+        """
+
+    def handle_clone(self, evt: CCEvent) -> None:
+        entry = self.runs_by_pid.get(evt.ppid, None)
+        if entry is not None and evt.pid not in self.runs_by_pid:
+            self.runs_by_pid[evt.pid] = (entry[0], False)
+
+    def handle_execve(self, evt: CCEvent) -> None:
+        if evt.eargs.startswith(b'filename='):
+            return  # enter event
+        ts = self._time(evt)
+        parent = previous = None
+        entry = self.runs_by_pid.get(evt.pid, None)
+        if entry is None:
+            entry = self.runs_by_pid.get(evt.ppid, None)
+            if entry is not None:
+                parent = entry[0]
+        elif entry[1]:  # the process ran another program before
+            previous = entry[0]
+            self._finish(previous, ts)
+        else:
+            parent = entry[0]
+        exepath = evt.resolved_exepath
+        run = self.run_type(exepath, ToolType.from_path(exepath), ts, evt.pid, evt.ppid)
+        self._start(run, evt, parent, previous)
+        self.runs_by_pid[evt.pid] = (run, True)
+
+    def handle_procexit(self, evt: CCEvent) -> None:
+        ts = self._time(evt)
+        entry = self.runs_by_pid.pop(evt.pid, None)
+        if entry is not None and entry[1]:
+            self._finish(entry[0], ts)
+
+    def finish_all(self) -> int:
+        """
+        ends the programs that are still running at the time of the last
+        event, the last one started first; returns their number.
+        """
+        running = [run for (run, own) in self.runs_by_pid.values() if own]
+        for run in sorted(running, key=lambda r: r.started, reverse=True):
+            self._finish(run, self.last)
+        self.runs_by_pid.clear()
+        return len(running)
+
+
+class TestRunTracker(unittest.TestCase):
+
+    class Recorder(RunTracker):
+
+        def __init__(self):
+            super().__init__()
+            self.log = []
+
+        def _start(self, run, evt, parent, previous):
+            self.log.append(("start", run.pid, run.exepath,
+                             parent and parent.exepath, previous and previous.exepath))
+
+        def _finish(self, run, ts):
+            self.log.append(("finish", run.pid, run.exepath, ts))
+
+    def test_runs(self):
+        lines = [
+            "10#execve#/usr/bin/make#bash#10#1#res=0 ts=1",
+            "11#clone#/usr/bin/make#make#11#10#res=0 ts=2",
+            "11#execve#/bin/sh#make#11#10#filename=/bin/sh ts=2",  # enter event
+            "11#execve#/bin/sh#make#11#10#res=0 ts=2",
+            "11#execve#<NA>#sh#11#10#res=0 exe=/usr/bin/gcc ts=3",  # exec from sh
+            "12#clone#/usr/bin/gcc#gcc#12#11#res=0 ts=4",
+            "12#procexit#x#x#12#11#status=0 ts=5",  # never ran a program
+            "11#procexit#x#x#11#10#status=0 ts=6",
+        ]
+        rt = self.Recorder()
+        for line in lines:
+            evt = CCEvent.parse(line.encode())
+            getattr(rt, "handle_" + evt.type.decode())(evt)
+        self.assertEqual(rt.finish_all(), 1)
+        self.assertEqual(rt.log, [
+            ("start", 10, "/usr/bin/make", None, None),
+            ("start", 11, "/bin/sh", "/usr/bin/make", None),
+            ("finish", 11, "/bin/sh", 3),
+            ("start", 11, "/usr/bin/gcc", None, "/bin/sh"),
+            ("finish", 11, "/usr/bin/gcc", 6),
+            ("finish", 10, "/usr/bin/make", 6),  # still running
+        ])
+        self.assertEqual((rt.first, rt.last), (1, 6))
+        self.assertEqual(rt.runs_by_pid, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+"""
+Snapshots of the process tree, taken while tracing continues.
+"""
+import os
+import sys
+import time
+import signal
+import logging
+import tempfile
+import threading
+import unittest
+
+import asynclog
+
+
+class Snapshots(object):
+    """
+    renders the process tree when asked to with SIGUSR1 and, optionally,
+    every `interval` seconds. snapshots are taken on a background thread
+    as soon as they are due, also while the build is quiet. the trace loop
+    holds `lock` while it updates the tree and a snapshot holds it while
+    the tree is streamed out, so a snapshot never shows a half-updated
+    tree. the trace loop keeps reading events meanwhile and processes
+    them once the snapshot is done.
+
+    snapshots stream to stdout or replace the file at `path`, so that the
+    file always holds the most recent complete snapshot.
+    """
+
+    def __init__(self, pt, p, path: str = None, interval: float = None,
+                 max_depth: int = None, max_width: int = None):
+        self.pt = pt
+        self.p = p
+        self.path = path
+        self.interval = interval
+        self.max_depth = max_depth
+        self.max_width = max_width
+        self.lock = threading.Lock()
+        self.requested = False
+        self.taken = 0
+        self._due = time.monotonic() + interval if interval else None
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def install(self) -> None:
+        signal.signal(signal.SIGUSR1, self._on_signal)
+        self._thread = threading.Thread(target=self._run, name="snapshots")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _on_signal(self, signum, frame) -> None:
+        self.requested = True
+        self._wake.set()
+
+    def _run(self) -> None:
+        while not self._stopped:
+            timeout = None if self._due is None else max(0.0, self._due - time.monotonic())
+            self._wake.wait(timeout)
+            self._wake.clear()
+            if self._stopped:
+                return
+            if self.requested or (self._due is not None and time.monotonic() >= self._due):
+                try:
+                    self.take()
+                except Exception:
+                    logging.exception("could not take snapshot %d", self.taken)
+
+    def _write(self, out, fancy_output: bool) -> int:
+        with self.lock:
+            out.write("--- snapshot {} at {}, {} processes ---\n".format(
+                self.taken, time.strftime("%H:%M:%S"), self.pt.node_count))
+            return self.pt.write_tree(self.p, out, fancy_output,
+                                      self.max_depth, self.max_width)
+
+    def take(self) -> None:
+        self.requested = False
+        self.taken += 1
+        start = time.perf_counter()
+        if self.path:
+            tmp = self.path + ".tmp"
+            with open(tmp, 'w') as out:
+                lines = self._write(out, fancy_output=False)
+            os.replace(tmp, self.path)
+        else:
+            asynclog.flush()  # don't interleave with queued violations
+            lines = self._write(sys.stdout, fancy_output=sys.stdout.isatty())
+            sys.stdout.flush()
+        logging.debug("snapshot %d: %d lines in %.3fs", self.taken, lines,
+                      time.perf_counter() - start)
+        if self.interval:
+            self._due = time.monotonic() + self.interval
+
+    def close(self) -> None:
+        """
+        stops taking snapshots; waits for one being taken.
+        """
+        self._stopped = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+
+class TestSnapshots(unittest.TestCase):
+
+    def test_signal(self):
+        from policy import Policy
+        from proctree import ProcTree, TestProcTree
+        pt = ProcTree()
+        TestProcTree._clone(pt, "/usr/bin/make", 10, 1)
+        TestProcTree._execve(pt, "/usr/bin/gcc", 10, 1)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "tree.txt")
+            snapshots = Snapshots(pt, Policy(), path=path)
+            snapshots.install()
+            try:
+                time.sleep(0.05)
+                self.assertFalse(os.path.exists(path))
+
+                # taken right away, without waiting for another event
+                os.kill(os.getpid(), signal.SIGUSR1)
+                deadline = time.monotonic() + 5
+                while not os.path.exists(path) and time.monotonic() < deadline:
+                    time.sleep(0.01)
+            finally:
+                snapshots.close()
+            with open(path) as f:
+                lines = f.read().splitlines()
+            self.assertTrue(lines[0].startswith("--- snapshot 1 at "))
+            self.assertTrue(lines[1].startswith("/usr/bin/make (1)"))
+            self.assertTrue(lines[2].startswith("+-- /usr/bin/gcc (10)"))
+            self.assertFalse(snapshots.requested)
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+
+    def test_interval(self):
+        from policy import Policy
+        from proctree import ProcTree, TestProcTree
+        pt = ProcTree()
+        TestProcTree._clone(pt, "/usr/bin/make", 10, 1)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "tree.txt")
+            snapshots = Snapshots(pt, Policy(), path=path, interval=0.01)
+            with snapshots.lock:  # the trace loop is updating the tree
+                snapshots.install()
+                time.sleep(0.05)
+                self.assertFalse(os.path.exists(path))
+            deadline = time.monotonic() + 5
+            while snapshots.taken < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            snapshots.close()
+            self.assertGreaterEqual(snapshots.taken, 2)
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+
+
+if __name__ == '__main__':
+    unittest.main()
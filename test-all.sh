@@ -3,4 +3,21 @@
 
 python3 tools.py
 python3 -m unittest policy/__init__.py
-
+python3 -m unittest pipeline.py
+python3 -m unittest ccevent.py
+python3 -m unittest capture.py
+python3 -m unittest evtsource.py
+python3 -m unittest proctree.py
+python3 -m unittest proctable.py
+python3 -m unittest snapshot.py
+python3 -m unittest compdb.py
+python3 -m unittest bintrace.py
+python3 -m unittest tracedb.py
+python3 -m unittest asynclog.py
+python3 -m unittest metrics.py
+python3 -m unittest runtracker.py
+python3 -m unittest buildprof.py
+python3 -m unittest chrometrace.py
+python3 -m unittest ready.py
+python3 -m unittest launcher.py
+python3 -m unittest containers.py
@@ -1,7 +1,61 @@
 import os
 import re
+import json
+import logging
 import subprocess as sp
 from enum import Enum
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+
+
+class LRUCache(object):
+    """
+    dict-like cache holding at most `maxsize` entries; the least recently
+    used entry is evicted first. counts hits and misses.
+
+    >>> c = LRUCache(2)
+    >>> c.put("a", 1); c.put("b", 2); c.get("a")
+    1
+    >>> c.put("c", 3); c.get("b") is None
+    True
+    >>> sorted(c.keys()), c.hits, c.misses
+    (['a', 'c'], 1, 1)
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def keys(self):
+        return self._data.keys()
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
 
 class ToolType(Enum):
     c_compiler = 1
@@ -67,17 +121,27 @@ class ToolType(Enum):
         linker
         >>> ToolType.from_path("/usr/bin/x86_64-linux-gnu-ld")
         linker
+        >>> ToolType.from_path("/usr/lib/llvm-6.0/bin/clang")
+        c_compiler
+        >>> ToolType.from_path("/usr/lib/llvm-6.0/bin/clang-tblgen")
+        llvm_lib
+        >>> ToolType.from_path("/usr/bin/make")
+        builder
+        >>> ToolType.from_path("/home/me/build/gen-tool")
+        unknown
+        >>> "/home/me/build/gen-tool" in ToolType._cache
+        True
         """
         typ = ToolType._cache.get(exepath, None)
         if typ:
             return typ
 
-        for (typ, matcher) in ToolType._matchers.items():
-            if matcher.match(exepath):
-                ToolType._cache[exepath] = typ
-                return typ
-
-        return ToolType.unknown
+        # the first alternative that matches wins, same as trying the
+        # matchers one after another.
+        m = ToolType._classifier.match(exepath)
+        typ = ToolType[m.lastgroup] if m else ToolType.unknown
+        ToolType._cache.put(exepath, typ)  # also cache unknown tools
+        return typ
 
     def is_compiler(self):
         return self == ToolType.c_compiler or self == ToolType.cxx_compiler
@@ -97,31 +161,93 @@ class ToolType(Enum):
         return self == ToolType.linker
 
 
-ToolType._cache = dict()  # init cache
-ToolType._matchers = {k: re.compile(v) for (k, v) in {
-    ToolType.c_compiler: r"[^\0]+/(clang|gcc|suncc|icc|cc)$",
-    ToolType.cxx_compiler: r"[^\0]+/(clang\+\+|g\+\+|c\+\+)$",
-    ToolType.gcc_lib: r"/usr/lib/gcc/[^\0]+/(\d\.\d|\d)/(cc(1|1plus)|collect2)",
+ToolType._cache = LRUCache(8192)  # init cache
+# NOTE: order matters; earlier matchers take precedence.
+ToolType._matchers = OrderedDict((k, re.compile(v)) for (k, v) in [
+    (ToolType.c_compiler, r"[^\0]+/(clang|gcc|suncc|icc|cc)$"),
+    (ToolType.cxx_compiler, r"[^\0]+/(clang\+\+|g\+\+|c\+\+)$"),
+    (ToolType.gcc_lib, r"/usr/lib/gcc/[^\0]+/(\d\.\d|\d)/(cc(1|1plus)|collect2)"),
     # can match the gcc version of as, ld, etc. so commented out for now.
     # ToolType.gcc_bin: r"/usr/bin/(x86_64|i686|arm|arm64|aarch64)-linux-gnu-",
-    ToolType.llvm_lib: r"/usr/lib/llvm-[\d\.]+/bin/clang(\+\+)?",
-    ToolType.linker: r"[^\0]+/((x86_64|i686|arm|arm64|aarch64)-linux-gnu-)?ld(\.gold|\.bfd|\.ldd)?$",
-    ToolType.assembler: r"[^\0]+/(((x86_64|i686|arm|arm64|aarch64)-linux-gnu-)?as|yasm|nasm)$",
-    ToolType.archiver: r"[^\0]+/((x86_64|i686|arm|arm64|aarch64)-linux-gnu-)?ar$",
-    ToolType.indexer: r"[^\0]+/((x86_64|i686|arm|arm64|aarch64)-linux-gnu-)?ranlib$",
-    ToolType.sym_lister: r"[^\0]+/((x86_64|i686|arm|arm64|aarch64)-linux-gnu-)?nm$",
-    ToolType.interpreter: r"[^\0]+/(python|ruby|tclsh|perl|lua)[\d\.]*$",
-    ToolType.builder: r"[^\0]+/((c|cc|g|q)?make|cpack|ctest|scons|ninja|bear|ccache|libtool)",
-    ToolType.util: r"/(usr/)?bin/.*",
-}.items()}
-
-
-def get_tool_ver(exepath: str):
+    (ToolType.llvm_lib, r"/usr/lib/llvm-[\d\.]+/bin/clang(\+\+)?"),
+    (ToolType.linker, r"[^\0]+/((x86_64|i686|arm|arm64|aarch64)-linux-gnu-)?ld(\.gold|\.bfd|\.ldd)?$"),
+    (ToolType.assembler, r"[^\0]+/(((x86_64|i686|arm|arm64|aarch64)-linux-gnu-)?as|yasm|nasm)$"),
+    (ToolType.archiver, r"[^\0]+/((x86_64|i686|arm|arm64|aarch64)-linux-gnu-)?ar$"),
+    (ToolType.indexer, r"[^\0]+/((x86_64|i686|arm|arm64|aarch64)-linux-gnu-)?ranlib$"),
+    (ToolType.sym_lister, r"[^\0]+/((x86_64|i686|arm|arm64|aarch64)-linux-gnu-)?nm$"),
+    (ToolType.interpreter, r"[^\0]+/(python|ruby|tclsh|perl|lua)[\d\.]*$"),
+    (ToolType.builder, r"[^\0]+/((c|cc|g|q)?make|cpack|ctest|scons|ninja|bear|ccache|libtool)"),
+    (ToolType.util, r"/(usr/)?bin/.*"),
+])
+# all matchers combined into one regex with a named group per tool type
+ToolType._classifier = re.compile("|".join(
+    "(?P<{}>{})".format(k.name, v.pattern) for (k, v) in ToolType._matchers.items()))
+
+
+TOOL_VER_PENDING = "[version pending]"  # shown while a probe is running
+
+
+def _tool_ver_key(exepath: str) -> str:
+    """
+    identifies the installed tool; changes whenever it is replaced. the
+    path it was invoked as is part of the key since some tools (e.g., gcc
+    as cc) include it in their version output.
+    """
+    try:
+        realpath = os.path.realpath(exepath)
+        st = os.stat(realpath)
+    except OSError:
+        return None
+    return "{}|{}:{}:{}:{}".format(exepath, realpath, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _probe_tool_ver(exepath: str, timeout: float) -> str:
+    try:
+        p = sp.Popen([exepath, '--version'], stdout=sp.PIPE, stderr=sp.PIPE)
+    except OSError:
+        return ""
+    try:
+        stdout, stderr = p.communicate(timeout=timeout)
+    except sp.TimeoutExpired:
+        p.kill()
+        p.communicate()
+        return ""
+    ver = stdout.split(b'\n', 1)[0]  # get first line
+    ver = ver.decode(errors='replace')  # bytes -> str
+    ver = re.sub(r"\s\(.*\)", "", ver)  # remove parenthetical info if any
+    return ver
+
+
+def _on_tool_ver(exepath: str, key: str, future) -> None:
+    try:
+        ver = future.result()
+    except Exception:
+        ver = ""
+    get_tool_ver.cache[exepath] = ver
+    get_tool_ver.pending.pop(exepath, None)
+    if key and ver:
+        get_tool_ver.store[key] = ver
+        get_tool_ver.dirty = True
+
+
+def get_tool_ver(exepath: str, wait: bool = False):
     """
     Query and cache tool version. Some tools are ignored.
+
+    Versions are looked up in the on-disk cache (see `load_tool_ver_cache`)
+    first; otherwise `exepath --version` runs on a background thread and
+    TOOL_VER_PENDING is returned until it finishes, unless `wait` is set.
+    While `get_tool_ver.deferred` is set, tools are not run until
+    `wait_tool_vers` is called.
+
+    >>> get_tool_ver("/no/such/gcc", wait=True)
+    ''
+    >>> get_tool_ver("/no/such/tool") is None
+    True
     """
     version = get_tool_ver.cache.get(exepath, None)
-    if version:
+    if version is not None:
+        get_tool_ver.hits += 1
         return version
 
     # TODO: special case bear? old versions only support -v, 
@@ -133,30 +259,109 @@ def get_tool_ver(exepath: str):
     if tt == ToolType.unknown or tt == ToolType.util:
         return None
 
-    # NOTE: skipping this step leads to prettier version output for GCC
-    # at the expense of additional cache entries.
-    # exepath = os.path.realpath(exepath)  # canonicalize path
+    get_tool_ver.misses += 1
+    future = get_tool_ver.pending.get(exepath, None)
+    if not future:
+        # NOTE: probing exepath rather than its realpath leads to prettier
+        # version output for GCC at the expense of additional cache entries.
+        key = _tool_ver_key(exepath)
+        version = get_tool_ver.store.get(key, None) if key else None
+        if version:
+            get_tool_ver.cache[exepath] = version
+            return version
+
+        if get_tool_ver.deferred and not wait:
+            return TOOL_VER_PENDING
+        future = get_tool_ver.pool.submit(_probe_tool_ver, exepath, get_tool_ver.timeout)
+        get_tool_ver.pending[exepath] = future
+        future.add_done_callback(lambda f: _on_tool_ver(exepath, key, f))
+
+    if wait:
+        future.result()
+        return get_tool_ver.cache.get(exepath, "")
+    return TOOL_VER_PENDING
+
+
+get_tool_ver.cache = dict()  # init cache; exepath -> version
+get_tool_ver.pending = dict()  # exepath -> future of running probe
+get_tool_ver.store = dict()  # persistent cache; see _tool_ver_key
+get_tool_ver.dirty = False  # store has entries not yet saved
+get_tool_ver.timeout = 5.0  # seconds a probe may take
+get_tool_ver.deferred = False  # set while probes would be traced themselves
+get_tool_ver.pool = ThreadPoolExecutor(max_workers=4)
+get_tool_ver.hits = 0  # lookups answered by `cache`
+get_tool_ver.misses = 0  # lookups of tools not probed yet
+
+
+def get_stored_tool_ver(exepath: str) -> str:
+    """
+    the version of a program that is not necessarily a build tool, e.g.
+    sysdig, from the on-disk cache, or by running `exepath --version` now
+    and caching the result.
+    """
+    key = _tool_ver_key(exepath)
+    version = get_tool_ver.store.get(key, None) if key else None
+    if version:
+        return version
+    version = _probe_tool_ver(exepath, get_tool_ver.timeout)
+    if key and version:
+        get_tool_ver.store[key] = version
+        get_tool_ver.dirty = True
+    return version
+
+
+def wait_tool_vers(exepaths=(), timeout: float = None) -> None:
+    """
+    probe the versions of `exepaths` and wait for all outstanding probes.
+    ends the deferral of probes.
+
+    >>> get_tool_ver.deferred = True
+    >>> get_tool_ver("/no/such/cc") == TOOL_VER_PENDING
+    True
+    >>> wait_tool_vers(["/no/such/cc"]); get_tool_ver("/no/such/cc")
+    ''
+    """
+    get_tool_ver.deferred = False
+    for exepath in exepaths:
+        get_tool_ver(exepath)
+    futures_wait(list(get_tool_ver.pending.values()), timeout=timeout)
+
+
+def default_tool_ver_cache_path() -> str:
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(cache_home, 'cctrace', 'tool-versions.json')
+
+
+def load_tool_ver_cache(path: str) -> None:
     try:
-        p = sp.Popen([exepath, '--version'], stdout=sp.PIPE, stderr=sp.PIPE)
-        stdout, stderr = p.communicate()
-        ver = stdout.split(b'\n', 1)[0]  # get first line
-        # print("{} -> {}".format(exepath, ver))
-        ver = ver.decode()  # bytes -> str
-        ver = re.sub(r"\s\(.*\)", "", ver)  # remove parenthetical info if any
-        get_tool_ver.cache[exepath] = ver
-        return ver
-    except OSError:
-        get_tool_ver.cache[exepath] = ""
-        return ""
+        with open(path) as f:
+            store = json.load(f)
+    except (OSError, ValueError):
+        return
+    if isinstance(store, dict):
+        get_tool_ver.store.update(store)
 
 
-get_tool_ver.cache = dict()  # init cache
+def save_tool_ver_cache(path: str) -> None:
+    if not get_tool_ver.dirty:
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write a temporary file first so concurrent runs never see
+        # a partially written cache
+        tmp = "{}.{}".format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(get_tool_ver.store, f, indent=0, sort_keys=True)
+        os.replace(tmp, path)
+        get_tool_ver.dirty = False
+    except OSError as e:
+        logging.warning("could not save tool version cache %s: %s", path, e)
 
 
 def get_unchecked_tools(p):
     # return all the tools that are not checked under the policy
     unchecked = [(ToolType.from_path(k), k)
-                 for k in get_tool_ver.cache.keys()
+                 for k in list(get_tool_ver.cache.keys())
                  if not p.is_checked(k)]
     return sorted(unchecked, key=lambda t: t[0].value)
 
@@ -0,0 +1,311 @@
+"""
+SQLite store of traced processes and the `cctrace query` subcommand.
+
+every execve adds a row to `processes`; a process that forks without
+calling execve is part of the row of the program it runs. `edges` links
+each row to the row of the program that started it, `verdicts` holds
+the result of the policy check of checked tools and `versions` the
+version of each tool. rows from several sessions can share one database.
+"""
+import sys
+import time
+import sqlite3
+import argparse
+import unittest
+
+from ccevent import CCEvent
+from tools import ToolType
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    started REAL,
+    argv TEXT
+);
+CREATE TABLE IF NOT EXISTS processes (
+    id INTEGER PRIMARY KEY,
+    session INTEGER,
+    pid INTEGER,
+    ppid INTEGER,
+    exepath TEXT,
+    tooltype TEXT,
+    args TEXT,
+    cwd TEXT,
+    started INTEGER,  -- ns since the epoch
+    exited INTEGER
+);
+CREATE TABLE IF NOT EXISTS edges (
+    parent INTEGER,
+    child INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS verdicts (
+    process INTEGER PRIMARY KEY,
+    verdict TEXT,  -- 'ok' or 'violation'
+    message TEXT,
+    expected TEXT
+);
+CREATE TABLE IF NOT EXISTS versions (
+    exepath TEXT PRIMARY KEY,
+    version TEXT
+);
+CREATE INDEX IF NOT EXISTS processes_exepath ON processes (exepath);
+CREATE INDEX IF NOT EXISTS processes_tooltype ON processes (tooltype);
+CREATE INDEX IF NOT EXISTS processes_pid ON processes (pid);
+CREATE INDEX IF NOT EXISTS edges_parent ON edges (parent);
+CREATE INDEX IF NOT EXISTS verdicts_verdict ON verdicts (verdict);
+"""
+
+
+def connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+class TraceDB(object):
+    """
+    writes traced processes to a SQLite database. rows are buffered and
+    inserted `batch` at a time, one transaction per batch; row ids are
+    assigned here so that rows can refer to each other before they are
+    inserted.
+    """
+
+    def __init__(self, path: str, batch: int = 2000, argv: list = None):
+        self.conn = connect(path)
+        self.batch = batch
+        with self.conn:
+            cur = self.conn.execute("INSERT INTO sessions (started, argv) VALUES (?, ?)",
+                                    (time.time(), " ".join(argv or sys.argv)))
+        self.session = cur.lastrowid
+        self.next_id = self.conn.execute(
+            "SELECT COALESCE(MAX(id), 0) + 1 FROM processes").fetchone()[0]
+        # pid -> (row id of the program it runs, True if the row is its own)
+        self.rows_by_pid = dict()
+        self.processes = []
+        self.edges = []
+        self.verdicts = []
+        self.exits = []
+        self.pending = 0
+
+    def handle_clone(self, evt: CCEvent) -> None:
+        row = self.rows_by_pid.get(evt.ppid, None)
+        if row is not None and evt.pid not in self.rows_by_pid:
+            self.rows_by_pid[evt.pid] = (row[0], False)
+
+    def handle_execve(self, evt: CCEvent, perror=None, checked=False, ts: int = None) -> None:
+        if ts is None:
+            ts = evt.ts or int(time.time() * 1e9)  # else time of receipt
+        rowid = self.next_id
+        self.next_id += 1
+        exepath = evt.resolved_exepath
+        self.processes.append((rowid, self.session, evt.pid, evt.ppid, exepath,
+                               ToolType.from_path(exepath).name, evt.args, evt.cwd, ts))
+        parent = self.rows_by_pid.get(evt.ppid, None)
+        if parent is not None:
+            self.edges.append((parent[0], rowid))
+        self.rows_by_pid[evt.pid] = (rowid, True)
+        if perror:
+            self.verdicts.append((rowid, 'violation', perror.message, str(perror.expected)))
+        elif checked:
+            self.verdicts.append((rowid, 'ok', None, None))
+        self._added()
+
+    def handle_procexit(self, evt: CCEvent, ts: int = None) -> None:
+        row = self.rows_by_pid.pop(evt.pid, None)
+        if row is not None and row[1]:
+            self.exits.append((ts or evt.ts or int(time.time() * 1e9), row[0]))
+            self._added()
+
+    def _added(self) -> None:
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.flush()
+
+    def flush(self) -> None:
+        with self.conn:
+            self.conn.executemany("INSERT INTO processes (id, session, pid, ppid, exepath, "
+                                  "tooltype, args, cwd, started) "
+                                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", self.processes)
+            self.conn.executemany("INSERT INTO edges VALUES (?, ?)", self.edges)
+            self.conn.executemany("INSERT INTO verdicts VALUES (?, ?, ?, ?)", self.verdicts)
+            self.conn.executemany("UPDATE processes SET exited = ? WHERE id = ?", self.exits)
+        self.processes, self.edges, self.verdicts, self.exits = [], [], [], []
+        self.pending = 0
+
+    def close(self, versions: dict = None) -> None:
+        self.flush()
+        if versions:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO versions VALUES (?, ?)",
+                                      versions.items())
+        self.conn.close()
+
+
+QUERIES = {
+    'ancestry': """
+        WITH RECURSIVE chain(id, depth) AS (
+            SELECT ?, 0
+            UNION ALL
+            SELECT edges.parent, chain.depth + 1
+            FROM chain JOIN edges ON edges.child = chain.id
+        )
+        SELECT p.id, p.pid, p.exepath, p.args
+        FROM chain JOIN processes p ON p.id = chain.id
+        ORDER BY chain.depth DESC""",
+    'violations': """
+        SELECT p.id, p.pid, p.exepath, v.message, v.expected, p.args
+        FROM verdicts v JOIN processes p ON p.id = v.process
+        WHERE v.verdict = 'violation'
+        ORDER BY p.id""",
+    'tools': """
+        SELECT p.tooltype, p.exepath, COALESCE(ver.version, ''), COUNT(*)
+        FROM processes p LEFT JOIN versions ver ON ver.exepath = p.exepath
+        GROUP BY p.exepath
+        ORDER BY p.tooltype, COUNT(*) DESC""",
+    'without': """
+        SELECT p.id, p.pid, p.exepath, p.args
+        FROM processes p
+        WHERE p.exepath LIKE ? ESCAPE '\\'
+          AND instr(' ' || COALESCE(p.args, '') || ' ', ' ' || ? || ' ') = 0
+          AND instr(' ' || COALESCE(p.args, ''), ' ' || ? || '=') = 0
+        ORDER BY p.id""",
+}
+
+
+def _rows(conn: sqlite3.Connection, out, sql: str, params=()) -> int:
+    count = 0
+    for row in conn.execute(sql, params):
+        out.write("\t".join("" if c is None else str(c) for c in row) + "\n")
+        count += 1
+    return count
+
+
+def _suffix(s: str) -> str:
+    """
+    a LIKE pattern matching strings that end in s.
+    """
+    return '%' + s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _process_ids(conn: sqlite3.Connection, spec: str) -> list:
+    """
+    the rows matching `spec`: `#ID` is a row id, a number is a pid (of
+    which there may be several), anything else matches exepaths ending
+    in `spec`.
+    """
+    if spec.startswith('#'):
+        return [int(spec[1:])]
+    if spec.isdigit():
+        sql, param = "SELECT id FROM processes WHERE pid = ? ORDER BY id", int(spec)
+    else:
+        sql = "SELECT id FROM processes WHERE exepath LIKE ? ESCAPE '\\' ORDER BY id"
+        param = _suffix(spec)
+    return [r[0] for r in conn.execute(sql, (param,))]
+
+
+def query_main(argv: list, out=sys.stdout) -> int:
+    """
+    `cctrace query DB COMMAND ...`; prints tab-separated rows.
+    """
+    parser = argparse.ArgumentParser(prog="cctrace query",
+                                     description='query a trace database written with --db.')
+    parser.add_argument('db', help='trace database')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+    anc = sub.add_parser('ancestry', help='the processes that started a process, root first')
+    anc.add_argument('process', help='#ROWID, a pid or the end of an exepath (e.g. cc1)')
+    anc.add_argument('--limit', type=int, default=10, help='show at most N processes')
+    sub.add_parser('violations', help='processes that violated the policy')
+    sub.add_parser('tools', help='tools run, with their versions and number of runs')
+    wo = sub.add_parser('without', help='runs of a tool that lack an argument')
+    wo.add_argument('exe', help='end of the exepath, e.g. ld.gold')
+    wo.add_argument('arg', help='argument, e.g. -random-seed; also matches '
+                                       '-random-seed=VALUE')
+    raw = sub.add_parser('sql', help='run an SQL query')
+    raw.add_argument('sql')
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.db)
+    try:
+        if args.command == 'ancestry':
+            ids = _process_ids(conn, args.process)
+            if not ids:
+                print("no such process: " + args.process, file=sys.stderr)
+                return 1
+            for i, rowid in enumerate(ids[:args.limit]):
+                if i:
+                    out.write("\n")
+                _rows(conn, out, QUERIES['ancestry'], (rowid,))
+            if len(ids) > args.limit:
+                out.write("... {} more\n".format(len(ids) - args.limit))
+        elif args.command == 'without':
+            # an argument also counts as given with a value, as in arg=value
+            _rows(conn, out, QUERIES['without'], (_suffix(args.exe), args.arg, args.arg))
+        elif args.command == 'sql':
+            _rows(conn, out, args.sql)
+        else:
+            _rows(conn, out, QUERIES[args.command])
+    except sqlite3.Error as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+    return 0
+
+
+class TestTraceDB(unittest.TestCase):
+
+    def test_store_and_query(self):
+        import io
+        import os
+        import tempfile
+        from policy import PolicyError
+
+        def evt(line: str) -> CCEvent:
+            return CCEvent.parse(line.encode())
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "trace.db")
+            db = TraceDB(path, batch=2, argv=["cctrace"])
+            db.handle_execve(evt("10#execve#/usr/bin/make#bash#10#1#res=0 exe=make"))
+            db.handle_clone(evt("11#clone#/usr/bin/make#bash#11#10#res=0"))
+            db.handle_execve(evt("11#execve#/bin/sh#make#11#10#res=0"))
+            db.handle_clone(evt("12#clone#/bin/sh#make#12#11#res=0"))
+            db.handle_clone(evt("13#clone#/bin/sh#sh#13#12#res=0"))
+            # cc -c a.c
+            db.handle_execve(evt("13#execve#/usr/bin/cc#sh#13#12#res=0 args=Y2MALWMAYS5j"),
+                             checked=True)
+            # ld.gold a.o
+            perror = PolicyError.argument_mismatch(ToolType.linker, "-random-seed", "")
+            db.handle_execve(evt("14#execve#/usr/bin/ld.gold#make#14#10#res=0 "
+                                 "args=bGQuZ29sZABhLm8="), perror=perror)
+            # ld.gold -random-seed=1234 b.o
+            db.handle_execve(evt("15#execve#/usr/bin/ld.gold#make#15#10#res=0 "
+                                 "args=bGQuZ29sZAAtcmFuZG9tLXNlZWQ9MTIzNABiLm8="))
+            db.handle_procexit(evt("12#procexit#/bin/sh#sh#12#0#res=0"))
+            db.handle_procexit(evt("11#procexit#/bin/sh#sh#11#0#res=0"))
+            db.close({"/usr/bin/cc": "cc 12.2.0"})
+
+            def query(*argv) -> list:
+                out = io.StringIO()
+                self.assertEqual(query_main([path] + list(argv), out), 0)
+                return [l.split("\t") for l in out.getvalue().splitlines()]
+
+            # the fork without execve (12) is part of the row of sh
+            chain = query('ancestry', 'cc')
+            self.assertEqual([r[2] for r in chain], ["/usr/bin/make", "/bin/sh", "/usr/bin/cc"])
+            self.assertEqual(query('ancestry', '13'), chain)
+            violations = query('violations')
+            self.assertEqual([r[2] for r in violations], ["/usr/bin/ld.gold"])
+            without = query('without', 'ld.gold', '--', '-random-seed')
+            self.assertEqual([r[3] for r in without], ["ld.gold a.o"])  # not -random-seed=1234
+            self.assertEqual(query('without', 'cc', '--', '-c'), [])
+            self.assertIn(["c_compiler", "/usr/bin/cc", "cc 12.2.0", "1"], query('tools'))
+            exited = query('sql', 'SELECT pid FROM processes WHERE exited IS NOT NULL')
+            self.assertEqual(exited, [["11"]])
+
+
+if __name__ == '__main__':
+    unittest.main()